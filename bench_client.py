@@ -0,0 +1,161 @@
+#!/usr/bin/python
+""" Benchmark of the procclient pipeline, from bytes on the wire to pixels
+
+A synthetic workload (see procfake.py) is encoded block by block exactly as
+procserver.py would send it, then framed and decoded as SocketThread does
+and drawn by a ProcPlot on an offscreen Agg canvas, as GraphFrame does.
+Each block stands for --interval seconds, so --hours of monitoring can be
+simulated in much less time.
+
+Reported, as JSON on stdout (or --output), for tracking regressions:
+  - parse: framing plus decoding throughput;
+  - handle_messages and redraw_plot: GUI thread time per block;
+  - artists: how many the axes hold at the end;
+  - memory: the resident size as the simulated hours go by, and its growth.
+
+usage: bench_client.py [--hours 1] [--interval 1.0] [--text] [--processes N] ...
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
+
+from procstream import BlockParser
+from procblock import NameTable, decode_block
+from procplot import ProcPlot, aggregate_spec
+from procserver import Client
+from procfake import FakeScanner, parse_phase, add_workload_arguments, workload_from_arguments
+
+def resident_mb():
+  with open("/proc/self/statm") as f:
+    return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024)
+
+def distribution(samples):
+  """ Summary of per-block times, in microseconds """
+  if not samples:
+    return None
+  us = np.array(samples) * 1e6
+  return { "mean": us.mean(), "p50": np.percentile(us, 50), "p95": np.percentile(us, 95),
+           "p99": np.percentile(us, 99), "max": us.max() }
+
+class TimedPlot(ProcPlot):
+  """ ProcPlot that keeps its redraw time apart from the rest of
+  handle_messages(), and only draws every 'draw_every' blocks """
+
+  def __init__(self, fig, canvas, draw_every, retention = None):
+    ProcPlot.__init__(self, fig, canvas, retention = retention)
+    self.draw_every = draw_every
+    self.blocks = 0
+    self.redraw_time = 0.0
+    self.redraws = []
+
+  def redraw_plot(self):
+    self.blocks += 1
+    if self.blocks % self.draw_every:
+      return
+    start = time.time()
+    ProcPlot.redraw_plot(self)
+    self.redraw_time = time.time() - start
+    self.redraws.append(self.redraw_time)
+
+def run(args):
+  scanner = FakeScanner(workload_from_arguments(args), args.phase)
+  server = Client(None, NameTable())
+  server.binary = not args.text
+  parser = BlockParser()
+  names = NameTable()
+  fig = Figure((args.width / 100.0, args.height / 100.0), dpi = 100)
+  plot = TimedPlot(fig, FigureCanvasAgg(fig), args.draw_every, args.retention)
+  for spec in args.aggregate:
+    plot.add_aggregate(spec)
+  plot.aggregates_only = args.aggregates_only
+  plot.canvas.draw()
+
+  blocks = int(args.hours * 3600 / args.interval)
+  memory_every = max(1, int(args.memory_every / args.interval))
+  parse_time = 0.0
+  wire_bytes = 0
+  handle = []
+  memory = [(0.0, resident_mb())]
+  for i in xrange(blocks):
+    data = server.block(scanner.scan(), i * args.interval)
+    wire_bytes += len(data)
+
+    start = time.time()
+    batches = [decode_block(block, names)
+               for offset in xrange(0, len(data), args.recv_size)
+               for block in parser.feed(data[offset:offset + args.recv_size])]
+    parse_time += time.time() - start
+
+    for batch in batches:
+      plot.redraw_time = 0.0
+      start = time.time()
+      plot.handle_messages(batch)
+      handle.append(time.time() - start - plot.redraw_time)
+    if (i + 1) % memory_every == 0:
+      memory.append(((i + 1) * args.interval / 3600.0, resident_mb()))
+
+  # growth over the second half, once caches and the axes have settled
+  tail = memory[len(memory) // 2:]
+  growth = None
+  if len(tail) > 1 and tail[-1][0] > tail[0][0]:
+    growth = (tail[-1][1] - tail[0][1]) / (tail[-1][0] - tail[0][0])
+  return {
+    "label": args.label,
+    "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "versions": { "python": platform.python_version(), "numpy": np.__version__,
+                  "matplotlib": matplotlib.__version__ },
+    "config": dict((k, v) for k, v in vars(args).iteritems() if k not in ("output", "label")),
+    "blocks": blocks,
+    "processes": { "live": len(scanner.workload.live), "seen": scanner.workload.next_pid - 100 },
+    "parse": { "us_per_block": 1e6 * parse_time / blocks, "bytes_per_block": wire_bytes / float(blocks),
+               "mb_per_s": wire_bytes / (1024.0 * 1024) / parse_time if parse_time else None },
+    "handle_messages": distribution(handle),
+    "redraw_plot": distribution(plot.redraws),
+    "memory": { "samples": memory, "mb_per_hour": growth },
+    "artists": len(plot.axes.collections) + len(plot.axes.lines) + len(plot.axes.texts),
+  }
+
+def main():
+  ap = argparse.ArgumentParser(description = "procclient pipeline benchmark")
+  add_workload_arguments(ap)
+  ap.add_argument("--phase", action = "append", default = [], type = parse_phase, metavar = "key=value,...",
+                  help = "workload phase, as for procfake.py; repeatable")
+  ap.add_argument("--hours", type = float, default = 0.25, help = "simulated monitoring time")
+  ap.add_argument("--interval", type = float, default = 1.0, help = "simulated seconds per block")
+  ap.add_argument("--text", action = "store_true", help = "use the text protocol instead of binary")
+  ap.add_argument("--recv-size", type = int, default = 65536, help = "bytes per simulated recv()")
+  ap.add_argument("--draw-every", type = int, default = 1, help = "redraw every N blocks")
+  ap.add_argument("--memory-every", type = float, default = 60.0, help = "simulated seconds between memory samples")
+  ap.add_argument("--width", type = int, default = 1000, help = "canvas width in pixels")
+  ap.add_argument("--height", type = int, default = 600, help = "canvas height in pixels")
+  ap.add_argument("--aggregate", action = "append", default = [], type = aggregate_spec, metavar = "PID|NAME",
+                  help = "also plot this subtree's total; repeatable")
+  ap.add_argument("--aggregates-only", action = "store_true", help = "plot only the subtree totals")
+  ap.add_argument("--retention", type = float, metavar = "SECONDS",
+                  help = "forget dead processes this long after their death")
+  ap.add_argument("--label", help = "name of this run, e.g. a version, copied to the results")
+  ap.add_argument("-o", "--output", help = "write the results here instead of stdout")
+  args = ap.parse_args()
+  if args.seed is None:
+    args.seed = 1   # the same workload every run, so runs compare
+
+  results = run(args)
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent = 1, sort_keys = True)
+  else:
+    json.dump(results, sys.stdout, indent = 1, sort_keys = True)
+    print
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
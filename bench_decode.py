@@ -0,0 +1,131 @@
+#!/usr/bin/python
+""" Decode cost of report blocks: Message/MessageSet vs ReportBatch
+
+For every block this reports the decode time and the number of objects
+(and bytes) allocated to hold the decoded result, i.e. what sits in the
+wx event queue until the GUI thread gets to it.  The legacy decoder is the
+one SocketThread used before procblock.decode_block.
+
+usage: bench_decode.py [--processes N] [--blocks N]
+"""
+import gc
+import sys
+import time
+import types
+import argparse
+
+from procblock import NameTable, decode_block
+
+class LegacyMessageSet:
+  def __init__(self):
+    self.messages = []
+  def add(self, payload):
+    self.messages.append(payload)
+
+class LegacyMessage:
+  def __init__(self, type, fields):
+    self.type = type
+    self.payload = {}
+    for field in fields:
+      kv = field.split("=")
+      if len(kv) == 2:
+        self.payload[kv[0]] = kv[1]
+      elif 'name' in self.payload:
+        self.payload['name'] = self.payload['name'] + " " + kv[0]
+
+def legacy_decode(block, names):
+  batch = LegacyMessageSet()
+  for line in block.splitlines():
+    fields = line.split("|")
+    handlers = { "new": LegacyMessage,
+                 "update": LegacyMessage,
+                 "old": LegacyMessage }
+    if fields[0] in handlers:
+      batch.add(handlers[fields[0]](fields[0], fields[1:]))
+  return batch
+
+def legacy_consume(batch):
+  """ What GraphFrame.handle_messages then did on the GUI thread """
+  for msg in batch.messages:
+    if "pid" in msg.payload:
+      int(msg.payload['pid'])
+      if "uss" in msg.payload:
+        float(msg.payload['uss']) / (1024 * 1024)
+
+def columnar_consume(batch):
+  for kind, pid, uss in zip(batch.kind, batch.pid, batch.uss):
+    uss / (1024 * 1024)
+
+def footprint(root, shared):
+  """ Count the distinct objects and bytes reachable from 'root' """
+  seen = set(id(o) for o in shared)
+  todo = [root]
+  count = 0
+  size = 0
+  while todo:
+    o = todo.pop()
+    if id(o) in seen:
+      continue
+    seen.add(id(o))
+    count += 1
+    size += sys.getsizeof(o)
+    if isinstance(o, types.InstanceType):
+      todo.append(o.__dict__)
+    elif isinstance(o, dict):
+      todo.extend(o.keys())
+      todo.extend(o.values())
+    elif isinstance(o, (list, tuple)):
+      todo.extend(o)
+  return count, size
+
+def make_blocks(processes, blocks):
+  out = []
+  lines = []
+  for pid in range(processes):
+    lines.append("new|pid=%u|ppid=1|uss=%u|name=process-%u" % (pid + 100, 1048576 + pid * 4096, pid))
+  out.append("\n".join(lines) + "\n")
+  for i in range(blocks - 1):
+    lines = []
+    for pid in range(0, processes, 3):
+      lines.append("update|pid=%u|uss=%u" % (pid + 100, 1048576 + pid * 4096 + i * 4096))
+    out.append("\n".join(lines) + "\n")
+  return out
+
+def run(name, decode, consume, blocks):
+  names = NameTable()
+  gc.disable()
+  start = time.time()
+  batches = [decode(block, names) for block in blocks]
+  decoded = time.time()
+  for batch in batches:
+    consume(batch)
+  consumed = time.time()
+  gc.enable()
+
+  shared = [names, names.names, names.index] + names.names
+  sync_objects, sync_bytes = footprint(batches[0], shared)
+  objects = 0
+  size = 0
+  for batch in batches[1:]:
+    o, b = footprint(batch, shared)
+    objects += o
+    size += b
+  n = len(batches) - 1
+  print "%-11s decode %7.1f us/block  consume %7.1f us/block  sync block: %6u objects %8u bytes  update block: %6.0f objects %8.0f bytes" % \
+        (name, (decoded - start) * 1e6 / len(blocks), (consumed - decoded) * 1e6 / len(blocks),
+         sync_objects, sync_bytes, objects / float(n), size / float(n))
+
+def main():
+  ap = argparse.ArgumentParser(description = "report block decoding benchmark")
+  ap.add_argument("--processes", type = int, default = 300)
+  ap.add_argument("--blocks", type = int, default = 1000)
+  args = ap.parse_args()
+
+  blocks = make_blocks(args.processes, args.blocks)
+  print "%u blocks, %u processes" % (args.blocks, args.processes)
+  run("legacy", legacy_decode, legacy_consume, blocks)
+  run("columnar", decode_block, columnar_consume, blocks)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+""" Benchmark: many simulated procservers into one ConnectionManager
+
+A child process simulates --servers procservers on consecutive ports,
+each sending a sync block and then one update block per --interval
+seconds.  This process multiplexes all of them on a single thread and
+reports throughput and its own CPU use, as a fraction of one core.
+
+usage: bench_mux.py [--servers 50] [--processes 150] [--interval 1.0] [--duration 20]
+"""
+import os
+import sys
+import time
+import random
+import select
+import argparse
+import multiprocessing
+from socket import *
+
+from procmux import ConnectionManager
+
+def sync_block(processes):
+  lines = ["new|pid=%u|ppid=1|uss=%u|name=process-%u" % (pid, 1048576 + pid * 4096, pid)
+           for pid in range(100, 100 + processes)]
+  return ">>>\n" + "\n".join(lines) + "\n<<<\n"
+
+def update_block(processes, fraction):
+  lines = ["update|pid=%u|uss=%u" % (pid, random.randint(1, 64) * 1048576)
+           for pid in range(100, 100 + processes) if random.random() < fraction]
+  return ">>>\n" + "\n".join(lines) + "\n<<<\n"
+
+def serve(port, servers, processes, fraction, interval, ready):
+  """ Simulate 'servers' procservers on ports port..port+servers-1 """
+  listeners = []
+  for i in range(servers):
+    s = socket(AF_INET, SOCK_STREAM)
+    s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    s.bind(("127.0.0.1", port + i))
+    s.listen(1)
+    listeners.append(s)
+  ready.set()
+  clients = []
+  next_tick = time.time() + interval
+  while listeners or clients:
+    timeout = max(0, next_tick - time.time())
+    readable, w, x = select.select(listeners + clients, [], [], timeout)
+    for s in readable:
+      if s in listeners:
+        c, addr = s.accept()
+        c.sendall(sync_block(processes))
+        clients.append(c)
+        listeners.remove(s)
+        s.close()
+      else:
+        if not s.recv(4096):
+          clients.remove(s)
+          s.close()
+    if time.time() >= next_tick:
+      next_tick += interval
+      for c in list(clients):
+        try:
+          c.sendall(update_block(processes, fraction))
+        except error:
+          clients.remove(c)
+          c.close()
+
+def main():
+  ap = argparse.ArgumentParser(description = "multi-device client benchmark")
+  ap.add_argument("--servers", type = int, default = 50)
+  ap.add_argument("--processes", type = int, default = 150)
+  ap.add_argument("--fraction", type = float, default = 0.3, help = "fraction of processes updated per block")
+  ap.add_argument("--interval", type = float, default = 1.0, help = "seconds between blocks")
+  ap.add_argument("--duration", type = float, default = 20.0)
+  ap.add_argument("--port", type = int, default = 27600)
+  args = ap.parse_args()
+
+  ready = multiprocessing.Event()
+  server = multiprocessing.Process(target = serve, args = (args.port, args.servers, args.processes,
+                                                           args.fraction, args.interval, ready))
+  server.daemon = True
+  server.start()
+  ready.wait()
+
+  manager = ConnectionManager()
+  for i in range(args.servers):
+    manager.add("device-%u" % i, "127.0.0.1", args.port + i)
+
+  start = time.time()
+  cpu = os.times()
+  manager.run(args.duration)
+  elapsed = time.time() - start
+  used = os.times()
+  cpu = (used[0] - cpu[0]) + (used[1] - cpu[1])
+  server.terminate()
+
+  blocks = sum(s.blocks for s in manager.stores.itervalues())
+  connected = sum(1 for s in manager.stores.itervalues() if s.blocks)
+  print "%u/%u devices, %u processes each, one block every %gs" % \
+        (connected, args.servers, args.processes, args.interval)
+  print "%u blocks in %.1f s: %.1f blocks/s" % (blocks, elapsed, blocks / elapsed)
+  print "client CPU: %.2f s = %.1f%% of one core, %.0f us per block" % \
+        (cpu, 100.0 * cpu / elapsed, 1e6 * cpu / max(blocks, 1))
+  return 0 if connected == args.servers else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+""" Throughput benchmark for the procserver stream framer
+
+Compares procstream.BlockParser against the original splitlines()-based
+loop from SocketThread.run, over a synthetic stream of report blocks fed
+in chunks of various sizes.
+
+usage: bench_parser.py [--processes N] [--blocks N] [--chunks 1024,65536]
+"""
+import sys
+import time
+import argparse
+
+from procstream import BlockParser
+
+def make_stream(processes, blocks):
+  """ Build a synthetic stream: one sync block followed by update blocks """
+  out = []
+  lines = [">>>"]
+  for pid in range(processes):
+    lines.append("new|pid=%u|ppid=1|uss=%u|name=process-%u" % (pid + 100, 1048576 + pid * 4096, pid))
+  lines.append("<<<")
+  out.append("\n".join(lines) + "\n")
+  for i in range(blocks - 1):
+    lines = [">>>"]
+    for pid in range(0, processes, 3):
+      lines.append("update|pid=%u|uss=%u" % (pid + 100, 1048576 + pid * 4096 + i * 4096))
+    lines.append("<<<")
+    out.append("\n".join(lines) + "\n")
+  return "".join(out)
+
+class LegacyParser:
+  """ The framing loop SocketThread.run used before BlockParser """
+
+  def __init__(self):
+    self.stream = ''
+    self.got_sob = False
+    self.block = None
+
+  def feed(self, chunk):
+    blocks = []
+    self.stream = self.stream + chunk
+    lines = self.stream.splitlines(1)
+    self.stream = ''
+    for line in lines:
+      if line.endswith('\n'):
+        line = line.rstrip()
+        if line == '>>>':
+          self.got_sob = True
+          self.block = []
+        elif line == '<<<':
+          blocks.append(self.block)
+          self.block = []
+        elif self.got_sob:
+          self.block.append(line)
+      else:
+        self.stream = line
+    return blocks
+
+def run(parser, stream, chunk_size):
+  count = 0
+  start = time.time()
+  for i in xrange(0, len(stream), chunk_size):
+    count += len(parser.feed(stream[i:i + chunk_size]))
+  return count, time.time() - start
+
+def main():
+  ap = argparse.ArgumentParser(description = "procserver stream framing benchmark")
+  ap.add_argument("--processes", type = int, default = 300)
+  ap.add_argument("--blocks", type = int, default = 2000)
+  ap.add_argument("--chunks", default = "1024,4096,65536")
+  args = ap.parse_args()
+
+  stream = make_stream(args.processes, args.blocks)
+  mb = len(stream) / (1024.0 * 1024.0)
+  print "stream: %u blocks, %u processes, %.1f MB" % (args.blocks, args.processes, mb)
+  for chunk_size in [int(c) for c in args.chunks.split(",")]:
+    for name, parser in (("legacy", LegacyParser()), ("BlockParser", BlockParser(chunk_size))):
+      count, elapsed = run(parser, stream, chunk_size)
+      if count != args.blocks:
+        print "%s: expected %u blocks, got %u" % (name, args.blocks, count)
+        return 1
+      print "%-12s chunk=%6u  %8.3f s  %8.1f MB/s  %9.0f blocks/s" % \
+            (name, chunk_size, elapsed, mb / elapsed, count / elapsed)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
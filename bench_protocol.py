@@ -0,0 +1,77 @@
+#!/usr/bin/python
+""" Wire size and decode cost of the text and binary procserver protocols
+
+Encodes the same synthetic report blocks (one sync block, then updates of
+a fraction of the processes per block) both ways, checks that they decode
+to the same batches, and reports bytes and decode time per block.
+
+usage: bench_protocol.py [--processes 150] [--fraction 0.3] [--blocks 500]
+"""
+import sys
+import time
+import random
+import argparse
+
+from procstream import BlockParser
+from procblock import KIND_NEW, KIND_UPDATE, NameTable, ReportBatch, \
+                      decode_block, encode_text, encode_binary
+
+def make_batches(processes, fraction, blocks):
+  names = NameTable()
+  pids = range(1000, 1000 + processes)
+  batches = []
+  t = time.time()
+  sync = ReportBatch(names)
+  for pid in pids:
+    sync.add(KIND_NEW, pid, 1, random.randint(64, 16384) * 4096,
+             names.intern("/system/bin/process-%u" % pid))
+  sync.server_time = t
+  batches.append(sync)
+  for i in xrange(blocks - 1):
+    batch = ReportBatch(names)
+    for pid in pids:
+      if random.random() < fraction:
+        batch.add(KIND_UPDATE, pid, 0, random.randint(64, 16384) * 4096)
+    batch.server_time = t + i + 1
+    batches.append(batch)
+  return batches
+
+def decode_stream(data, chunk):
+  """ Frame and decode 'data' as if received in 'chunk' sized reads """
+  parser = BlockParser()
+  names = NameTable()
+  decoded = []
+  elapsed = 0.0
+  for i in xrange(0, len(data), chunk):
+    start = time.time()
+    for block in parser.feed(data[i:i + chunk]):
+      decoded.append(decode_block(block, names))
+    elapsed += time.time() - start
+  return decoded, elapsed
+
+def main():
+  ap = argparse.ArgumentParser(description = "text vs binary protocol benchmark")
+  ap.add_argument("--processes", type = int, default = 150)
+  ap.add_argument("--fraction", type = float, default = 0.3, help = "fraction of processes updated per block")
+  ap.add_argument("--blocks", type = int, default = 500)
+  ap.add_argument("--chunk", type = int, default = 4096, help = "bytes per simulated recv()")
+  args = ap.parse_args()
+
+  batches = make_batches(args.processes, args.fraction, args.blocks)
+  results = {}
+  for label, encode in (("text", encode_text), ("binary", encode_binary)):
+    frames = [encode(b) for b in batches]
+    decoded, elapsed = decode_stream(b''.join(frames), args.chunk)
+    results[label] = decoded
+    print "%-6s  sync block %6u bytes, update blocks %6.0f bytes, decode %6.1f us/block" % \
+          (label, len(frames[0]), sum(map(len, frames[1:])) / float(len(frames) - 1),
+           1e6 * elapsed / len(decoded))
+
+  for a, b in zip(results["text"], results["binary"]):
+    if list(a.records()) != list(b.records()):
+      print "MISMATCH"
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -3,8 +3,10 @@
 import os,sys,math
 import datetime as dt
 import platform
+from collections import deque
 
 # when we run from Notepad++, the working directory is wrong - fix it here
+launchPath = os.getcwd()
 currentPath = os.path.dirname(os.path.abspath(__file__))
 os.chdir(currentPath)
 
@@ -23,6 +25,116 @@ FRAME_DELAY = (1000 / FRAMERATE) - 5  # allow for loop overhead & window redraw
 STOP_PAUSE = FRAME_DELAY * 2
 QUIT_PAUSE = FRAME_DELAY * 3
 
+# the canvas and memory only hold the latest HISTORY samples, older ones go to a file,
+# so that the cost of a frame doesn't grow with the length of the capture
+HISTORY = RIGHT_SIDE * 4
+PAGE_SAMPLES = FRAMERATE * 60	# samples written to the file at once
+CAPTURE_DIR = "captures"		# where captures go unless a path is given on the command line
+LOG_LINES = 1000				# lines kept in the log list
+
+# keep the latest samples in memory, and append the older ones to a CSV file
+class SamplePager:
+	def __init__(self, path):
+		self.path = path
+		self.window = deque()		# (seconds, sample), oldest first
+		self.pending = []
+		self.file = None
+
+	def add(self, seconds, sample):
+		self.window.append((seconds, sample))
+		if len(self.window) > HISTORY:
+			self.pageOut(*self.window.popleft())
+
+	def pageOut(self, seconds, sample):
+		self.pending.append("{:.3f},{:.1f},{:.3f}\n".format(seconds, sample.getCurrent() / 10.0, sample.getVoltage() / 1000.0))
+		if len(self.pending) >= PAGE_SAMPLES:
+			self.flush()
+
+	def flush(self):
+		if not self.pending:
+			return
+		if self.file is None:
+			directory = os.path.dirname(self.path)
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory)
+			self.file = open(self.path, "w")
+			self.file.write("seconds,current_mA,voltage_V\n")
+		self.file.writelines(self.pending)
+		self.file.flush()
+		self.pending = []
+
+	# write out what is still in memory too, so the file holds the whole capture
+	def close(self):
+		while self.window:
+			self.pageOut(*self.window.popleft())
+		self.flush()
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+# draw the trace into a fixed ring of canvas items: each new sample reuses the items
+# of the sample HISTORY samples older, so the number of items never grows
+class TraceRenderer:
+	def __init__(self, canvas):
+		self.canvas = canvas
+		# created bottom to top: grid, time labels, then the trace
+		self.levelLines = []
+		for index in range(-7, 8):
+			lineY = ZERO_LINE - (index * (100 / SCALE_FACTOR))
+			self.levelLines.append(canvas.create_line(0, lineY, RIGHT_SIDE, lineY, fill="grey"))
+		self.secondLines = [self.hiddenLine() for i in range(HISTORY / FRAMERATE + 1)]
+		self.labels = [canvas.create_text(0, 0, text="", fill="blue", state=HIDDEN) for i in range(HISTORY / (FRAMERATE * 10) + 1)]
+		# per sample, the line to the zero line when the current changes sign, and the line to the sample
+		self.risers = [self.hiddenLine() for i in range(HISTORY)]
+		self.segments = [self.hiddenLine() for i in range(HISTORY)]
+
+	def hiddenLine(self):
+		return self.canvas.create_line(0, 0, 0, 0, state=HIDDEN)
+
+	# returns True when a new page was started, i.e. the scroll region moved
+	def draw(self, xPosition, yPosition, newYPosition, previousCurrent, current):
+		canvas = self.canvas
+
+		# a page at a time, we want horizontal lines each 100 mA across what the canvas holds,
+		# and the scroll region to end with the page: the latest HISTORY samples
+		newPage = (xPosition % RIGHT_SIDE) == 0
+		if newPage:
+			left = max(0, xPosition - HISTORY)
+			for line in self.levelLines:
+				lineY = canvas.coords(line)[1]
+				canvas.coords(line, left, lineY, xPosition + RIGHT_SIDE, lineY)
+			canvas.config(scrollregion=(max(0, xPosition + RIGHT_SIDE - HISTORY), 0, xPosition + RIGHT_SIDE, BOTTOM_SIDE))
+
+		# we want vertical lines every second
+		if (xPosition % FRAMERATE) == 0:
+			if (xPosition % (FRAMERATE * 10)) == 0:
+				color = "dark grey"
+			else:
+				color = "grey"
+			line = self.secondLines[(xPosition / FRAMERATE) % len(self.secondLines)]
+			canvas.coords(line, xPosition, 0, xPosition, BOTTOM_SIDE)
+			canvas.itemconfig(line, fill=color, state=NORMAL)
+
+		# we want time labels every 10 seconds
+		if (xPosition % (FRAMERATE * 10)) == 0:
+			label = self.labels[(xPosition / (FRAMERATE * 10)) % len(self.labels)]
+			canvas.coords(label, max(xPosition, 5), BOTTOM_SIDE - 10)
+			canvas.itemconfig(label, text=str(xPosition / FRAMERATE), state=NORMAL)
+
+		# draw the current line(s): through the zero line when the sign changes
+		slot = xPosition % HISTORY
+		riser = self.risers[slot]
+		if (current < 0 and previousCurrent > 0) or (current >= 0 and previousCurrent < 0):
+			canvas.coords(riser, xPosition, yPosition, xPosition, ZERO_LINE)
+			canvas.itemconfig(riser, fill="red" if previousCurrent < 0 else "black", state=NORMAL)
+			yPosition = ZERO_LINE
+		else:
+			canvas.itemconfig(riser, state=HIDDEN)
+		segment = self.segments[slot]
+		canvas.coords(segment, xPosition, yPosition, xPosition + 1, newYPosition)
+		canvas.itemconfig(segment, fill="red" if current < 0 else "black", state=NORMAL)
+		return newPage
+
 class SampleDisplayer:
 	def __init__(self):
 		self.module = CurrentModule()
@@ -69,7 +181,7 @@ class SampleDisplayer:
 		else:
 			self.serialPortName = "/dev/ttyACM0"
 		self.drawScaleCanvas()
-		self.drawInitialMainCanvas()
+		self.renderer = TraceRenderer(self.mainCanvas)
 		self.xPosition = 0
 		self.module.startRunning(self.serialPortName)
 		sample = self.module.getSample()
@@ -77,9 +189,12 @@ class SampleDisplayer:
 		self.yPosition = ZERO_LINE - (current / SCALE_FACTOR)
 		self.previousCurrent = 0
 		self.running = False
-		self.lastLine = None
-		self.samples = []
 		self.startTimestamp = dt.datetime.utcnow()
+		if len(sys.argv) > 1:
+			capturePath = os.path.join(launchPath, sys.argv[1])
+		else:
+			capturePath = os.path.join(currentPath, CAPTURE_DIR, self.startTimestamp.strftime("current-%Y%m%d-%H%M%S.csv"))
+		self.samples = SamplePager(capturePath)
 
 	def handleCloseButton(self):
 		self.stopRunning()
@@ -87,6 +202,7 @@ class SampleDisplayer:
 
 	def quit(self):
 		self.module.stopRunning()
+		self.samples.close()
 		self.master.destroy()
 		self.master.quit()
 
@@ -99,13 +215,9 @@ class SampleDisplayer:
 	def drawCurrentLine(self):
 		startTime = unix_time_millis(dt.datetime.utcnow())
 
-		# auto-scroll the canvas one pixel
-		if self.xPosition > RIGHT_SIDE:
-			scrollPair = self.canvasScroll.get()
-			scrollPos = scrollPair[1]
-			# only auto-scroll if the scroll bar is hard-right...
-			if scrollPos > 0.98:
-				self.mainCanvas.xview_scroll(1, "units")
+		# only auto-scroll if the scroll bar is hard-right...
+		scrollPair = self.canvasScroll.get()
+		follow = scrollPair[1] > 0.98
 
 		# extract a sample from the usb ammeter, and scale it to the screen
 		sample = self.module.getSample()
@@ -130,56 +242,23 @@ class SampleDisplayer:
 		voltage = millivolts / 1000.0
 		voltageString = "Voltage\n{:3.2f} V".format(voltage)
 		self.voltageString.set(voltageString)
-		self.samples.append(sample)
+		self.samples.add((dt.datetime.utcnow() - self.startTimestamp).total_seconds(), sample)
 		current = sample.getCurrent() / 10.0
 		newYPosition = ZERO_LINE - (current / SCALE_FACTOR)
 
 		# log the current sample
 		self.logWidget.insert(END, str(current) + " mA")
+		if self.logWidget.size() > LOG_LINES:
+			self.logWidget.delete(0)
 		self.logWidget.see(END)
 
-		# we want horizontal lines each 100 mA
-		if (self.xPosition % RIGHT_SIDE) == 0:
-			for index in range(-7, 8):
-				lineY = ZERO_LINE - (index * (100 / SCALE_FACTOR));
-				self.mainCanvas.create_line(RIGHT_SIDE, lineY, self.xPosition + RIGHT_SIDE, lineY, fill="grey")
-
-		# we want vertical lines every second
-		if (self.xPosition % FRAMERATE) == 0:
-			if (self.xPosition % (FRAMERATE * 10)) == 0:
-				color = "dark grey"
-			else:
-				color = "grey"
-			if self.lastLine != None:
-				self.mainCanvas.tag_lower(self.lastLine)
-			self.lastLine = self.mainCanvas.create_line(self.xPosition, 0, self.xPosition, BOTTOM_SIDE, fill=color)
-
-		# we want time labels every 10 seconds
-		if (self.xPosition % (FRAMERATE * 10)) == 0:
-			label = str(self.xPosition / FRAMERATE)
-			xPos = self.xPosition
-			if xPos == 0:
-				xPos = 5
-			# we have this nonsense with lastLine so the last seconds text label will be above the next line
-			self.mainCanvas.create_text(xPos, BOTTOM_SIDE - 10, text=label, fill="blue")
-
-		# draw the current line(s)
-		if current < 0:
-			if self.previousCurrent > 0:
-				self.mainCanvas.create_line(self.xPosition, self.yPosition, self.xPosition, ZERO_LINE, fill="black")
-				self.mainCanvas.create_line(self.xPosition, ZERO_LINE, self.xPosition + 1, newYPosition, fill="red")
-			else:
-				self.mainCanvas.create_line(self.xPosition, self.yPosition, self.xPosition + 1, newYPosition, fill="red")
-		else:
-			if self.previousCurrent < 0:
-				self.mainCanvas.create_line(self.xPosition, self.yPosition, self.xPosition, ZERO_LINE, fill="red")
-				self.mainCanvas.create_line(self.xPosition, ZERO_LINE, self.xPosition + 1, newYPosition, fill="black")
-			else:
-				self.mainCanvas.create_line(self.xPosition, self.yPosition, self.xPosition + 1, newYPosition, fill="black")
+		# the trace sweeps across the page; the view only moves when the next page starts
+		newPage = self.renderer.draw(self.xPosition, self.yPosition, newYPosition, self.previousCurrent, current)
+		if follow and newPage:
+			self.mainCanvas.xview_moveto(1.0)
 
 		# update continuous values, and compute the 10 Hz delay
 		self.xPosition = self.xPosition + 1
-		self.mainCanvas.config(scrollregion=(0, 0, self.xPosition, BOTTOM_SIDE))
 		self.yPosition = newYPosition
 		self.previousCurrent = current
 		drawTime = int(unix_time_millis(dt.datetime.utcnow()) - startTime)
@@ -199,12 +278,6 @@ class SampleDisplayer:
 		self.scaleCanvas.create_text(90, BOTTOM_SIDE - 2, text="seconds:", anchor=SE, fill="blue")
 		self.scaleCanvas.create_line(0, BOTTOM_SIDE - 1, 99, BOTTOM_SIDE - 1)
 
-	# we need to fill in the left side of the canvas which isn't really used
-	def drawInitialMainCanvas(self):
-		for index in range(-7, 8):
-			newY = ZERO_LINE - (index * 50);
-			self.mainCanvas.create_line(0, newY, RIGHT_SIDE, newY, fill="grey")
-
 	def startRunning(self):
 		self.running = True
 		# self.module.startRunning()
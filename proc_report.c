@@ -1,9 +1,18 @@
 #include "proc_report.h"
 
+#include <errno.h>
+#include <stdio.h>
 #include <dirent.h>
 #include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
 #include <unistd.h>
 #include <inttypes.h>
+#include <strings.h>
+#include <sys/time.h>
+#include <fcntl.h>
+#include <time.h>
+#include <fnmatch.h>
 
 #include "red_black_tree.h"
 
@@ -23,19 +32,25 @@ static const bool false = 0;
 typedef enum {
   PS_UNKNOWN,     // process status is unknown
   PS_NEW,         // process was created just before this iteration
-  PS_IDLE,        // process has not changed vitals since last iteration
-  PS_UPDATED,     // process has changed vitals since last iteration
-  PS_RENAMED      // process has changed names
+  PS_IDLE         // process existed before this iteration
 } PROCESS_STATUS;
 
+// Bit masks below have one bit per subscriber id.  What changed is
+// tracked per subscriber, since subscribers get blocks at different
+// intervals and watch different processes.
 typedef struct {
   pid_t           pid;
   pid_t           ppid;
   const char*     name;
-  const char*     new_name;
-  size_t          uss;
-  size_t          new_uss;
+  size_t          uss;      // as of the last sample that read it
   PROCESS_STATUS  status;
+  unsigned long   resident;   // statm pages when smaps was last parsed
+  unsigned long   shared;
+  uint64_t        parsed_at;  // CLOCK_MONOTONIC ms of that parse, 0 if never
+  uint32_t        watchers;   // due subscribers watching it, this sample
+  uint32_t        announced;  // subscribers told it is alive
+  uint32_t        renamed;    // subscribers not yet told its current name
+  size_t          sent_uss[PROC_MAX_SUBSCRIBERS];
 } process_info;
 
 int
@@ -61,6 +76,7 @@ tree_node_destroy(void* node)
 {
   process_info* n = (process_info*)node;
   TRACE("destroy node, pid=%u\n", n->pid);
+  free((void*)n->name);
   free(n);
 }
 
@@ -79,11 +95,685 @@ tree_node_dump(void* node)
 }
 
 static rb_red_blk_tree* processes = NULL;
+static pid_t max_pid = 0;
+
+// A block is encoded in memory and written with a single write().
+//
+// The binary format is ">>>B", the u32 length of the rest, then (all
+// little-endian):
+//
+//   header  magic "PRB3", u32 records, u32 names, u32 flags, f64 time,
+//           u32 smaps parsed, u32 smaps skipped, u32 seq, u32 stream,
+//           f64 end, f64 write
+//   records u8 kind, 3 pad bytes, i32 pid, i32 ppid, i32 name, i64 uss
+//   names   u16 length + bytes, for each name referenced by the records
+//
+// 'name' indexes this block's name table, -1 for none; 'uss' is -1 when
+// not reported ('old').  Kinds match the text format: 0 new, 1 update,
+// 2 old.  Flag BINARY_FLAG_SYNC marks a snapshot, as "sync=1" does on the
+// text format's time line.  The parsed/skipped counts are also sent as a
+// "stats|" line in text blocks.  ("PRB1" headers lacked the counts.)
+//
+// Every block carries the timings of its way through the server: 'time' is
+// when the sample started, 'end' when it was encoded and 'write' when it
+// was handed to the client's socket, plus the number of the sample in the
+// server's stream and the stream's id.  Text blocks send them as
+// "time|real=T|seq=N|stream=S" and "latency|end=T|write=T" lines.  ("PRB2"
+// headers ended after the counts; 0 was sent for the stream before there
+// was one.)
+#define BINARY_HEADER_SIZE  56
+#define BINARY_FLAG_SYNC    1
+#define BINARY_RECORD_SIZE  24
+
+enum { KIND_NEW, KIND_UPDATE, KIND_OLD };
+
+typedef struct {
+  char*   data;
+  size_t  len;
+  size_t  cap;
+} proc_buffer;
+
+typedef struct {
+  PROC_FORMAT format;
+  int         sync;
+  proc_buffer out;        // text lines, or binary records
+  proc_buffer names;      // binary name table
+  uint32_t    records;
+  uint32_t    name_count;
+  uint32_t    parsed;     // smaps read this sample
+  uint32_t    skipped;    // smaps skipped since statm didn't change
+  uint32_t    seq;
+  uint32_t    stream;
+  size_t      write_at;   // offset of the write time in 'out'
+} proc_encoder;
+
+// The processes of one sample that some subscriber watched, by pid: what
+// a subscriber resuming from that sample knows
+typedef struct {
+  pid_t     pid;
+  pid_t     ppid;
+  uint64_t  uss;
+  char      name[16];     // comm names are at most 15 characters
+} history_entry;
+
+typedef struct {
+  uint32_t        seq;
+  history_entry*  entries;
+  size_t          count;
+  size_t          cap;
+} history_sample;
+
+// the last 'history_size' samples, sample 'seq' in slot seq % history_size
+static history_sample* history = NULL;
+static unsigned history_size = PROC_DEFAULT_HISTORY;
+static uint32_t stream_id = 0;
+static uint32_t sample_seq = 0;   // of the next sample
+
+// width of the text format's write time, so it can be filled in in place
+#define TEXT_TIME_WIDTH 17
+
+static char*
+buffer_reserve(proc_buffer* b, size_t n)
+{
+  if (b->len + n > b->cap) {
+    size_t cap = b->cap ? b->cap : 4096;
+    while (cap < b->len + n) {
+      cap *= 2;
+    }
+    char* data = realloc(b->data, cap);
+    if (!data) {
+      return NULL;
+    }
+    b->data = data;
+    b->cap = cap;
+  }
+  return b->data + b->len;
+}
+
+static void
+put_le(char* p, uint64_t v, int n)
+{
+  int i;
+  for (i = 0; i < n; ++i) {
+    p[i] = (char)(v >> (8 * i));
+  }
+}
+
+static PROC_COLLECTOR collector = PROC_DEFAULT_COLLECTOR;
+static unsigned max_staleness = PROC_DEFAULT_MAX_STALENESS;
+
+void
+proc_set_collector(PROC_COLLECTOR c)
+{
+  collector = c;
+}
+
+void
+proc_set_max_staleness(unsigned ms)
+{
+  max_staleness = ms;
+}
+
+// Resident and shared pages from /proc/<pid>/statm: a cheap signal that
+// the process' memory moved, at a fraction of the cost of smaps
+static int
+read_statm(pid_t pid, unsigned long* resident, unsigned long* shared)
+{
+  char buf[128];
+
+  snprintf(buf, sizeof(buf), "/proc/%u/statm", pid);
+  int fd = open(buf, O_RDONLY);
+  if (fd < 0) {
+    return -1;
+  }
+  ssize_t n = read(fd, buf, sizeof(buf) - 1);
+  close(fd);
+  if (n <= 0) {
+    return -1;
+  }
+  buf[n] = '\0';
+
+  // size resident shared text lib data dt
+  char* p;
+  strtoul(buf, &p, 10);
+  *resident = strtoul(p, &p, 10);
+  *shared = strtoul(p, &p, 10);
+  return 0;
+}
+
+// calculate USS: the total size of all of the private data held by the
+// process, from the Private_Clean and Private_Dirty lines of its smaps
+
+static int
+uss_sscanf(pid_t pid, uint64_t* uss)
+{
+  char buf[1024];
+
+  snprintf(buf, sizeof(buf), "/proc/%u/smaps", pid);
+  FILE* f = fopen(buf, "r");
+  if (!f) {
+    return -1;
+  }
+  *uss = 0;
+  while (fgets(buf, sizeof(buf), f)) {
+    uint64_t val;
+    if (sscanf(buf, "Private_Dirty: %" PRIu64 " kB", &val) == 1 ||
+        sscanf(buf, "Private_Clean: %" PRIu64 " kB", &val) == 1) {
+      *uss += val * 1024UL;
+    }
+  }
+  fclose(f);
+  return 0;
+}
+
+// Read all of 'path' into a buffer that is kept and grown across calls,
+// so a scan of every process costs no allocations once warmed up.  The
+// data is NUL-terminated.  Returns its length, or -1.
+static ssize_t
+read_whole_file(const char* path, proc_buffer* b)
+{
+  int fd = open(path, O_RDONLY);
+  if (fd < 0) {
+    return -1;
+  }
+  b->len = 0;
+  while (1) {
+    if (!buffer_reserve(b, 64 * 1024)) {
+      close(fd);
+      return -1;
+    }
+    ssize_t n = read(fd, b->data + b->len, b->cap - b->len - 1);
+    if (n < 0) {
+      if (errno == EINTR) {
+        continue;
+      }
+      close(fd);
+      return -1;
+    }
+    if (n == 0) {
+      break;
+    }
+    b->len += n;
+  }
+  close(fd);
+  b->data[b->len] = '\0';
+  return b->len;
+}
+
+// Sum the "Private_Clean:" and "Private_Dirty:" values (in kB) of smaps
+// or smaps_rollup text.  Only the first bytes of each line are looked at.
+static uint64_t
+scan_private(const char* p, const char* end)
+{
+  uint64_t uss = 0;
+  while (p < end) {
+    if (p[0] == 'P' && end - p > 14 && memcmp(p, "Private_", 8) == 0 &&
+        (memcmp(p + 8, "Clean:", 6) == 0 || memcmp(p + 8, "Dirty:", 6) == 0)) {
+      p += 14;
+      while (*p == ' ') {
+        ++p;
+      }
+      uint64_t val = 0;
+      while (*p >= '0' && *p <= '9') {
+        val = val * 10 + (*p++ - '0');
+      }
+      uss += val * 1024UL;
+    }
+    p = memchr(p, '\n', end - p);
+    if (!p) {
+      break;
+    }
+    ++p;
+  }
+  return uss;
+}
+
+static int
+uss_scan(pid_t pid, const char* file, uint64_t* uss)
+{
+  static proc_buffer in;
+  char path[64];
+
+  snprintf(path, sizeof(path), "/proc/%u/%s", pid, file);
+  if (read_whole_file(path, &in) < 0) {
+    return -1;
+  }
+  *uss = scan_private(in.data, in.data + in.len);
+  return 0;
+}
+
+static int
+read_uss(pid_t pid, PROC_COLLECTOR c, uint64_t* uss)
+{
+  // smaps_rollup appeared in Linux 4.14; don't keep trying without it
+  static int have_rollup = 1;
+
+  switch (c) {
+    case PROC_COLLECT_SSCANF:
+      return uss_sscanf(pid, uss);
+
+    case PROC_COLLECT_ROLLUP:
+      if (have_rollup) {
+        if (uss_scan(pid, "smaps_rollup", uss) == 0) {
+          return 0;
+        }
+        if (errno != ENOENT) {
+          return -1;
+        }
+        // gone, or no kernel support: tell them apart by smaps
+        if (uss_scan(pid, "smaps", uss) < 0) {
+          return -1;
+        }
+        TRACE("no smaps_rollup, falling back to smaps");
+        have_rollup = 0;
+        return 0;
+      }
+      return uss_scan(pid, "smaps", uss);
+
+    case PROC_COLLECT_SMAPS:
+    default:
+      return uss_scan(pid, "smaps", uss);
+  }
+}
+
+static void
+encoder_begin(proc_encoder* e, PROC_FORMAT format, int sync, uint32_t seq,
+              uint32_t stream, const struct timeval* now)
+{
+  e->format = format;
+  e->sync = sync;
+  e->seq = seq;
+  e->stream = stream;
+  e->out.len = 0;
+  e->names.len = 0;
+  e->records = 0;
+  e->name_count = 0;
+  if (format == PROC_FORMAT_TEXT) {
+    char* p = buffer_reserve(&e->out, 96);
+    if (p) {
+      // server-side wall clock time of this sample, for recordings
+      e->out.len += sprintf(p, ">>>\ntime|real=%lu.%06lu|seq=%u|stream=%u%s\n",
+                            (unsigned long)now->tv_sec, (unsigned long)now->tv_usec,
+                            seq, stream, sync ? "|sync=1" : "");
+    }
+  } else {
+    // frame marker, length and header are filled in by encoder_finish()
+    if (buffer_reserve(&e->out, 8 + BINARY_HEADER_SIZE)) {
+      e->out.len = 8 + BINARY_HEADER_SIZE;
+    }
+  }
+}
+
+static void
+encoder_add(proc_encoder* e, int kind, const process_info* info, const char* name)
+{
+  if (e->format == PROC_FORMAT_TEXT) {
+    char* p = buffer_reserve(&e->out, 96 + (name ? strlen(name) : 0));
+    if (!p) {
+      return;
+    }
+    switch (kind) {
+      case KIND_NEW:
+        if (name) {
+          e->out.len += sprintf(p, "new|pid=%u|ppid=%u|uss=%u|name=%s\n",
+                                info->pid, info->ppid, info->uss, name);
+        } else {
+          e->out.len += sprintf(p, "new|pid=%u|ppid=%u|uss=%u\n",
+                                info->pid, info->ppid, info->uss);
+        }
+        break;
+      case KIND_UPDATE:
+        if (name) {
+          e->out.len += sprintf(p, "update|pid=%u|uss=%u|name=%s\n",
+                                info->pid, info->uss, name);
+        } else {
+          e->out.len += sprintf(p, "update|pid=%u|uss=%u\n", info->pid, info->uss);
+        }
+        break;
+      case KIND_OLD:
+        e->out.len += sprintf(p, "old|pid=%u\n", info->pid);
+        break;
+    }
+    return;
+  }
+
+  int32_t name_index = -1;
+  if (name) {
+    size_t len = strlen(name);
+    if (len > 0xffff) {
+      len = 0xffff;
+    }
+    char* p = buffer_reserve(&e->names, 2 + len);
+    if (p) {
+      put_le(p, len, 2);
+      memcpy(p + 2, name, len);
+      e->names.len += 2 + len;
+      name_index = e->name_count++;
+    }
+  }
+  char* p = buffer_reserve(&e->out, BINARY_RECORD_SIZE);
+  if (!p) {
+    return;
+  }
+  memset(p, 0, BINARY_RECORD_SIZE);
+  p[0] = (char)kind;
+  put_le(p + 4, (uint32_t)info->pid, 4);
+  put_le(p + 8, kind == KIND_NEW ? (uint32_t)info->ppid : 0, 4);
+  put_le(p + 12, (uint32_t)name_index, 4);
+  put_le(p + 16, kind == KIND_OLD ? (uint64_t)-1 : (uint64_t)info->uss, 8);
+  e->out.len += BINARY_RECORD_SIZE;
+  e->records++;
+}
+
+static void
+put_time(char* p, const struct timeval* t)
+{
+  double d = t->tv_sec + t->tv_usec / 1e6;
+  uint64_t bits;
+  memcpy(&bits, &d, sizeof(bits));
+  put_le(p, bits, 8);
+}
+
+static void
+encoder_finish(proc_encoder* e, const struct timeval* now, const struct timeval* end)
+{
+  if (e->format == PROC_FORMAT_TEXT) {
+    char* p = buffer_reserve(&e->out, 128);
+    if (p) {
+      int n = sprintf(p, "stats|parsed=%u|skipped=%u\nlatency|end=%lu.%06lu|write=",
+                      e->parsed, e->skipped, (unsigned long)end->tv_sec, (unsigned long)end->tv_usec);
+      // the write time is filled in by proc_stamp_write()
+      e->write_at = e->out.len + n;
+      n += sprintf(p + n, "%0*u\n<<<\n", TEXT_TIME_WIDTH, 0);
+      e->out.len += n;
+    }
+  } else {
+    char* p = buffer_reserve(&e->out, e->names.len);
+    if (p) {
+      memcpy(p, e->names.data, e->names.len);
+      e->out.len += e->names.len;
+    }
+    p = e->out.data;
+    memcpy(p, ">>>B", 4);
+    put_le(p + 4, e->out.len - 8, 4);
+    memcpy(p + 8, "PRB3", 4);
+    put_le(p + 12, e->records, 4);
+    put_le(p + 16, e->name_count, 4);
+    put_le(p + 20, e->sync ? BINARY_FLAG_SYNC : 0, 4);
+    put_time(p + 24, now);
+    put_le(p + 32, e->parsed, 4);
+    put_le(p + 36, e->skipped, 4);
+    put_le(p + 40, e->seq, 4);
+    put_le(p + 44, e->stream, 4);
+    put_time(p + 48, end);
+    e->write_at = 56;
+    put_le(p + e->write_at, 0, 8);
+  }
+}
+
+// the block of the last sample, by subscriber id
+static proc_encoder encoders[PROC_MAX_SUBSCRIBERS];
+
+const char*
+proc_get_block(const proc_subscriber* sub, size_t* len)
+{
+  proc_encoder* e = &encoders[sub->id];
+  *len = e->out.len;
+  return e->out.data;
+}
+
+void
+proc_stamp_write(const proc_subscriber* sub)
+{
+  proc_encoder* e = &encoders[sub->id];
+  struct timeval now;
+  gettimeofday(&now, NULL);
+  if (e->format == PROC_FORMAT_TEXT) {
+    char stamp[32];
+    if (!e->write_at || e->write_at + TEXT_TIME_WIDTH > e->out.len) {
+      return;
+    }
+    snprintf(stamp, sizeof(stamp), "%010lu.%06lu", (unsigned long)now.tv_sec, (unsigned long)now.tv_usec);
+    memcpy(e->out.data + e->write_at, stamp, TEXT_TIME_WIDTH);
+  } else if (e->write_at && e->write_at + 8 <= e->out.len) {
+    put_time(e->out.data + e->write_at, &now);
+  }
+}
+
+static int
+is_descendant(const process_info* info, pid_t root)
+{
+  int depth;
+  // parents are usually in the tree already, since they have lower pids
+  for (depth = 0; info && depth < 64; ++depth) {
+    if (info->pid == root || info->ppid == root) {
+      return 1;
+    }
+    if (info->ppid <= 0 || info->ppid == info->pid) {
+      return 0;
+    }
+    rb_red_blk_node* parent = RBExactQuery(processes, (void*)info->ppid);
+    info = parent ? (process_info*)parent->info : NULL;
+  }
+  return 0;
+}
+
+static int
+subscriber_watches(const proc_subscriber* sub, const process_info* info)
+{
+  int i;
+
+  if (!sub->pid_count && !sub->name[0] && !sub->subtree) {
+    return 1;
+  }
+  for (i = 0; i < sub->pid_count; ++i) {
+    if (sub->pids[i] == info->pid) {
+      return 1;
+    }
+  }
+  if (sub->name[0] && info->name && fnmatch(sub->name, info->name, 0) == 0) {
+    return 1;
+  }
+  return sub->subtree && is_descendant(info, sub->subtree);
+}
+
+static void
+subscriber_gone(proc_subscriber* sub, pid_t pid)
+{
+  if (sub->gone_count == sub->gone_cap) {
+    size_t cap = sub->gone_cap ? sub->gone_cap * 2 : 16;
+    pid_t* gone = realloc(sub->gone, cap * sizeof(pid_t));
+    if (!gone) {
+      // it will see the process again in its next snapshot
+      sub->sync = 1;
+      return;
+    }
+    sub->gone = gone;
+    sub->gone_cap = cap;
+  }
+  sub->gone[sub->gone_count++] = pid;
+}
+
+// get the internal name of the process, if it exists
+static const char*
+read_name(pid_t pid)
+{
+  char buf[1024];
+
+  snprintf(buf, sizeof(buf), "/proc/%u/comm", pid);
+  FILE* f = fopen(buf, "r");
+  if (!f) {
+    return NULL;
+  }
+  *buf = '\0';
+  fgets(buf, sizeof(buf), f);
+  fclose(f);
+  size_t len = strlen(buf);
+  if (len && buf[len - 1] == '\n') {
+    // get rid of the newline
+    buf[len - 1] = '\0';
+  }
+  return strdup(buf);
+}
+
+static pid_t
+read_ppid(pid_t pid)
+{
+  char buf[1024];
+  pid_t ppid = 0;
+
+  snprintf(buf, sizeof(buf), "/proc/%u/status", pid);
+  FILE* f = fopen(buf, "r");
+  if (f) {
+    while (fgets(buf, sizeof(buf), f)) {
+      if (sscanf(buf, "PPid: %u", &ppid) == 1) {
+        break;
+      }
+    }
+    fclose(f);
+  }
+  return ppid;
+}
+
+// Encode what 'sub' needs to learn about a live process
+static void
+report(proc_subscriber* sub, process_info* info)
+{
+  proc_encoder* e = &encoders[sub->id];
+  uint32_t bit = 1u << sub->id;
+
+  if (!(info->watchers & bit)) {
+    if (info->announced & bit) {
+      // no longer watched: as far as this subscriber knows, it's gone
+      if (!sub->sync) {
+        encoder_add(e, KIND_OLD, info, NULL);
+      }
+      info->announced &= ~bit;
+    }
+    return;
+  }
+  if (sub->sync || !(info->announced & bit)) {
+    encoder_add(e, KIND_NEW, info, info->name);
+  } else if (info->renamed & bit) {
+    encoder_add(e, KIND_UPDATE, info, info->name);
+  } else if (info->sent_uss[sub->id] != info->uss) {
+    encoder_add(e, KIND_UPDATE, info, NULL);
+  } else {
+    return;
+  }
+  info->announced |= bit;
+  info->renamed &= ~bit;
+  info->sent_uss[sub->id] = info->uss;
+}
+
+void
+proc_set_history(unsigned samples)
+{
+  if (!history) {
+    history_size = samples;
+  }
+}
+
+// a random stream id, so a client can tell a restarted server from the
+// one it was connected to; 0 means none on the wire
+static uint32_t
+new_stream_id(void)
+{
+  uint32_t id = 0;
+  int fd = open("/dev/urandom", O_RDONLY);
+  if (fd >= 0) {
+    if (read(fd, &id, sizeof(id)) != sizeof(id)) {
+      id = 0;
+    }
+    close(fd);
+  }
+  if (!id) {
+    struct timeval now;
+    gettimeofday(&now, NULL);
+    id = (uint32_t)now.tv_sec ^ ((uint32_t)now.tv_usec << 12) ^ (uint32_t)getpid();
+  }
+  return id ? id : 1;
+}
+
+static void
+history_add(history_sample* h, const process_info* info)
+{
+  if (h->count == h->cap) {
+    size_t cap = h->cap ? h->cap * 2 : 256;
+    history_entry* entries = realloc(h->entries, cap * sizeof(history_entry));
+    if (!entries) {
+      return;
+    }
+    h->entries = entries;
+    h->cap = cap;
+  }
+  history_entry* entry = &h->entries[h->count++];
+  entry->pid = info->pid;
+  entry->ppid = info->ppid;
+  entry->uss = info->uss;
+  snprintf(entry->name, sizeof(entry->name), "%s", info->name ? info->name : "");
+}
 
 int
-proc_write_report(int fd, int sync)
+proc_resume(proc_subscriber* sub, uint32_t stream, uint32_t seq)
 {
-  static pid_t max_pid = 0;
+  if (!history || !stream_id || stream != stream_id || sub->blocks ||
+      seq >= sample_seq || sample_seq - seq > history_size) {
+    return -1;
+  }
+  history_sample* h = &history[seq % history_size];
+  if (h->seq != seq) {
+    return -1;
+  }
+
+  uint32_t bit = 1u << sub->id;
+  // forget what an earlier subscriber with this id was told
+  stk_stack* stack = RBEnumerate(processes, (void*)1, (void*)max_pid);
+  rb_red_blk_node* process;
+  while ((process = StackPop(stack))) {
+    process_info* info = (process_info*)process->info;
+    info->announced &= ~bit;
+    info->renamed &= ~bit;
+  }
+  free(stack);
+
+  // the subscriber knows the processes of the sample that it watched then
+  sub->gone_count = 0;
+  size_t i;
+  for (i = 0; i < h->count; ++i) {
+    const history_entry* entry = &h->entries[i];
+    process_info then;
+    bzero(&then, sizeof(then));
+    then.pid = entry->pid;
+    then.ppid = entry->ppid;
+    then.name = entry->name;
+    if (!subscriber_watches(sub, &then)) {
+      continue;
+    }
+    rb_red_blk_node* node = RBExactQuery(processes, (void*)entry->pid);
+    if (!node) {
+      // it died since
+      subscriber_gone(sub, entry->pid);
+      continue;
+    }
+    process_info* info = (process_info*)node->info;
+    info->announced |= bit;
+    info->sent_uss[sub->id] = entry->uss;
+    char name[sizeof(entry->name)];
+    snprintf(name, sizeof(name), "%s", info->name ? info->name : "");
+    if (strcmp(name, entry->name) != 0) {
+      info->renamed |= bit;
+    }
+  }
+  sub->sync = 0;
+  return 0;
+}
+
+int
+proc_sample(proc_subscriber* const* subs, int count)
+{
+  struct timeval now;
+  int i;
 
   if (!processes) {
     processes = RBTreeCreate(tree_key_compare,
@@ -94,13 +784,43 @@ proc_write_report(int fd, int sync)
     if (!processes) {
       return 0;
     }
+    stream_id = new_stream_id();
+  }
+  if (!history && history_size) {
+    history = calloc(history_size, sizeof(history_sample));
+  }
+  uint32_t seq = sample_seq++;
+  history_sample* h = history ? &history[seq % history_size] : NULL;
+  if (h) {
+    h->seq = seq;
+    h->count = 0;
   }
 
-  struct dirent*  ep;     
-  pid_t           b2g_pid = 0;
-  char            buf[1024];
+  struct dirent*  ep;
   DIR*            dp;
-  int             len;
+  process_info    gone;
+  uint32_t        parsed = 0;
+  uint32_t        skipped = 0;
+  struct timespec mono;
+
+  gettimeofday(&now, NULL);
+  clock_gettime(CLOCK_MONOTONIC, &mono);
+  uint64_t sample_ms = mono.tv_sec * 1000ULL + mono.tv_nsec / 1000000;
+  bzero(&gone, sizeof(gone));
+  for (i = 0; i < count; ++i) {
+    proc_subscriber* sub = subs[i];
+    if (sub->due) {
+      encoder_begin(&encoders[sub->id], sub->format, sub->sync, seq, stream_id, &now);
+      sub->blocks++;
+      // processes that died since this subscriber's previous block
+      size_t j;
+      for (j = 0; !sub->sync && j < sub->gone_count; ++j) {
+        gone.pid = sub->gone[j];
+        encoder_add(&encoders[sub->id], KIND_OLD, &gone, NULL);
+      }
+      sub->gone_count = 0;
+    }
+  }
 
   dp = opendir("/proc/");
 
@@ -108,92 +828,86 @@ proc_write_report(int fd, int sync)
     while ((ep = readdir(dp))) {
       pid_t pid;
 
-      if (sscanf(ep->d_name, "%u", &pid) == 1) {
-        TRACE("pid = %u\n", pid);
-        if (pid > max_pid) {
-          max_pid = pid;
+      if (sscanf(ep->d_name, "%u", &pid) != 1) {
+        continue;
+      }
+      TRACE("pid = %u\n", pid);
+      if (pid > max_pid) {
+        max_pid = pid;
+      }
+
+      const char* name = read_name(pid);
+      rb_red_blk_node* process = RBExactQuery(processes, (void*)pid);
+      process_info* info;
+      if (!process) {
+        TRACE();
+        // this process is new, add it to the tree
+        info = calloc(1, sizeof(process_info));
+        if (!info) {
+          free((void*)name);
+          continue;
         }
-        snprintf(buf, sizeof(buf), "/proc/%u/smaps", pid);
-        FILE* f = fopen(buf, "r");
-        if (f) {
-          // calculate USS: the total size of all of the private data held
-          // by this process.
-          uint64_t uss = 0;
-          while (fgets(buf, sizeof(buf), f)) {
-            uint64_t val;
-            if (sscanf(buf, "Private_Dirty: %" PRIu64 " kB", &val) == 1 ||
-                sscanf(buf, "Private_Clean: %" PRIu64 " kB", &val) == 1) {
-              uss += val * 1024UL;
-            }
-          }
-          fclose(f);
-          TRACE("uss = %" PRIu64 "\n", uss);
-
-          // get the internal name of the process, if it exists
-          const char* name = NULL;
-          snprintf(buf, sizeof(buf), "/proc/%u/comm", pid);
-          f = fopen(buf, "r");
-          *buf = '\0';
-          if (f) {
-            fgets(buf, sizeof(buf), f);
-            len = strlen(buf);
-            if (buf[len - 1] == '\n') {
-              // get rid of the newline
-              buf[len - 1] = '\0';
-            }
-            name = strdup(buf);
-            fclose(f);
-          }
-          
-          rb_red_blk_node* process = RBExactQuery(processes, (void*)pid);
-          process_info* info;
-          if (!process) {
-            TRACE();
-            // this process is new, add it to the tree
-            info = malloc(sizeof(process_info));
-            info->status = PS_NEW;
-
-            // try to get the new process' parent process ID
-            info->ppid = 0;
-            snprintf(buf, sizeof(buf), "/proc/%u/status", pid);
-            f = fopen(buf, "r");
-            if (f) {
-              while (fgets(buf, sizeof(buf), f)) {
-                if (sscanf(buf, "PPid: %u", &info->ppid) == 1) {
-                  break;
-                }
-              }
-              fclose(f);
-            }
-            TRACE("ppid = %u\n", info->ppid);
-
-            info->pid = pid;
-            info->uss = uss;
-            info->name = name;
-
-            RBTreeInsert(processes, (void*)pid, info);
-          } else {
-            TRACE();
-            // this process already exists, update its record
-            info = (process_info*)process->info;
-            info->status = PS_IDLE;
-
-            if (uss != info->uss) {
-              info->status = PS_UPDATED;
-              info->uss = uss;
-            }
+        info->status = PS_NEW;
+        info->pid = pid;
+        info->ppid = read_ppid(pid);
+        info->name = name;
+        TRACE("ppid = %u\n", info->ppid);
+        process = RBTreeInsert(processes, (void*)pid, info);
+      } else {
+        TRACE();
+        // this process already exists, update its record
+        info = (process_info*)process->info;
+        info->status = PS_IDLE;
+        if (!info->name || !name || strcmp(info->name, name) != 0) {
+          info->renamed = ~0u;
+          free((void*)info->name);
+          info->name = name;
+        } else {
+          free((void*)name);
+        }
+      }
 
-            // this case must appear last
-            if (!info->name || !name || strcmp(info->name, name) != 0) {
-              info->status = PS_RENAMED;
-              free((void*)info->name);
-              info->name = name;
-            } else {
-              free((void*)name);
-            }
-          }
+      info->watchers = 0;
+      for (i = 0; i < count; ++i) {
+        if (subs[i]->due && subscriber_watches(subs[i], info)) {
+          info->watchers |= 1u << subs[i]->id;
         }
       }
+      if (!info->watchers) {
+        // nobody is looking, don't pay for its smaps
+        continue;
+      }
+
+      // if its resident and shared page counts haven't moved, its USS
+      // most likely hasn't either; parse smaps anyway once it's stale
+      unsigned long resident = 0;
+      unsigned long shared = 0;
+      int have_statm = read_statm(pid, &resident, &shared) == 0;
+      if (have_statm && info->parsed_at && sample_ms - info->parsed_at < max_staleness &&
+          resident == info->resident && shared == info->shared) {
+        ++skipped;
+        continue;
+      }
+
+      // calculate USS: the total size of all of the private data held
+      // by this process.
+      uint64_t uss;
+      if (read_uss(pid, collector, &uss) == 0) {
+        TRACE("uss = %" PRIu64 "\n", uss);
+        info->uss = uss;
+        info->resident = resident;
+        info->shared = shared;
+        info->parsed_at = have_statm ? sample_ms : 0;
+        ++parsed;
+      } else if (errno == EACCES) {
+        // not ours to look at, but keep it as an ancestor for subtrees
+        info->watchers = 0;
+      } else if (info->status == PS_NEW) {
+        // it exited while we looked at it
+        RBDelete(processes, process);
+      } else {
+        info->status = PS_UNKNOWN;
+      }
     }
 
     closedir(dp);
@@ -202,54 +916,31 @@ proc_write_report(int fd, int sync)
     rb_red_blk_node* process;
     while ((process = StackPop(stack))) {
       process_info* info = (process_info*)process->info;
-      PROCESS_STATUS status = info->status;
-
-      if (sync) {
-        status = PS_NEW;
-      }
-      len = 0;
-      switch (status) {
-        case PS_UNKNOWN:
-          TRACE();
-          // this record wasn't updated, so this process no longer exists
-          len = snprintf(buf, sizeof(buf), "old|pid=%u\n", info->pid);
-          RBDelete(processes, process);
-          break;
 
-        case PS_NEW:
-          TRACE();
-          if (info->name) {
-            len = snprintf(buf, sizeof(buf), "new|pid=%u|ppid=%u|uss=%u|name=%s\n",
-                           info->pid, info->ppid, info->uss, info->name);
-          } else {
-            len = snprintf(buf, sizeof(buf), "new|pid=%u|ppid=%u|uss=%u\n",
-                           info->pid, info->ppid, info->uss);
+      if (info->status == PS_UNKNOWN) {
+        TRACE();
+        // this record wasn't updated, so this process no longer exists
+        for (i = 0; i < count; ++i) {
+          proc_subscriber* sub = subs[i];
+          if (info->announced & (1u << sub->id)) {
+            if (sub->due && !sub->sync) {
+              encoder_add(&encoders[sub->id], KIND_OLD, info, NULL);
+            } else if (!sub->due) {
+              subscriber_gone(sub, info->pid);
+            }
           }
-          break;
-
-        case PS_UPDATED:
-          TRACE();
-          len = snprintf(buf, sizeof(buf), "update|pid=%u|uss=%u\n",
-                         info->pid, info->uss);
-          break;
-
-        case PS_RENAMED:
-          TRACE();
-          len = snprintf(buf, sizeof(buf), "update|pid=%u|uss=%u|name=%s\n",
-                         info->pid, info->uss, info->name);
-          break;
-
-        case PS_IDLE:
-        default:
-          // nothing to do
-          break;
+        }
+        RBDelete(processes, process);
+        continue;
       }
-      if (len) {
-        if (write(fd, buf, len) < 0) {
-          perror("write()");
-          return -1;
+      for (i = 0; i < count; ++i) {
+        if (subs[i]->due) {
+          report(subs[i], info);
         }
       }
+      if (h && info->watchers) {
+        history_add(h, info);
+      }
       info->status = PS_UNKNOWN; // reset state to unknown
     }
     free(stack);
@@ -257,5 +948,80 @@ proc_write_report(int fd, int sync)
     perror("opendir()");
   }
 
+  TRACE("smaps parsed %u, skipped %u", parsed, skipped);
+  struct timeval end;
+  gettimeofday(&end, NULL);
+  for (i = 0; i < count; ++i) {
+    if (subs[i]->due) {
+      encoders[subs[i]->id].parsed = parsed;
+      encoders[subs[i]->id].skipped = skipped;
+      encoder_finish(&encoders[subs[i]->id], &now, &end);
+    }
+  }
+  return 0;
+}
+
+static const char* collector_names[] = { "sscanf", "smaps", "rollup" };
+
+int
+proc_benchmark_collectors(int rounds)
+{
+  const int count = sizeof(collector_names) / sizeof(collector_names[0]);
+  uint64_t elapsed[count];
+  unsigned processes_read = 0;
+  unsigned mismatches = 0;
+  int round;
+  int c;
+
+  bzero(elapsed, sizeof(elapsed));
+  for (round = 0; round < rounds; ++round) {
+    DIR* dp = opendir("/proc/");
+    if (!dp) {
+      perror("opendir()");
+      return -1;
+    }
+    struct dirent* ep;
+    while ((ep = readdir(dp))) {
+      pid_t pid;
+      if (sscanf(ep->d_name, "%u", &pid) != 1) {
+        continue;
+      }
+      // the collectors take turns on each process, so they see the same
+      // processes in (nearly) the same state
+      uint64_t uss[count];
+      int ok = 1;
+      for (c = 0; c < count; ++c) {
+        struct timespec start;
+        struct timespec end;
+        clock_gettime(CLOCK_MONOTONIC, &start);
+        ok &= read_uss(pid, c, &uss[c]) == 0;
+        clock_gettime(CLOCK_MONOTONIC, &end);
+        elapsed[c] += (end.tv_sec - start.tv_sec) * 1000000000ULL + end.tv_nsec - start.tv_nsec;
+      }
+      if (!ok) {
+        continue;
+      }
+      ++processes_read;
+      for (c = 1; c < count; ++c) {
+        if (uss[c] != uss[0]) {
+          ++mismatches;
+          break;
+        }
+      }
+    }
+    closedir(dp);
+  }
+
+  if (rounds < 1) {
+    rounds = 1;
+  }
+  printf("%u processes, %d rounds\n", processes_read / rounds, rounds);
+  for (c = 0; c < count; ++c) {
+    printf("  %-8s %8" PRIu64 " us per scan of all processes\n",
+           collector_names[c], elapsed[c] / 1000 / rounds);
+  }
+  // a process' memory may change between two reads, so a few differences
+  // are expected on a busy system
+  printf("%u process reads differed between collectors\n", mismatches);
   return 0;
 }
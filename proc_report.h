@@ -1,6 +1,94 @@
 #ifndef __procserver_proc_report_h__
 #define __procserver_proc_report_h__
 
-int proc_write_report(int fd, int sync);
+#include <stddef.h>
+#include <stdint.h>
+#include <sys/types.h>
+
+// wire formats a client can ask for
+typedef enum {
+  PROC_FORMAT_TEXT,   // ">>>\n", one "kind|key=value|..." line per record, "<<<\n"
+  PROC_FORMAT_BINARY  // ">>>B", u32 length, fixed-width records, name table
+} PROC_FORMAT;
+
+// ways of reading a process' USS out of /proc
+typedef enum {
+  PROC_COLLECT_SSCANF,  // fgets() + sscanf() over every line of smaps
+  PROC_COLLECT_SMAPS,   // smaps in one read(), scanned for Private_* lines
+  PROC_COLLECT_ROLLUP   // smaps_rollup where the kernel has it, else SMAPS
+} PROC_COLLECTOR;
+
+#ifndef PROC_DEFAULT_COLLECTOR
+#define PROC_DEFAULT_COLLECTOR PROC_COLLECT_ROLLUP
+#endif
+
+// how long a process' USS may be reused while its statm doesn't change
+#ifndef PROC_DEFAULT_MAX_STALENESS
+#define PROC_DEFAULT_MAX_STALENESS 10000  // ms
+#endif
+
+// samples kept for subscribers resuming a lost connection
+#ifndef PROC_DEFAULT_HISTORY
+#define PROC_DEFAULT_HISTORY 64
+#endif
+
+#define PROC_MAX_SUBSCRIBERS  16
+#define PROC_MAX_FILTER_PIDS  64
+
+// One client's view of the processes.  A process is reported to the
+// subscriber if it matches any of the filters, or if no filter is set.
+typedef struct {
+  int           id;         // 0..PROC_MAX_SUBSCRIBERS-1, unique among subscribers
+  PROC_FORMAT   format;
+  int           sync;       // the next block must be a snapshot
+  int           due;        // set by the caller: encode a block this sample
+  unsigned      blocks;     // blocks encoded for this subscriber so far
+
+  pid_t         pids[PROC_MAX_FILTER_PIDS];
+  int           pid_count;
+  char          name[64];   // fnmatch() pattern for the process name
+  pid_t         subtree;    // this process and all of its descendants
+
+  pid_t*        gone;       // processes that died since the last block
+  size_t        gone_count;
+  size_t        gone_cap;
+} proc_subscriber;
+
+// Sample every process watched by a due subscriber once, then encode a
+// block for each due subscriber: the changes since its previous block, or
+// every watched process as 'new' if it needs a snapshot.  Processes nobody
+// watches are not read beyond their name and parent.
+//
+// Samples are numbered within a stream, the life of this server, which
+// has a random non-zero id; every block carries both.
+int proc_sample(proc_subscriber* const* subs, int count);
+
+// Carry on from sample 'seq' of 'stream' for a subscriber that is the
+// client of an earlier connection, so its next block holds only what
+// changed since then.  Call it before the subscriber's first block, with
+// its filters set.  Returns -1 if that sample is no longer kept; the next
+// block is a snapshot then.
+int proc_resume(proc_subscriber* sub, uint32_t stream, uint32_t seq);
+
+// how many of the latest samples proc_resume() can carry on from; call
+// it before the first sample
+void proc_set_history(unsigned samples);
+
+// The block encoded for 'sub' by the last proc_sample(); valid until the
+// next one.
+const char* proc_get_block(const proc_subscriber* sub, size_t* len);
+
+// Set the write time carried by 'sub's block to now; call it just before
+// the block is handed to the socket.
+void proc_stamp_write(const proc_subscriber* sub);
+
+void proc_set_collector(PROC_COLLECTOR collector);
+
+// 0 re-reads every watched process' smaps on every sample
+void proc_set_max_staleness(unsigned ms);
+
+// time 'rounds' scans of every process' USS with each collector and print
+// the results; returns non-zero if /proc can't be read
+int proc_benchmark_collectors(int rounds);
 
 #endif // __procserver_proc_report_h__
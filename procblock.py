@@ -0,0 +1,308 @@
+""" Columnar decoding of procserver report blocks.
+
+A block is decoded once, on the socket thread, into a ReportBatch: a set of
+parallel typed arrays (one entry per report line) plus indices into a
+NameTable shared by every batch from the same connection.  Consumers never
+see per-line objects or dicts, and never re-parse numbers.
+
+Blocks come in two encodings: text report lines, or the binary payload of
+a '>>>B' frame (see decode_binary()), which decodes with a single
+numpy.frombuffer() over fixed-width records.  numpy is imported only when
+a binary block is decoded or encoded, so importing this module (as the
+recorder does) doesn't load it.
+"""
+import re
+import struct
+from array import array
+
+KIND_NEW = 0
+KIND_UPDATE = 1
+KIND_OLD = 2
+
+KINDS = { "new": KIND_NEW, "update": KIND_UPDATE, "old": KIND_OLD }
+KIND_NAMES = ("new", "update", "old")
+
+NO_NAME = -1   # name index of a record that carries no name
+NO_USS = -1.0  # uss of a record that carries no uss ('old')
+
+# ReportBatch attributes that time a block's way to the screen
+TIMINGS = ("seq", "server_end", "server_write", "receive_time", "decode_time",
+           "queue_time", "dispatch_time", "draw_time")
+
+class NameTable:
+  """ Append-only table of interned process names
+
+  Indices are stable for the lifetime of the table, so batches may be
+  decoded on one thread and resolved on another.
+  """
+
+  def __init__(self):
+    self.names = []
+    self.index = {}
+
+  def intern(self, name):
+    i = self.index.get(name)
+    if i is None:
+      i = len(self.names)
+      self.names.append(name)
+      self.index[name] = i
+    return i
+
+  def get(self, i):
+    if i < 0:
+      return None
+    return self.names[i]
+
+class ReportBatch:
+  """ One decoded report block, stored column-wise """
+
+  def __init__(self, names):
+    self.names = names          # NameTable the name column refers to
+    self.kind = array('b')      # KIND_*
+    self.pid = array('i')
+    self.ppid = array('i')      # 0 if not reported
+    self.uss = array('d')       # bytes, NO_USS if not reported
+    self.name = array('i')      # index into self.names, NO_NAME if none
+    self.server_time = None     # server wall clock time of the sample
+    self.sync = False           # a snapshot of every live process
+    self.parsed = None          # processes whose smaps the server read
+    self.skipped = None         # processes it skipped as unchanged
+    self.blocks = 1             # report blocks merged into this batch
+    # the way of the block from the server to the screen, as wall clock
+    # times; None where not known.  server_time is when the sample started.
+    self.seq = None             # the number of the block's sample in its stream
+    self.server_end = None      # server: the sample was encoded
+    self.server_write = None    # server: the block was handed to the socket
+    self.receive_time = None    # client: the block's last byte was read
+    self.decode_time = None     # client: the block was decoded
+    self.queue_time = None      # client: the batch was queued for the GUI
+    self.dispatch_time = None   # client: the GUI thread picked the batch up
+    self.draw_time = None       # client: the GUI thread finished drawing it
+    self.source = None          # thread that produced the batch
+    self.device = None          # device id, when multiplexing connections
+    self.stream = None          # the server's id for the samples 'seq' counts
+
+  def __len__(self):
+    return len(self.kind)
+
+  def add(self, kind, pid, ppid = 0, uss = NO_USS, name = NO_NAME):
+    self.kind.append(kind)
+    self.pid.append(pid)
+    self.ppid.append(ppid)
+    self.uss.append(uss)
+    self.name.append(name)
+
+  def records(self):
+    """ Iterate over (kind, pid, ppid, uss, name) tuples, name resolved """
+    names = self.names.names
+    for i in xrange(len(self.kind)):
+      n = self.name[i]
+      yield (self.kind[i], self.pid[i], self.ppid[i], self.uss[i],
+             names[n] if n >= 0 else None)
+
+  def dump(self):
+    for kind, pid, ppid, uss, name in self.records():
+      print "%s: pid=%u ppid=%u uss=%.0f name=%s" % (KIND_NAMES[kind], pid, ppid, uss, name)
+
+def merge_snapshot(batch, live):
+  """ Rewrite snapshot 'batch' as the changes to a consumer's state
+
+  'live' holds the PIDs the consumer believes are alive.  A server sends
+  a snapshot (every live process as 'new') to a client that connects, or
+  that fell behind and had blocks dropped; records for processes already
+  known become updates and known processes missing from the snapshot
+  become 'old', so applying the result never duplicates a process.
+  """
+  merged = ReportBatch(batch.names)
+  merged.server_time = batch.server_time
+  merged.source = batch.source
+  merged.device = batch.device
+  merged.stream = batch.stream
+  merged.blocks = batch.blocks
+  for key in TIMINGS:
+    setattr(merged, key, getattr(batch, key))
+  seen = set()
+  for kind, pid, ppid, uss, name in zip(batch.kind, batch.pid, batch.ppid, batch.uss, batch.name):
+    seen.add(pid)
+    if kind == KIND_NEW and pid in live:
+      kind = KIND_UPDATE
+    merged.add(kind, pid, ppid, uss, name)
+  for pid in live:
+    if pid not in seen:
+      merged.add(KIND_OLD, pid)
+  return merged
+
+# one report line: kind, then pid and the optional ppid/uss/name fields in
+# the order procserver writes them; the name is last and may contain anything
+LINE = re.compile(r'^(new|update|old)\|pid=(\d+)(?:\|ppid=(\d+))?(?:\|uss=(\d+))?(?:\|name=(.*))?$', re.M)
+
+# block metadata from the server; older servers don't send it
+TIME = re.compile(r'^time\|(.*)$', re.M)
+STATS = re.compile(r'^stats\|parsed=(\d+)\|skipped=(\d+)$', re.M)
+LATENCY = re.compile(r'^latency\|end=([\d.]+)\|write=([\d.]+)$', re.M)
+
+# binary payload: header, records, then one '<H' length + bytes per name
+BINARY_MAGIC = b'PRB3'
+BINARY_HEADER = struct.Struct('<4sIIIdIIIIdd') # magic, records, names, flags, time, parsed, skipped,
+                                               # seq, stream, end, write
+BINARY_MAGIC_V2 = b'PRB2'
+BINARY_HEADER_V2 = struct.Struct('<4sIIIdII')  # without seq, end, write
+BINARY_MAGIC_V1 = b'PRB1'
+BINARY_HEADER_V1 = struct.Struct('<4sIIId') # without parsed, skipped
+BINARY_FLAG_SYNC = 1
+# numpy dtype of a binary record, and its size ('<B3xiiiq')
+BINARY_RECORD = [('kind', 'u1'), ('pad', 'V3'), ('pid', '<i4'), ('ppid', '<i4'),
+                 ('name', '<i4'), ('uss', '<i8')]
+BINARY_RECORD_SIZE = struct.calcsize('<B3xiiiq')
+NAME_LENGTH = struct.Struct('<H')
+
+# numpy type of each ReportBatch column's array typecode
+DTYPES = { 'b': 'i1', 'i': 'i4', 'd': 'f8' }
+
+def column(values, typecode):
+  """ Copy a numpy column into a native array of 'typecode' """
+  a = array(typecode)
+  a.fromstring(values.astype(DTYPES[typecode]).tostring())
+  return a
+
+def decode_binary(block, names):
+  """ Decode the payload of a binary report frame into a ReportBatch
+
+  Records are '<B3xiiiq' (kind, pid, ppid, name, uss); 'name' indexes the
+  names that follow the records, -1 for none, and 'uss' is -1 when not
+  reported, which is NO_USS once converted.
+  """
+  batch = ReportBatch(names)
+  if block.startswith(BINARY_MAGIC_V1):
+    header = BINARY_HEADER_V1
+    magic, n, count, flags, t = header.unpack_from(block)
+  elif block.startswith(BINARY_MAGIC_V2):
+    header = BINARY_HEADER_V2
+    magic, n, count, flags, t, batch.parsed, batch.skipped = header.unpack_from(block)
+  else:
+    header = BINARY_HEADER
+    magic, n, count, flags, t, batch.parsed, batch.skipped, batch.seq, stream, \
+      end, write = header.unpack_from(block)
+    # 0 if the server didn't stamp them
+    batch.stream = stream or None
+    batch.server_end = end or None
+    batch.server_write = write or None
+  batch.server_time = t
+  batch.sync = bool(flags & BINARY_FLAG_SYNC)
+  pos = header.size + n * BINARY_RECORD_SIZE
+  local = []
+  for i in xrange(count):
+    length, = NAME_LENGTH.unpack_from(block, pos)
+    pos += NAME_LENGTH.size
+    local.append(names.intern(block[pos:pos + length]))
+    pos += length
+  if n:
+    import numpy as np
+    records = np.frombuffer(block, BINARY_RECORD, n, header.size)
+    batch.kind = column(records['kind'], 'b')
+    batch.pid = column(records['pid'], 'i')
+    batch.ppid = column(records['ppid'], 'i')
+    batch.uss = column(records['uss'], 'd')
+    ids = records['name']
+    if local:
+      ids = np.where(ids >= 0, np.take(np.array(local), ids.clip(0, len(local) - 1)), NO_NAME)
+    batch.name = column(ids, 'i')
+  return batch
+
+def decode_block(block, names):
+  """ Decode the body of a report block into a ReportBatch
+
+  'names' is the connection's NameTable.  Binary payloads are handed to
+  decode_binary().  For text, the whole block is matched in one pass and
+  each column is converted in bulk; lines that are not report lines are
+  ignored.
+  """
+  if block[:4] in (BINARY_MAGIC, BINARY_MAGIC_V2, BINARY_MAGIC_V1):
+    return decode_binary(block, names)
+  batch = ReportBatch(names)
+  m = TIME.search(block)
+  if m:
+    for field in m.group(1).split("|"):
+      key, sep, value = field.partition("=")
+      if key == "real":
+        batch.server_time = float(value)
+      elif key == "sync":
+        batch.sync = value == "1"
+      elif key == "seq":
+        batch.seq = int(value)
+      elif key == "stream":
+        batch.stream = int(value)
+  m = STATS.search(block)
+  if m:
+    batch.parsed = int(m.group(1))
+    batch.skipped = int(m.group(2))
+  m = LATENCY.search(block)
+  if m:
+    batch.server_end = float(m.group(1))
+    batch.server_write = float(m.group(2)) or None
+  rows = LINE.findall(block)
+  if rows:
+    kinds, pids, ppids, usss, name_strs = zip(*rows)
+    intern = names.intern
+    batch.kind = array('b', map(KINDS.__getitem__, kinds))
+    batch.pid = array('i', map(int, pids))
+    batch.ppid = array('i', [int(p) if p else 0 for p in ppids])
+    batch.uss = array('d', [float(u) if u else NO_USS for u in usss])
+    batch.name = array('i', [intern(n) if n else NO_NAME for n in name_strs])
+  return batch
+
+def encode_text(batch):
+  """ Frame 'batch' as a text block, the way procserver writes it """
+  lines = [b'>>>']
+  if batch.server_time is not None:
+    seq = b'|seq=%u' % batch.seq if batch.seq is not None else b''
+    if batch.stream is not None:
+      seq += b'|stream=%u' % batch.stream
+    lines.append(b'time|real=%.6f%s%s' % (batch.server_time, seq, b'|sync=1' if batch.sync else b''))
+  names = batch.names.names
+  for kind, pid, ppid, uss, name in zip(batch.kind, batch.pid, batch.ppid, batch.uss, batch.name):
+    if kind == KIND_NEW:
+      line = b'new|pid=%u|ppid=%u|uss=%u' % (pid, ppid, uss)
+    elif kind == KIND_UPDATE:
+      line = b'update|pid=%u|uss=%u' % (pid, uss)
+    else:
+      line = b'old|pid=%u' % pid
+    if name >= 0 and kind != KIND_OLD:
+      line += b'|name=' + names[name]
+    lines.append(line)
+  if batch.parsed is not None:
+    lines.append(b'stats|parsed=%u|skipped=%u' % (batch.parsed, batch.skipped))
+  if batch.server_end is not None:
+    lines.append(b'latency|end=%.6f|write=%.6f' % (batch.server_end, batch.server_write or 0.0))
+  lines.append(b'<<<\n')
+  return b'\n'.join(lines)
+
+def encode_binary(batch):
+  """ Frame 'batch' as a binary block, the way procserver writes it """
+  import numpy as np
+  n = len(batch)
+  records = np.zeros(n, BINARY_RECORD)
+  records['kind'] = np.frombuffer(batch.kind, np.int8)
+  records['pid'] = np.frombuffer(batch.pid, np.int32)
+  records['ppid'] = np.frombuffer(batch.ppid, np.int32)
+  records['uss'] = np.frombuffer(batch.uss)
+  table = batch.names.names
+  local = {}
+  names = []
+  ids = records['name']
+  for i, name in enumerate(batch.name):
+    if name < 0:
+      ids[i] = NO_NAME
+      continue
+    j = local.get(name)
+    if j is None:
+      j = local[name] = len(names)
+      names.append(NAME_LENGTH.pack(len(table[name])) + table[name])
+    ids[i] = j
+  flags = BINARY_FLAG_SYNC if batch.sync else 0
+  payload = [BINARY_HEADER.pack(BINARY_MAGIC, n, len(names), flags, batch.server_time or 0.0,
+                                batch.parsed or 0, batch.skipped or 0, batch.seq or 0, batch.stream or 0,
+                                batch.server_end or 0.0, batch.server_write or 0.0),
+             records.tostring()] + names
+  payload = b''.join(payload)
+  return b'>>>B' + struct.pack('<I', len(payload)) + payload
@@ -2,46 +2,25 @@
 import re
 import wx
 import os
-from socket import *
+import time
 
 import matplotlib
 matplotlib.use('WXAgg')
 
-from threading import Thread
+from threading import Thread, Lock
+from procstream import Connection, DEFAULT_RECV_SIZE, add_subscription_arguments, subscription_requests
+from procplot import ProcPlot, aggregate_spec
+from procsession import SessionPlayer, SessionReader
+from procqueue import BatchQueue
+from proclatency import LatencyStats
+from procleak import add_leak_arguments, leak_settings
+from procsegments import SegmentWriter
+from procexport import Exporter, open_writer, export_session
 from wx.lib.pubsub import Publisher
 from matplotlib.figure import Figure
-import pylab
 from matplotlib.backends.backend_wxagg import \
     FigureCanvasWxAgg as FigCanvas, \
     NavigationToolbar2WxAgg as NavigationToolbar
-import numpy as np
-from matplotlib.lines import Line2D
-
-class MessageSet:
-  def __init__(self):
-    self.messages = []
-  def add(self, payload):
-    self.messages.append(payload)
-  def dump(self):
-    for message in self.messages:
-      message.dump()
-
-class Message:
-  def __init__(self, type, fields):
-    self.type = type
-    self.payload = {}
-    for field in fields:
-      kv = field.split("=")
-      # we don't handle the 'name' key properly yet
-      if len(kv) == 2:
-        self.payload[kv[0]] = kv[1]
-      elif 'name' in self.payload:
-        self.payload['name'] = self.payload['name'] + " " + kv[0]
-    # self.dump()
-  def dump(self):
-    print "type: %s" % self.type
-    for key in self.payload:
-      print "   %s = %s" % (key, self.payload[key])
 
 class ConnectionStatus:
   def __init__(self, text):
@@ -53,98 +32,182 @@ class ConnectionStatus:
 class SocketThread(Thread):
   """ Socket worker thread, so we don't block the UI """
 
-  def __init__(self, host, port):
-    """ Initialize socket thread class """
+  def __init__(self, host, port, recv_size = DEFAULT_RECV_SIZE, binary = True, requests = (), store = None):
+    """ Initialize socket thread class
+
+    'requests' are sent to the server after connecting, e.g. to set the
+    sampling interval or filter the processes reported.  A lost connection
+    is made again and resumed, see procstream.Connection.  Every block is
+    also written to SegmentWriter 'store', if given, here rather than on
+    the GUI thread; it's closed when the thread ends.  So is the Exporter
+    of a live export, see start_export().
+    """
     Thread.__init__(self)
-    self.stream = ''
-    self.block = {}
-    self.got_sob = False
-    self.got_eob = False
-    self.host = host
-    self.port = port
-    self.keep_going = True
+    self.connection = Connection(host, port, recv_size, binary, requests,
+                                 lambda text: self.post_connection_status(ConnectionStatus(text)))
+    self.store = store
+    self.exporter = None
+    self.export_lock = Lock()   # held while a block is exported and queued
+    self.queue = BatchQueue(self.notify)
     Publisher().subscribe(self.wrap_up, "exit")
     self.start()
 
   def wrap_up(self, msg):
     print ">>> EXIT <<<"
-    self.keep_going = False
+    self.connection.stop()
+
+  def stop(self):
+    self.connection.stop()
+
+  def start_export(self, exporter, processes):
+    """ Write every block from now on to Exporter 'exporter' as well, until
+    stop_export()
+
+    'processes' are the live processes as the GUI knows them (see
+    Exporter.begin()).  The exporter starts from them and the block still
+    queued for the GUI, if any, so it misses nothing in between.
+    """
+    with self.export_lock:
+      exporter.begin(processes)
+      pending = self.queue.peek()
+      if pending is not None:
+        exporter.apply(pending)
+      self.exporter = exporter
+
+  def stop_export(self):
+    """ Close the live export; its Exporter, None if there was none """
+    with self.export_lock:
+      exporter = self.exporter
+      self.exporter = None
+    if exporter is not None:
+      exporter.close()
+    return exporter
+
+  def export(self, batch):
+    try:
+      self.exporter.apply(batch)
+    except (IOError, OSError), e:
+      exporter = self.exporter
+      self.exporter = None
+      try:
+        exporter.close()
+      except (IOError, OSError):
+        # what it still held can't be written either; the file is closed
+        pass
+      self.post_connection_status(ConnectionStatus("Export to %s failed: %s" % (exporter.writer.path, e)))
 
   def run(self):
     """ Run socket thread """
-    client = socket(AF_INET, SOCK_STREAM)
-    hostport = "%s:%d" % (self.host, self.port)
-    self.post_connection_status(ConnectionStatus("Connecting to %s..." % hostport))
-    rv = client.connect_ex((self.host, self.port))
-    if rv != 0:
-      self.post_connection_status(ConnectionStatus("Connection to %s failed (%s)" % (hostport, os.strerror(rv))))
-      return False
-    self.post_connection_status(ConnectionStatus("Connected to %s" % hostport))
-
-    while self.keep_going:
-      chunk = client.recv(1024)
-      self.stream = self.stream + chunk
-      lines = self.stream.splitlines(1)
-      self.stream = ''
-      for line in lines:
-        if line.endswith('\n'):
-          line = line.rstrip()
-          if line == '>>>':
-            """ Beginning of block marker """
-            self.got_sob = True
-            self.block = MessageSet()
-          elif line == '<<<':
-            """ End of block marker """
-            self.post_data(self.block)
-            self.block = MessageSet()
-            self.got_eob = True
-          elif self.got_sob:
-            """ Handle info lines """
-            # print line
-            fields = line.split("|")
-            handlers = { "new": self.handle_new,
-                         "update": self.handle_update,
-                         "old": self.handle_old }
-            if fields[0] in handlers:
-              self.block.add(handlers[fields[0]](fields[1:]))
-        else:
-          """ This should always be the last line """
-          self.stream = line
-    socket.close(client)
-    self.post_connection_status(ConnectionStatus("Connection to %s closed" % hostport))
-
-  def handle_new(self, fields):
-    return Message("new", fields)
-
-  def handle_update(self, fields):
-    return Message("update", fields)
-
-  def handle_old(self, fields):
-    return Message("old", fields)
+    for batch in self.connection.batches():
+      if self.store is not None:
+        self.store.apply(batch)
+      with self.export_lock:
+        if self.exporter is not None:
+          self.export(batch)
+        self.post_data(batch)
+    if self.store is not None:
+      self.store.close()
+    exporter = self.stop_export()
+    if exporter is not None:
+      self.post_connection_status(ConnectionStatus("Exported %u rows to %s" % (exporter.rows, exporter.writer.path)))
+
+  def post_data(self, data):
+    data.source = self
+    self.queue.put(data)
+
+  def notify(self):
+    wx.CallAfter(Publisher().sendMessage, "update", self.queue)
+
+  def post_connection_status(self, data):
+    wx.CallAfter(Publisher().sendMessage, "connection", data)
+
+class ReplayThread(SessionPlayer):
+  """ Replay a recorded session through the same path as SocketThread """
+
+  def __init__(self, path, speed = 1.0, start = None):
+    """ 'start' is in seconds from the beginning of the session """
+    SessionPlayer.__init__(self, path, speed)
+    if start is not None and len(self.reader):
+      self.start_time = self.reader.start_time() + start
+    self.name = os.path.basename(path)
+    self.queue = BatchQueue(self.notify)
+    Publisher().subscribe(self.wrap_up, "exit")
+    rate = "%gx" % speed if speed > 0 else "full speed"
+    self.post_connection_status(ConnectionStatus("Replaying %s at %s" % (self.name, rate)))
+    self.start()
+
+  def wrap_up(self, msg):
+    self.stop()
 
   def post_data(self, data):
-    wx.CallAfter(Publisher().sendMessage, "update", data)
+    data.source = self
+    self.queue.put(data)
+
+  def notify(self):
+    wx.CallAfter(Publisher().sendMessage, "update", self.queue)
+
+  def finished(self):
+    self.post_connection_status(ConnectionStatus("Replay of %s finished" % self.name))
 
   def post_connection_status(self, data):
     wx.CallAfter(Publisher().sendMessage, "connection", data)
 
-class GraphFrame(wx.Frame):
+class ExportThread(Thread):
+  """ Export a recorded session in the background, see procexport """
+
+  def __init__(self, session, path, format, subtrees = (), on_done = None):
+    Thread.__init__(self)
+    self.daemon = True
+    self.session = session
+    self.path = path
+    self.format = format
+    self.subtrees = subtrees
+    self.on_done = on_done
+    self.start()
+
+  def run(self):
+    try:
+      reader = SessionReader(self.session)
+      try:
+        exporter = Exporter(open_writer(self.path, self.format), subtrees = self.subtrees)
+        export_session(reader, exporter)
+      finally:
+        reader.close()
+      message = "Exported %u rows to %s" % (exporter.rows, self.path)
+    except Exception, e:
+      # nobody else would hear of it on this thread
+      message = "Export to %s failed: %s" % (self.path, e)
+    if self.on_done:
+      wx.CallAfter(self.on_done, message)
+
+EXPORT_LABEL = "Export &data..."
+STOP_EXPORT_LABEL = "Stop &data export"
+
+class GraphFrame(wx.Frame, ProcPlot):
   """ The main frame of the application
   """
   title = 'Firefox OS per-process USS'
   host = 'localhost'
   port = 26600
 
-  def __init__(self):
+  def __init__(self, replay = None, speed = 1.0, start = None, host = None, port = None, requests = (),
+               aggregates = (), leaks = None, retention = None, store = None):
+    """ Show a live procserver, or replay the session file 'replay'
+
+    'aggregates' are subtrees to plot the total USS of, see add_aggregate().
+    'leaks' are the LeakDetector settings to flag leaking processes with.
+    Dead processes are forgotten 'retention' seconds after their death.
+    A live procserver's blocks are also written to the segment store in
+    directory 'store', if given.
+    """
     # first we need to call the base class initializer
     wx.Frame.__init__(self, None, -1, self.title)
+    if host:
+      self.host = host
+    if port:
+      self.port = port
 
-    # the following dictionaries are keyed by PID
-    self.data = {}        # all of the data to be plotted
-    self.plot_starts = {} # process-started markers
-    self.plot_stops = {}  # process-stopped/killed markers
-    self.plot_data = {}   # record of existing plots
-    self.x = 0
+    self.latency = LatencyStats()
 
     self.create_menu()
     self.create_status_bar()
@@ -153,25 +216,9 @@ class GraphFrame(wx.Frame):
 
     self.dpi = 100
     self.fig = Figure((3.0, 3.0), dpi = self.dpi)
-    axes = self.fig.add_subplot(111)
-
-    #
-    box = axes.get_position()
-    axes.set_position([box.x0, box.y0, box.width * 0.9, box.height])
-    # self.axes.legend(loc = 'center left', fontsize = 8, bbox_to_anchor = (1, 0.5))
-    # self.axes.set_axis_bgcolor('black')
-
-    axes.grid(True, color = 'gray')
-    axes.set_xlabel('Time (seconds)')
-    axes.set_ylabel('Memory (MB)')
-    axes.set_title('Process USS (MB) vs Time (seconds)', size = 10)
-    pylab.setp(axes.get_xticklabels(), fontsize = 8)
-    pylab.setp(axes.get_yticklabels(), fontsize = 8)
-    pylab.setp(axes.get_xticklabels(), visible = True)
-    self.axes = axes
-
-    self.canvas = FigCanvas(panel, -1, self.fig)
-    self.canvas.callbacks.connect('pick_event', self.on_pick)
+    ProcPlot.__init__(self, self.fig, FigCanvas(panel, -1, self.fig), leaks, retention)
+    for spec in aggregates:
+      self.add_aggregate(spec)
 
     self.vbox = wx.BoxSizer(wx.VERTICAL)
     self.vbox.Add(self.canvas, 1, flag = wx.LEFT | wx.TOP | wx.GROW)
@@ -181,7 +228,12 @@ class GraphFrame(wx.Frame):
     Publisher().subscribe(self.update, "update")
     Publisher().subscribe(self.connection, "connection")
 
-    SocketThread(self.host, self.port)
+    self.replay_speed = speed
+    if replay:
+      self.source = ReplayThread(replay, speed, start)
+    else:
+      self.source = SocketThread(self.host, self.port, requests = requests,
+                                 store = SegmentWriter(store) if store else None)
 
   def create_menu(self):
     self.menubar = wx.MenuBar()
@@ -189,6 +241,14 @@ class GraphFrame(wx.Frame):
     file = wx.Menu()
     save = file.Append(-1, "&Save plot...\tCtrl+S", "Save plot to file")
     self.Bind(wx.EVT_MENU, self.on_file_save, save)
+    latency = file.Append(-1, "Export &latency...", "Save per-stage latency histograms")
+    self.Bind(wx.EVT_MENU, self.on_file_export_latency, latency)
+    self.export_item = file.Append(-1, EXPORT_LABEL,
+                                   "Save the replayed session's samples, or the live ones until stopped, "
+                                   "as CSV or columns")
+    self.Bind(wx.EVT_MENU, self.on_file_export_data, self.export_item)
+    session = file.Append(-1, "&Open session...\tCtrl+O", "Replay a recorded session")
+    self.Bind(wx.EVT_MENU, self.on_file_open_session, session)
     file.AppendSeparator()
     connect = file.Append(-1, "&Connect...\tCtrl+C", "Connection to a procserver")
     connect.Enable(False) # for now
@@ -201,6 +261,15 @@ class GraphFrame(wx.Frame):
     self.Bind(wx.EVT_MENU, self.on_file_exit, exit)
 
     self.menubar.Append(file, "&File")
+
+    view = wx.Menu()
+    blit = view.AppendCheckItem(-1, "&Fast redraw", "Only repaint the lines that changed")
+    blit.Check(True)
+    self.Bind(wx.EVT_MENU, self.on_view_blit, blit)
+    only = view.AppendCheckItem(-1, "&Subtree totals only",
+                                "Hide the processes, show the totals (right-click a process to add its subtree)")
+    self.Bind(wx.EVT_MENU, self.on_view_aggregates_only, only)
+    self.menubar.Append(view, "&View")
     self.SetMenuBar(self.menubar)
 
   def on_file_connect(self, event):
@@ -209,6 +278,19 @@ class GraphFrame(wx.Frame):
   def on_file_disconnect(self, event):
     print "File > Disconnect"
 
+  def on_file_open_session(self, event):
+    dlg = wx.FileDialog(self,
+                        message = "Replay session...",
+                        defaultDir = os.getcwd(),
+                        wildcard = "procserver sessions (*.prs)|*.prs|All files|*",
+                        style = wx.OPEN)
+    if dlg.ShowModal() == wx.ID_OK:
+      self.source.stop()
+      self.export_item.SetItemLabel(EXPORT_LABEL)
+      self.clear_plot()
+      self.latency = LatencyStats()
+      self.source = ReplayThread(dlg.GetPath(), self.replay_speed)
+
   def on_file_save(self, event):
       file_choices = "PNG (*.png)|*.png"
       dlg = wx.FileDialog(self,
@@ -223,12 +305,70 @@ class GraphFrame(wx.Frame):
         self.canvas.print_figure(path, dpi = self.dpi)
         self.flash_help_message("Saved to %s" % path)
 
+  def on_file_export_latency(self, event):
+    dlg = wx.FileDialog(self,
+                        message = "Export latency as...",
+                        defaultDir = os.getcwd(),
+                        defaultFile = "latency.json",
+                        wildcard = "JSON (*.json)|*.json",
+                        style = wx.SAVE)
+    if dlg.ShowModal() == wx.ID_OK:
+      path = dlg.GetPath()
+      self.latency.export(path)
+      self.flash_help_message("Saved to %s" % path)
+
+  def on_file_export_data(self, event):
+    """ Export the session being replayed, or the live blocks from now on
+    until chosen again: only the plotted subtrees if just their totals are
+    shown """
+    live = isinstance(self.source, SocketThread)
+    if live and self.source.exporter is not None:
+      exporter = self.source.stop_export()
+      self.export_item.SetItemLabel(EXPORT_LABEL)
+      if exporter is not None:
+        self.flash_help_message("Exported %u rows to %s" % (exporter.rows, exporter.writer.path))
+      return
+    # an export that failed has stopped by itself
+    self.export_item.SetItemLabel(EXPORT_LABEL)
+    dlg = wx.FileDialog(self,
+                        message = "Export data as...",
+                        defaultDir = os.getcwd(),
+                        defaultFile = "uss.csv",
+                        wildcard = "CSV (*.csv)|*.csv|Column files (*.cols)|*.cols",
+                        style = wx.SAVE)
+    if dlg.ShowModal() != wx.ID_OK:
+      return
+    path = dlg.GetPath()
+    format = "columns" if dlg.GetFilterIndex() == 1 else "csv"
+    subtrees = [a.spec for a in self.aggregates] if self.aggregates_only else ()
+    if not live:
+      ExportThread(self.source.reader.path, path, format, subtrees, self.flash_help_message)
+      return
+    try:
+      exporter = Exporter(open_writer(path, format), subtrees = subtrees)
+    except (IOError, OSError), e:
+      self.flash_help_message("Export to %s failed: %s" % (path, e))
+      return
+    # the plot keeps USS in MB
+    processes = [(n.pid, n.ppid, n.uss * (1024 * 1024), n.name) for n in self.tree.nodes.itervalues()]
+    self.source.start_export(exporter, processes)
+    self.export_item.SetItemLabel(STOP_EXPORT_LABEL)
+    self.flash_help_message("Exporting to %s" % path)
+
   def on_file_exit(self, event):
     self.Destroy()
 
+  def on_view_blit(self, event):
+    self.set_blit(event.IsChecked())
+
+  def on_view_aggregates_only(self, event):
+    self.set_aggregates_only(event.IsChecked())
+
   def create_status_bar(self):
     statusbar = self.CreateStatusBar()
-    statusbar.SetFieldsCount(2)
+    statusbar.SetFieldsCount(5)
+    # the last field holds the latency summary
+    statusbar.SetStatusWidths([-2, -2, -2, -1, -4])
     self.statusbar = statusbar
 
   def flash_help_message(self, help, flash_length_ms = 1500):
@@ -240,130 +380,23 @@ class GraphFrame(wx.Frame):
   def on_help_message_expire(self, event):
     self.statusbar.SetStatusText('', 0)
 
-  def on_pick(self, event):
-    artist = event.artist
-    if hasattr(event, 'ind'):
-      i = event.ind[(len(event.ind) - 1) / 2] # pick the middle value
-      x, y = artist.get_data()
-      x = x[i]
-      y = y[i]
-      print "pick: (%u, %f)" % (x, y)
-      if isinstance(artist, Line2D):
-        if event.mouseevent.button == 1:
-          if artist.get_linewidth() == 1:
-            artist.set_linewidth(3)
-          else:
-            artist.set_linewidth(1)
-        if event.mouseevent.button == 2:
-          axes = artist.get_axes()
-          axes.text(x + 0.5, y + 0.5, "%.3f MB" % y, color = 'black', fontsize = 10)
-          axes.plot(x, y, color = 'white', marker = 's')
-      self.redraw_plot()
-
-  def redraw_plot(self):
-    """ Draw the plot using all current data, settings """
-    xmin = 0
-    # xmax = len(self.data)
-    xmax = self.x * 1.01
-    if xmax < 50:
-      xmax = 50
-    ymin = 0
-    self.axes.set_xbound(lower = xmin, upper = xmax)
-    # self.plot_data[0].set_xdata(np.arange(len(self.data)))
-    ymax = 0
-    need_legend = False
-    for pid in self.data:
-      # self.plot_data[0].set_ydata(np.array(self.data[pid]["uss"]))
-      # print "pid=%u --> xdata.len=%u, ydata.len=%u" % (pid, len(np.arange(self.data[pid]['xmin'], self.data[pid]['xmax'] + 1)), len(np.array(self.data[pid]['uss'])))
-      if pid in self.plot_data:
-        plot = self.plot_data[pid]
-        plot.set_xdata(np.arange(self.data[pid]['xstart'], self.data[pid]['xstart'] + len(self.data[pid]['uss'])))
-        plot.set_ydata(np.array(self.data[pid]['uss']))
-        yussmax = round(max(self.data[pid]['uss']), 0) + 1
-        if yussmax > ymax:
-          ymax = yussmax
-        width = plot.get_linewidth()
-        if width == 1:
-          plot.set_label('')
-        else:
-          need_legend = True
-          plot.set_label('%s (%s)' % (plot.name, plot.pid))
-        if pid in self.plot_starts:
-          self.plot_starts[pid].set_linewidth(width)
-        if pid in self.plot_stops:
-          self.plot_stops[pid].set_linewidth(width)
-      # self.plot(np.array(np.arange(len(self.data)), self.data[pid]["uss"]), label = str(pid))
-    if need_legend:
-      # Apparently setting loc = 'best' causes matplotlib to eat up 100% CPU :(
-      # For now, keep this to the left edge where the oldest data is.
-      # self.legend = self.axes.legend(fontsize = 10, loc = 'center left')
-      self.legend = self.axes.legend(fontsize = 10, loc = 'center left', bbox_to_anchor = (1, 0.5))
-    else:
-      try:
-        self.legend.set_visible(False)
-      except:
-        pass
-    self.axes.set_ybound(lower = ymin, upper = ymax)
-    # print "redraw: (%u, %u)-(%u, %u)" % (xmin, ymin, xmax, ymax)
-    self.canvas.draw()
-
-  def handle_new(self, pid, msg):
-    """ Handle new process """
-    if pid not in self.data:
-      uss = float(msg.payload['uss']) / (1024 * 1024) # megabytes
-      self.data[pid] = { "uss": [uss], "xstart": self.x }
-      plot = self.axes.plot(self.data[pid]['uss'], linewidth = 1, picker = 4)[0]
-      plot.pid = pid
-      if "name" in msg.payload:
-        name = msg.payload['name']
-        plot.name = name
-        print "[new pid %u uss %.3f name '%s']" % (pid, uss, name)
-      else:
-        print "[new pid %u uss %.3f]" % (pid, uss)
-      self.plot_starts[pid] = self.axes.plot(self.x, uss, plot.get_color() + 'o')[0]
-      self.plot_data[pid] = plot
-
-  def handle_update(self, pid, msg):
-    """ Update an existing process, possibly including a rename """
-    if pid in self.data:
-      uss = float(msg.payload['uss']) / (1024 * 1024) # megabytes
-      self.data[pid]['uss'][-1] = uss
-      # print "[update pid %u uss %.3f --> length %u]" % (pid, uss, len(self.data[pid]['uss']))
-      if "name" in msg.payload:
-        print "[pid new name '%s']" % msg.payload['name']
-        self.plot_data[pid].name = msg.payload['name']
-
-  def handle_old(self, pid, msg):
-    """ Handle the death of a process """
-    if pid not in self.plot_stops:
-      # print "[old pid %u]" % pid
-      self.data[pid]['uss'].pop()
-      if pid in self.data:
-        self.plot_stops[pid] = self.axes.plot(self.x - 1, self.data[pid]['uss'][-1], self.plot_data[pid].get_color() + 'x')[0]
-        self.axes.text(self.x - 1, self.data[pid]['uss'][-1], "%s" % self.plot_data[pid].name, color = 'black', fontsize = 10)
-      else:
-        self.plot_stops[pid] = True
-
-  def handle_messages(self, batch):
-    """ Generic process message dispatch """
-    self.x = self.x + 1
-    for pid in self.data:
-      # for now, pre-duplicate all of the last data points
-      if pid not in self.plot_stops:
-        self.data[pid]['uss'].append(self.data[pid]['uss'][-1])
-    for msg in batch.messages:
-      handlers = { "new": self.handle_new,
-                   "update": self.handle_update,
-                   "old": self.handle_old }
-      if "pid" in msg.payload and msg.type in handlers:
-        handlers[msg.type](int(msg.payload['pid']), msg)
-    self.redraw_plot()
-
   def update(self, msg):
     """ Handle 'update' messages """
-    t = msg.data
-    if isinstance(t, MessageSet):
-      self.handle_messages(t)
+    queue = msg.data
+    if isinstance(queue, BatchQueue):
+      # drop anything still queued by a source we've since replaced
+      if queue is self.source.queue:
+        t = queue.take()
+        if t is None:
+          return
+        t.dispatch_time = time.time()
+        self.handle_messages(t)
+        t.draw_time = time.time()
+        self.latency.add(t)
+        self.statusbar.SetStatusText(self.latency.summary(), 4)
+        if t.parsed is not None:
+          self.statusbar.SetStatusText("smaps: %u read, %u unchanged" % (t.parsed, t.skipped), 2)
+        self.statusbar.SetStatusText("%u blocks merged" % queue.merged, 3)
     else:
       print "unhandled update type"
 
@@ -379,8 +412,27 @@ class GraphFrame(wx.Frame):
       print "unhandled connection status message"
 
 if __name__ == '__main__':
+  import argparse
+  ap = argparse.ArgumentParser(description = GraphFrame.title)
+  ap.add_argument("-H", "--host", default = GraphFrame.host)
+  ap.add_argument("-p", "--port", type = int, default = GraphFrame.port)
+  ap.add_argument("--replay", metavar = "SESSION", help = "replay a session recorded by procrecord.py")
+  ap.add_argument("--speed", type = float, default = 1.0, help = "replay speed, 0 for as fast as possible")
+  ap.add_argument("--start", type = float, help = "seconds into the session to start the replay at")
+  ap.add_argument("--aggregate", action = "append", default = [], type = aggregate_spec, metavar = "PID|NAME",
+                  help = "also plot the total USS of this process and its descendants; repeatable")
+  ap.add_argument("--retention", type = int, metavar = "SECONDS",
+                  help = "forget dead processes this long after their death")
+  ap.add_argument("--store", metavar = "DIR",
+                  help = "also write a live procserver's blocks to a segment store here, see procsegments.py")
+  add_leak_arguments(ap)
+  add_subscription_arguments(ap)
+  args = ap.parse_args()
+
   app = wx.PySimpleApp()
-  app.frame = GraphFrame()
+  app.frame = GraphFrame(args.replay, args.speed, args.start, args.host, args.port,
+                         subscription_requests(args), args.aggregate, leak_settings(args), args.retention,
+                         args.store)
   app.frame.Show()
   app.MainLoop()
   Publisher().sendMessage("exit")
@@ -0,0 +1,107 @@
+""" Pixel-aware min/max decimation of USS series.
+
+A canvas a few hundred pixels wide can't show more than a couple of points
+per pixel column, so instead of handing every sample to matplotlib each
+series is reduced to the minimum and maximum of consecutive buckets of
+'factor' samples, where 'factor' is the number of samples per pixel.
+Keeping both extremes means spikes are never hidden.
+
+The reduction is incremental: buckets that are complete never change and
+are computed once, only the trailing partial bucket is recomputed per
+frame, and everything is recomputed only when the factor changes, i.e. on
+zoom, resize, or when the time axis has grown enough to double it.
+"""
+import math
+import numpy as np
+
+def decimation_factor(span, pixels):
+  """ Samples per bucket for 'span' samples across 'pixels' columns
+
+  The factor is rounded down to a power of two so it only changes when the
+  samples-per-pixel ratio crosses one, not on every tick.
+  """
+  if pixels < 1 or span <= pixels:
+    return 1
+  return 1 << int(math.log(span / float(pixels), 2))
+
+class MinMaxDecimator:
+  """ Decimated view of one series of samples
+
+  'series' is the raw sample array; it may be appended to, have its last
+  sample replaced, or have its last sample popped between calls to
+  points().  'xstart' is the x position of the first sample.
+  """
+
+  def __init__(self, series, xstart):
+    self.series = series
+    self.xstart = xstart
+    self.factor = 0       # factor the closed buckets were computed at
+    self.closed = 0       # number of raw samples covered by closed buckets
+    self.n = 0            # number of points produced by closed buckets
+    self.x = np.empty(64)
+    self.y = np.empty(64)
+
+  def reserve(self, n):
+    if n > len(self.x):
+      size = max(n, 2 * len(self.x))
+      x = np.empty(size)
+      y = np.empty(size)
+      x[:self.n] = self.x[:self.n]
+      y[:self.n] = self.y[:self.n]
+      self.x = x
+      self.y = y
+
+  def points(self, factor):
+    """ Return (x, y) arrays of the decimated series at 'factor' """
+    y = np.frombuffer(self.series) if len(self.series) else np.empty(0)
+    if factor != self.factor or len(y) <= self.closed:
+      # zoom/resize, or samples were popped from a closed bucket
+      self.factor = factor
+      self.closed = 0
+      self.n = 0
+
+    # the last sample may still change, so it always stays in the open bucket
+    closed = (len(y) - 1) // factor * factor
+    if closed > self.closed:
+      buckets = y[self.closed:closed].reshape(-1, factor)
+      base = self.xstart + self.closed + np.arange(len(buckets)) * factor
+      if factor == 1:
+        self.append(base, buckets[:, 0])
+      else:
+        rows = np.arange(len(buckets))
+        lo = buckets.argmin(axis = 1)
+        hi = buckets.argmax(axis = 1)
+        first = np.minimum(lo, hi)
+        second = np.maximum(lo, hi)
+        xs = np.empty(2 * len(buckets))
+        ys = np.empty(2 * len(buckets))
+        xs[0::2] = base + first
+        xs[1::2] = base + second
+        ys[0::2] = buckets[rows, first]
+        ys[1::2] = buckets[rows, second]
+        self.append(xs, ys)
+      self.closed = closed
+
+    # the open bucket: its extremes in time order, then the latest sample
+    tail = y[self.closed:]
+    n = self.n
+    self.reserve(n + 3)
+    if len(tail) > 1:
+      lo = tail.argmin()
+      hi = tail.argmax()
+      for i in sorted(set((lo, hi))):
+        if i != len(tail) - 1:
+          self.x[n] = self.xstart + self.closed + i
+          self.y[n] = tail[i]
+          n += 1
+    if len(tail):
+      self.x[n] = self.xstart + self.closed + len(tail) - 1
+      self.y[n] = tail[-1]
+      n += 1
+    return self.x[:n], self.y[:n]
+
+  def append(self, xs, ys):
+    self.reserve(self.n + len(xs) + 3)
+    self.x[self.n:self.n + len(xs)] = xs
+    self.y[self.n:self.n + len(ys)] = ys
+    self.n += len(xs)
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+""" Export USS samples to CSV or to column files, as they stream by.
+
+An Exporter applies report batches one at a time, as SeriesStore does, and
+writes the rows of the selected processes out in chunks of CHUNK rows:
+memory holds the live processes and one chunk, however long the session.
+It reads a session recorded by procrecord.py, or a live procserver until
+--end or ^C.
+
+Rows are (time, pid, ppid, name, uss): the server time in seconds since
+the epoch and USS in bytes, empty (CSV) or NaN (columns) once the process
+is gone.  Either every change of a process is written, starting with its
+state at the start of the range ('changes', the default), or every
+process' USS at every block ('fill'), i.e. the step function a plot shows.
+
+Processes are selected by pid, by fnmatch name pattern, or by subtree:
+a process whose pid, or one of whose ancestors' pids, is given, or whose
+name or an ancestor's name matches the pattern.  No filter selects all.
+
+Formats:
+  csv       one header line, then a line per row
+  columns   a directory of little-endian column files, one value per row,
+            to be read with numpy.fromfile(): time.f8 and uss.f8
+            ('<f8'), pid.i4, ppid.i4 and name.i4 ('<i4', an index into
+            names.txt, -1 for none), plus names.txt, one name per line
+
+This module must not import any GUI code.
+
+usage: procexport.py (--session FILE | -H host [-p port]) -o OUTPUT [--format csv|columns]
+                     [--start S] [--end S] [--pid PID] [--name PATTERN] [--subtree PID|NAME]
+                     [--fill]
+"""
+import os
+import sys
+import csv
+import time
+import fnmatch
+import argparse
+from array import array
+
+from procblock import KIND_NEW, KIND_UPDATE, KIND_OLD, NO_USS, NameTable, merge_snapshot
+from procmux import ConnectionManager
+from procsession import SessionReader, to_le
+from proctree import ProcessTree, MAX_DEPTH, subtree_spec
+
+CHUNK = 4096            # rows written at once
+FORMATS = ("csv", "columns")
+
+class CsvWriter:
+  """ Rows as CSV lines """
+
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, "wb")
+    self.csv = csv.writer(self.file)
+    self.csv.writerow(("time", "pid", "ppid", "name", "uss"))
+
+  def write(self, t, pid, ppid, uss, names):
+    self.csv.writerows(("%.3f" % when, p, pp, n or "", "%.0f" % u if u == u else "")
+                       for when, p, pp, u, n in zip(t, pid, ppid, uss, names))
+
+  def close(self):
+    self.file.close()
+
+class ColumnWriter:
+  """ Rows as column files in directory 'path' """
+
+  COLUMNS = (("time", "f8"), ("pid", "i4"), ("ppid", "i4"), ("uss", "f8"), ("name", "i4"))
+
+  def __init__(self, path):
+    self.path = path
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.files = dict((column, open(os.path.join(path, "%s.%s" % (column, suffix)), "wb"))
+                      for column, suffix in self.COLUMNS)
+    self.names_file = open(os.path.join(path, "names.txt"), "wb")
+    self.names = {}       # name -> index in names.txt
+
+  def write(self, t, pid, ppid, uss, names):
+    index = array('i')
+    for n in names:
+      if n is None:
+        index.append(-1)
+        continue
+      i = self.names.get(n)
+      if i is None:
+        i = self.names[n] = len(self.names)
+        self.names_file.write(n.replace("\n", " ") + "\n")
+      index.append(i)
+    for column, values in (("time", t), ("pid", pid), ("ppid", ppid), ("uss", uss), ("name", index)):
+      self.files[column].write(to_le(values))
+
+  def close(self):
+    for f in self.files.itervalues():
+      f.close()
+    self.names_file.close()
+
+def open_writer(path, format):
+  return ColumnWriter(path) if format == "columns" else CsvWriter(path)
+
+class Exporter:
+  """ Write the rows of the selected processes from 'start' to 'end' (server
+  times, None for no limit) to 'writer' as batches are applied
+
+  'pids', 'names' and 'subtrees' select processes as described above; a
+  subtree is given as for --aggregate, a pid or a name pattern.  With
+  'fill', every selected process gets a row at every block.
+  """
+
+  def __init__(self, writer, start = None, end = None, pids = (), names = (), subtrees = (),
+               fill = False):
+    self.writer = writer
+    self.start = start
+    self.end = end
+    self.pids = set(pids)
+    self.names = list(names)
+    self.subtree_pids = set(s for s in subtrees if isinstance(s, int))
+    self.subtree_names = [s for s in subtrees if not isinstance(s, int)]
+    self.filtered = bool(self.pids or self.names or subtrees)
+    self.fill = fill
+    self.tree = ProcessTree()
+    self.chosen = []          # selected live nodes, by pid
+    self.generation = -1      # tree generation 'chosen' was made at
+    self.started = False      # a block in the range was written
+    self.done = False         # a block past the end was seen
+    self.blocks = 0
+    self.rows = 0
+    self.clear()
+
+  def clear(self):
+    self.t = array('d')
+    self.pid = array('i')
+    self.ppid = array('i')
+    self.uss = array('d')
+    self.name = []
+
+  def row(self, t, node, uss):
+    self.t.append(t)
+    self.pid.append(node.pid)
+    self.ppid.append(node.ppid)
+    self.uss.append(uss)
+    self.name.append(node.name)
+    if len(self.t) >= CHUNK:
+      self.flush()
+
+  def flush(self):
+    if len(self.t):
+      self.writer.write(self.t, self.pid, self.ppid, self.uss, self.name)
+      self.rows += len(self.t)
+      self.clear()
+
+  def selected(self, node):
+    if not self.filtered or node.pid in self.pids:
+      return True
+    name = node.name
+    if name is not None and any(fnmatch.fnmatchcase(name, p) for p in self.names):
+      return True
+    depth = 0
+    while node is not None and depth < MAX_DEPTH:
+      if node.pid in self.subtree_pids:
+        return True
+      if node.name is not None and any(fnmatch.fnmatchcase(node.name, p) for p in self.subtree_names):
+        return True
+      node = node.parent
+      depth += 1
+    return False
+
+  def selected_nodes(self):
+    """ The selected live processes, by pid; looked up again only when a
+    process came, went or was renamed """
+    tree = self.tree
+    if self.generation != tree.generation:
+      self.chosen = [node for pid, node in sorted(tree.nodes.iteritems()) if self.selected(node)]
+      self.generation = tree.generation
+    return self.chosen
+
+  def begin(self, processes):
+    """ Start from the live 'processes', (pid, ppid, uss, name) tuples, for
+    a stream that is already under way; the first batch applied writes
+    their state with its own """
+    for pid, ppid, uss, name in processes:
+      self.tree.add(pid, ppid, uss, name)
+
+  def apply(self, batch, t = None):
+    """ Apply the records of 'batch', at time 't' (by default the block's
+    server time), writing the rows it makes """
+    if t is None:
+      t = batch.server_time if batch.server_time is not None else time.time()
+    if self.end is not None and t > self.end:
+      self.done = True
+    tree = self.tree
+    if batch.sync:
+      batch = merge_snapshot(batch, tree.nodes)
+    # write the changes themselves unless this block starts the range or
+    # fills in every process anyway; deaths are written from then on
+    within = not self.done and (self.start is None or t >= self.start)
+    changes = within and self.started and not self.fill
+    names = batch.names.names
+    for kind, pid, ppid, uss, name in zip(batch.kind, batch.pid, batch.ppid, batch.uss, batch.name):
+      name = names[name] if name >= 0 else None
+      if kind == KIND_NEW:
+        tree.add(pid, ppid, uss, name)
+      elif kind == KIND_UPDATE:
+        node = tree.nodes.get(pid)
+        if node is None:
+          continue
+        tree.update(pid, uss if uss != NO_USS else node.uss, name)
+      elif kind == KIND_OLD:
+        node = tree.nodes.get(pid)
+        if node is None:
+          continue
+        if within and self.started and self.selected(node):
+          self.row(t, node, float('nan'))
+        tree.remove(pid)
+        continue
+      if changes:
+        node = tree.nodes[pid]
+        if self.selected(node):
+          self.row(t, node, node.uss)
+    if within:
+      self.blocks += 1
+      if not self.started or self.fill:
+        for node in self.selected_nodes():
+          self.row(t, node, node.uss)
+      self.started = True
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      self.writer.close()
+
+def export_session(reader, exporter):
+  """ Apply the blocks of SessionReader 'reader' to 'exporter', from its
+  start to its end, then close it """
+  try:
+    for catch_up, batch in reader.batches(NameTable(), exporter.start):
+      exporter.apply(batch)
+      if exporter.done:
+        break
+  finally:
+    exporter.close()
+
+def main():
+  ap = argparse.ArgumentParser(description = "Export USS samples to CSV or column files")
+  ap.add_argument("--session", help = "read a session recorded by procrecord.py")
+  ap.add_argument("-H", "--host", help = "read a live procserver instead")
+  ap.add_argument("-p", "--port", type = int, default = 26600)
+  ap.add_argument("--text", action = "store_true", help = "ask for the text protocol instead of binary")
+  ap.add_argument("-o", "--output", required = True, help = "file (csv) or directory (columns) to write")
+  ap.add_argument("--format", choices = FORMATS, help = "by default columns if OUTPUT ends in .cols, else csv")
+  ap.add_argument("--start", type = float, metavar = "SECONDS",
+                  help = "from this long after the start of the session, or from now when live")
+  ap.add_argument("--end", type = float, metavar = "SECONDS", help = "until this long after it")
+  ap.add_argument("--pid", type = int, action = "append", default = [], help = "export this process; repeatable")
+  ap.add_argument("--name", action = "append", default = [], metavar = "PATTERN",
+                  help = "export the processes with a name matching this pattern; repeatable")
+  ap.add_argument("--subtree", action = "append", default = [], type = subtree_spec, metavar = "PID|NAME",
+                  help = "export this process or the processes with this name, and their descendants; repeatable")
+  ap.add_argument("--fill", action = "store_true",
+                  help = "write every process at every block instead of its changes only")
+  args = ap.parse_args()
+  if bool(args.session) == bool(args.host):
+    ap.error("give one of --session and --host")
+  format = args.format or ("columns" if args.output.endswith(".cols") else "csv")
+
+  reader = None
+  if args.session:
+    reader = SessionReader(args.session)
+    origin = reader.start_time()
+  else:
+    origin = time.time()
+  start = origin + args.start if args.start is not None and origin is not None else None
+  end = origin + args.end if args.end is not None and origin is not None else None
+  exporter = Exporter(open_writer(args.output, format), start, end, args.pid, args.name, args.subtree,
+                      args.fill)
+  try:
+    if reader is not None:
+      export_session(reader, exporter)
+    else:
+      manager = ConnectionManager(binary = not args.text, store = lambda device: exporter)
+      manager.on_status = lambda device, text: sys.stderr.write("%s: %s\n" % (device, text))
+      manager.on_data = lambda batch: exporter.done and manager.stop()
+      manager.add("%s:%d" % (args.host, args.port), args.host, args.port)
+      try:
+        manager.run()
+      finally:
+        exporter.close()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if reader is not None:
+      reader.close()
+  sys.stderr.write("%u rows from %u blocks written to %s\n" % (exporter.rows, exporter.blocks, args.output))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
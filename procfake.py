@@ -0,0 +1,197 @@
+#!/usr/bin/python
+""" A procserver for synthetic processes.
+
+Serves a scripted, reproducible population of made-up processes through
+procserver.py's ProcServer, so clients, recorders and benchmarks can be
+exercised at any load without a device.  Each sample moves the model on by
+one step: processes are born and die at the given rates, a few are renamed,
+a fraction of them change USS and a few may leak, growing every step.
+
+The script is a sequence of phases, each lasting a number of samples and
+changing some of the parameters, e.g.
+
+  procfake.py --processes 150 --phase samples=600,births=5 --phase samples=600,processes=400
+
+and the rate at which blocks are sent is the clients' 'interval|ms=N'.
+
+usage: procfake.py [-p 26600] [--processes N] [--births N] [--deaths N] [--renames N]
+                   [--fraction F] [--leaks N] [--seed N] [--phase key=value,...]...
+"""
+import sys
+import random
+import argparse
+
+from procserver import ProcServer, DEFAULT_PORT, HISTORY
+
+PAGE = 4096
+LEAK_PAGES = 16         # average growth of a leaking process per step
+
+# what a phase may change, and how to parse it
+PARAMETERS = { "processes": int, "births": float, "deaths": float, "renames": float,
+               "fraction": float, "leaks": int }
+
+def occurrences(rng, rate):
+  """ How many times something happening 'rate' times per step on average
+  happens this step """
+  n = int(rate)
+  if rng.random() < rate - n:
+    n += 1
+  return n
+
+class Workload:
+  """ A population of synthetic processes, one step per sample
+
+  'processes' is the population the model tends to: births happen at
+  'births' per step, deaths at 'deaths' per step plus whatever it takes to
+  come back down to 'processes' (deaths defaults to births, i.e. a stable
+  population).  'renames' processes per step change name, and 'fraction'
+  of the live processes change USS every step, but for 'leaks' processes
+  that only ever grow, LEAK_PAGES pages per step on average.
+  """
+
+  def __init__(self, processes = 150, births = 0.0, deaths = None, renames = 0.0,
+               fraction = 0.3, leaks = 0, seed = None):
+    self.processes = processes
+    self.births = births
+    self.deaths = deaths
+    self.renames = renames
+    self.fraction = fraction
+    self.leaks = leaks
+    self.leaking = set()    # pids of the leaking processes
+    self.rng = random.Random(seed)
+    self.live = {}          # pid -> [ppid, uss, name]
+    self.next_pid = 100
+    self.steps = 0
+    for i in xrange(processes):
+      self.spawn()
+
+  def set(self, **parameters):
+    for key, value in parameters.iteritems():
+      if key not in PARAMETERS:
+        raise ValueError("unknown workload parameter '%s'" % key)
+      setattr(self, key, value)
+
+  def spawn(self):
+    pid = self.next_pid
+    self.next_pid += 1
+    rng = self.rng
+    # about half of the processes are children of another synthetic one
+    ppid = 1
+    if self.live and rng.random() < 0.5:
+      ppid = rng.choice(self.live.keys())
+    self.live[pid] = [ppid, rng.randint(256, 16384) * PAGE, "process-%u" % pid]
+
+  def step(self):
+    """ Move on one sample """
+    rng = self.rng
+    live = self.live
+    self.steps += 1
+    deaths = occurrences(rng, self.births if self.deaths is None else self.deaths)
+    deaths += max(0, len(live) - self.processes)
+    for pid in rng.sample(live.keys(), min(deaths, len(live))):
+      del live[pid]
+      self.leaking.discard(pid)
+    births = occurrences(rng, self.births) + max(0, self.processes - len(live))
+    for i in xrange(births):
+      self.spawn()
+    for i in xrange(occurrences(rng, self.renames)):
+      if live:
+        pid = rng.choice(live.keys())
+        live[pid][2] = "renamed-%u-%u" % (pid, self.steps)
+    while len(self.leaking) > self.leaks:
+      self.leaking.pop()
+    if len(self.leaking) < self.leaks:
+      healthy = [pid for pid in live if pid not in self.leaking]
+      self.leaking.update(rng.sample(healthy, min(self.leaks - len(self.leaking), len(healthy))))
+    for pid in self.leaking:
+      live[pid][1] += rng.randint(0, 2 * LEAK_PAGES) * PAGE
+    for pid, info in live.iteritems():
+      if pid in self.leaking:
+        continue
+      if rng.random() < self.fraction:
+        # a random walk, by whole pages, that never goes below one page
+        info[1] = max(PAGE, info[1] + rng.randint(-256, 256) * PAGE)
+
+  def state(self):
+    """ {pid: (ppid, uss, name)}, as procserver.Scanner.scan() returns """
+    return dict((pid, tuple(info)) for pid, info in self.live.iteritems())
+
+def parse_phase(text):
+  """ 'samples=600,births=5' -> (600, {'births': 5.0}) """
+  samples = None
+  parameters = {}
+  for field in text.split(','):
+    key, sep, value = field.partition('=')
+    if key == "samples":
+      samples = int(value)
+    elif key in PARAMETERS:
+      parameters[key] = PARAMETERS[key](value)
+    else:
+      raise ValueError("unknown phase field '%s'" % key)
+  if samples is None:
+    raise ValueError("phase '%s' has no samples=N" % text)
+  return samples, parameters
+
+class FakeScanner:
+  """ Stands in for procserver.Scanner: every scan() is one step of the
+  workload, following the phases of the script """
+
+  def __init__(self, workload, phases = ()):
+    self.workload = workload
+    self.phases = list(phases)
+    self.left = None        # samples left in the current phase
+    self.workers = 0
+
+  def scan(self):
+    if self.phases and not self.left:
+      self.left, parameters = self.phases.pop(0)
+      self.workload.set(**parameters)
+    if self.left:
+      self.left -= 1
+    self.workload.step()
+    return self.workload.state()
+
+  def close(self):
+    pass
+
+def add_workload_arguments(ap):
+  ap.add_argument("--processes", type = int, default = 150)
+  ap.add_argument("--births", type = float, default = 0.0, help = "processes born per sample")
+  ap.add_argument("--deaths", type = float, help = "processes dying per sample (default: as many as are born)")
+  ap.add_argument("--renames", type = float, default = 0.0, help = "processes renamed per sample")
+  ap.add_argument("--fraction", type = float, default = 0.3, help = "fraction of processes changing USS per sample")
+  ap.add_argument("--leaks", type = int, default = 0, help = "processes whose USS keeps growing")
+  ap.add_argument("--seed", type = int, help = "random seed, for reproducible runs")
+
+def workload_from_arguments(args):
+  return Workload(args.processes, args.births, args.deaths, args.renames, args.fraction, args.leaks,
+                  args.seed)
+
+def main():
+  ap = argparse.ArgumentParser(description = "Serve synthetic processes like procserver")
+  ap.add_argument("-p", "--port", type = int, default = DEFAULT_PORT)
+  add_workload_arguments(ap)
+  ap.add_argument("--phase", action = "append", default = [], type = parse_phase, metavar = "key=value,...",
+                  help = "samples=N and the parameters to change for that many samples; repeatable")
+  ap.add_argument("-s", "--slow", choices = ("drop", "disconnect"), default = "drop",
+                  help = "what to do with a client that falls behind")
+  ap.add_argument("-m", "--max-pending", type = int, default = 1024, metavar = "KB",
+                  help = "output a client may have pending before it is behind")
+  ap.add_argument("--history", type = int, default = HISTORY, metavar = "N",
+                  help = "samples kept for clients resuming a lost connection")
+  ap.add_argument("-v", "--verbose", action = "store_true")
+  args = ap.parse_args()
+
+  scanner = FakeScanner(workload_from_arguments(args), args.phase)
+  server = ProcServer(scanner, args.port, args.slow, args.max_pending * 1024, args.verbose, args.history)
+  print "Serving %u synthetic processes on port %d" % (args.processes, args.port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
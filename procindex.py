@@ -0,0 +1,96 @@
+""" Which process is at a point of the USS plot.
+
+SampleIndex answers "which process is nearest (x, y), and what was its USS
+then" for the hover tooltip and clicks, without hit-testing any artist.
+The time axis is cut into buckets of BUCKET steps, each listing the
+processes alive at some point of it; a lookup only looks at the processes
+of one bucket, i.e. the live processes and those born or dead around that
+time, however many have lived.
+
+The index is kept up to date incrementally: a process is listed when it
+is born, and every process still alive when time enters a new bucket is
+listed in that one.  Processes are the entries of ProcPlot.data: dicts
+holding their samples in 'uss', the first of them at time step 'xstart',
+and their MinMaxDecimator in 'decimated'.
+
+This module must not import any GUI code.
+"""
+from itertools import chain
+
+BUCKET = 32             # time steps per bucket
+
+class SampleIndex:
+  """ Processes by the time buckets they were alive in """
+
+  def __init__(self, bucket = BUCKET):
+    self.bucket = bucket
+    self.buckets = {}     # bucket number -> list of entries
+    self.current = 0      # bucket of the latest time step
+
+  def add(self, entry):
+    """ A process was born """
+    self.buckets.setdefault(entry['xstart'] // self.bucket, []).append(entry)
+
+  def advance(self, x, live):
+    """ Time moved on to step 'x'; 'live' are the processes alive before
+    it, i.e. not yet including any born at 'x' """
+    b = x // self.bucket
+    if b > self.current:
+      live = list(live)
+      for i in xrange(self.current + 1, b + 1):
+        self.buckets[i] = list(live)
+      self.current = b
+
+  def remove(self, entries):
+    """ Forget 'entries', a dict of id -> entry """
+    buckets = set()
+    for entry in entries.itervalues():
+      first = entry['xstart'] // self.bucket
+      last = (entry['xstart'] + len(entry['uss'])) // self.bucket
+      buckets.update(xrange(first, last + 1))
+    for b in buckets:
+      listed = self.buckets.get(b)
+      if listed is not None:
+        self.buckets[b] = [e for e in listed if id(e) not in entries]
+
+  def nearest(self, x, y, tolerance, factor = 1, also = ()):
+    """ (entry, time step, USS) of the process whose line passes nearest
+    to (x, y) at time step x, None if none passes within 'tolerance'
+
+    As drawn, decimated by 'factor', a line covers the range of its samples
+    in the decimation bucket around x; the decimator has that range at
+    hand unless the bucket is still open.  'also' are more entries to
+    consider, e.g. for subtree totals.
+    """
+    x = int(round(x))
+    return nearest(chain(self.buckets.get(x // self.bucket, ()), also), x, y, tolerance, factor)
+
+def nearest(entries, x, y, tolerance, factor = 1):
+  """ SampleIndex.nearest() among 'entries' """
+  x = int(round(x))
+  best = None
+  distance = tolerance
+  for entry in entries:
+    series = entry['uss']
+    i = x - entry['xstart']
+    if i < 0 or i >= len(series):
+      continue
+    if factor > 1:
+      j = i // factor
+      decimated = entry['decimated']
+      if decimated.factor == factor and 2 * j + 1 < decimated.n:
+        lo = decimated.y[2 * j]
+        hi = decimated.y[2 * j + 1]
+        if lo > hi:
+          lo, hi = hi, lo
+      else:
+        near = series[j * factor:(j + 1) * factor]
+        lo = min(near)
+        hi = max(near)
+    else:
+      lo = hi = series[i]
+    d = lo - y if y < lo else y - hi if y > hi else 0.0
+    if d <= distance:
+      best = entry, x, series[i]
+      distance = d
+  return best
@@ -0,0 +1,122 @@
+""" Per-stage latency of report blocks, from the server's sample to the screen.
+
+Every block carries the server's timings (see proc_report.c) and the client
+adds its own as the block makes its way to the screen (see ReportBatch).
+Their differences are the stages of the way:
+
+  collect    the server reading /proc            server_end - server_time
+  server     waiting for the server to send it   server_write - server_end
+  transport  the network, above its best         receive_time - server_write - offset
+  parse      framing and decoding                decode_time - receive_time
+  queue      waiting for the GUI thread          dispatch_time - queue_time
+  draw       the GUI thread's work on it         draw_time - dispatch_time
+  total      all of the above                    draw_time - server_time - offset
+
+Server and client clocks are not synchronized, so 'offset' is estimated as
+the smallest receive_time - server_write seen, i.e. the transport of the
+fastest block is taken to be 0; transport is then the delay above that.
+
+Each stage keeps a histogram with logarithmic buckets, so its percentiles
+cost the same to keep over a day as over a minute.
+"""
+import json
+import math
+import time
+from bisect import bisect_left
+
+STAGES = ("collect", "server", "transport", "parse", "queue", "draw", "total")
+
+# bucket upper bounds: 10 us to about 100 s, four buckets per doubling
+BUCKETS = [1e-5 * 2 ** (i / 4.0) for i in xrange(int(4 * math.log(1e7, 2)) + 1)]
+
+class Histogram:
+  """ Counts of durations, in seconds, by logarithmic bucket """
+
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)  # the last one is for overflows
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def add(self, seconds):
+    seconds = max(seconds, 0.0)
+    self.counts[bisect_left(BUCKETS, seconds)] += 1
+    self.count += 1
+    self.sum += seconds
+    self.max = max(self.max, seconds)
+
+  def percentile(self, p):
+    """ Upper bound of the bucket holding the p-th percentile, None if empty """
+    if not self.count:
+      return None
+    rank = p / 100.0 * self.count
+    seen = 0
+    for i, n in enumerate(self.counts):
+      seen += n
+      if n and seen >= rank:
+        return BUCKETS[i] if i < len(BUCKETS) else self.max
+    return self.max
+
+  def mean(self):
+    return self.sum / self.count if self.count else None
+
+class LatencyStats:
+  """ Histograms of every stage, fed one ReportBatch at a time """
+
+  def __init__(self):
+    self.histograms = dict((stage, Histogram()) for stage in STAGES)
+    self.offset = None    # estimated client clock - server clock
+    self.started = time.time()
+
+  def stages(self, batch):
+    """ {stage: seconds} for what 'batch' has timings for """
+    stages = {}
+    if batch.server_time is not None and batch.server_end is not None:
+      stages["collect"] = batch.server_end - batch.server_time
+      if batch.server_write is not None:
+        stages["server"] = batch.server_write - batch.server_end
+    if batch.server_write is not None and batch.receive_time is not None:
+      delay = batch.receive_time - batch.server_write
+      if self.offset is None or delay < self.offset:
+        self.offset = delay
+      stages["transport"] = delay - self.offset
+    if batch.receive_time is not None and batch.decode_time is not None:
+      stages["parse"] = batch.decode_time - batch.receive_time
+    if batch.queue_time is not None and batch.dispatch_time is not None:
+      stages["queue"] = batch.dispatch_time - batch.queue_time
+    if batch.dispatch_time is not None and batch.draw_time is not None:
+      stages["draw"] = batch.draw_time - batch.dispatch_time
+    if self.offset is not None and batch.server_time is not None and batch.draw_time is not None:
+      stages["total"] = batch.draw_time - batch.server_time - self.offset
+    return stages
+
+  def add(self, batch):
+    for stage, seconds in self.stages(batch).iteritems():
+      self.histograms[stage].add(seconds)
+
+  def summary(self, p = 95):
+    """ One line for a status bar: the p-th percentile of each stage, in ms """
+    parts = []
+    for stage in STAGES:
+      value = self.histograms[stage].percentile(p)
+      if value is not None:
+        parts.append("%s %.3g" % (stage, value * 1000))
+    if not parts:
+      return ""
+    return "p%g ms: %s" % (p, ", ".join(parts))
+
+  def results(self):
+    """ Everything, as a dict that serializes to JSON """
+    stages = {}
+    for stage in STAGES:
+      h = self.histograms[stage]
+      stages[stage] = { "count": h.count, "mean": h.mean(), "max": h.max,
+                        "p50": h.percentile(50), "p95": h.percentile(95), "p99": h.percentile(99),
+                        "counts": h.counts }
+    return { "started": self.started, "exported": time.time(), "clock_offset": self.offset,
+             "buckets": BUCKETS, "stages": stages }
+
+  def export(self, path):
+    """ Write results() to 'path' as JSON; times are in seconds """
+    with open(path, "w") as f:
+      json.dump(self.results(), f, indent = 1, sort_keys = True)
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+""" Online leak detection: which processes' USS keeps growing.
+
+Every live process has a LeakEstimator, given one sample per block and
+updated in constant time and space whatever the length of its history:
+
+  - slope: a least-squares fit of USS against time in which older samples
+    weigh exponentially less (time constant 'window'), so it follows the
+    last few windows without keeping any of them;
+  - growth run: for how long USS hasn't fallen more than 'tolerance' below
+    its peak, and how much it rose meanwhile.
+
+A process is flagged as leaking once its slope reaches 'rate' MB per
+minute and its growth run has lasted 'window' seconds, i.e. it grew
+steadily rather than in one step.  It's cleared when the run breaks or the
+slope falls below half of 'rate'.
+
+LeakDetector applies report batches to the estimators of one source as
+SeriesStore does, so it runs in the GUI (see ProcPlot), as the store of a
+ConnectionManager, next to procrecord or on its own:
+
+usage: procleak.py [--leak-rate 0.5] [--leak-window 300] [--session FILE | device...]
+  device: 'name=host:port', 'host:port', ':port' or 'host'
+
+This module must not import any GUI code.
+"""
+import sys
+import math
+import time
+import argparse
+
+from procblock import KIND_NEW, KIND_OLD, NameTable, merge_snapshot
+from procmux import ConnectionManager, parse_device
+from procsession import SessionReader
+from procstream import add_subscription_arguments, subscription_requests
+
+MB = 1024.0 * 1024.0
+
+DEFAULT_RATE = 0.5          # MB per minute
+DEFAULT_WINDOW = 300.0      # seconds
+DEFAULT_TOLERANCE = 1.0     # MB
+
+class LeakEstimator:
+  """ Growth of one process' USS, in MB, from samples at increasing times """
+
+  def __init__(self, pid, name, t, uss):
+    self.pid = pid
+    self.name = name
+    self.t = t              # time of the latest sample
+    self.uss = uss          # the latest sample
+    # weighted means and (co)variance sums, updated as in West (1979)
+    self.weight = 1.0
+    self.mean_t = t
+    self.mean_uss = uss
+    self.stt = 0.0
+    self.stu = 0.0
+    # growth run
+    self.run_start = t
+    self.run_uss = uss      # USS when the run started
+    self.peak = uss
+    self.leaking = False
+
+  def add(self, t, uss, decay, tolerance):
+    """ Add the sample 'uss' at time 't'; 'decay' is exp(-(t - self.t) / window) """
+    if t <= self.t:
+      return
+    self.t = t
+    self.uss = uss
+    self.weight = self.weight * decay + 1.0
+    dt = t - self.mean_t
+    self.mean_t += dt / self.weight
+    self.mean_uss += (uss - self.mean_uss) / self.weight
+    self.stt = self.stt * decay + dt * (t - self.mean_t)
+    self.stu = self.stu * decay + dt * (uss - self.mean_uss)
+    if uss > self.peak:
+      self.peak = uss
+    elif uss < self.peak - tolerance:
+      self.run_start = t
+      self.run_uss = uss
+      self.peak = uss
+
+  def slope(self):
+    """ MB per minute """
+    return 60.0 * self.stu / self.stt if self.stt > 0 else 0.0
+
+  def run(self):
+    """ Seconds the USS has been growing for """
+    return self.t - self.run_start
+
+  def rise(self):
+    """ MB the USS grew by since the growth run started """
+    return self.uss - self.run_uss
+
+class LeakDetector:
+  """ The LeakEstimators of the live processes of one source
+
+  'on_change(detector, estimator)' is called whenever a process is flagged
+  as leaking or cleared.
+  """
+
+  def __init__(self, device = None, rate = DEFAULT_RATE, window = DEFAULT_WINDOW,
+               tolerance = DEFAULT_TOLERANCE, on_change = None):
+    self.device = device
+    self.rate = rate
+    self.window = window
+    self.tolerance = tolerance
+    self.on_change = on_change
+    self.estimators = {}    # pid -> LeakEstimator, live processes only
+    self.t = None           # time of the latest block
+    self.blocks = 0
+
+  def reset(self):
+    """ Forget all processes, e.g. before switching to another source """
+    self.estimators = {}
+    self.t = None
+
+  def leaking(self):
+    """ The estimators of the processes flagged as leaking, by pid """
+    return [e for pid, e in sorted(self.estimators.iteritems()) if e.leaking]
+
+  def apply(self, batch, t = None):
+    """ Apply the records of 'batch', then add a sample of every live
+    process at time 't' in seconds (by default the block's server time) """
+    if t is None:
+      t = batch.server_time if batch.server_time is not None else time.time()
+    if batch.sync:
+      batch = merge_snapshot(batch, self.estimators)
+    self.blocks += batch.blocks
+    estimators = self.estimators
+    names = batch.names.names
+    samples = {}
+    born = {}
+    for kind, pid, uss, name in zip(batch.kind, batch.pid, batch.uss, batch.name):
+      if kind == KIND_OLD:
+        estimators.pop(pid, None)
+        samples.pop(pid, None)
+        born.pop(pid, None)
+        continue
+      samples[pid] = uss / MB
+      if kind == KIND_NEW:
+        born[pid] = names[name] if name >= 0 else None
+      elif name >= 0 and pid in estimators:
+        estimators[pid].name = names[name]
+    # every live process is sampled at the same times, so one decay fits all
+    decay = math.exp(-(t - self.t) / self.window) if self.t is not None and t > self.t else 0.0
+    self.t = t
+    rate = self.rate
+    window = self.window
+    tolerance = self.tolerance
+    for pid, e in estimators.iteritems():
+      uss = samples.get(pid)
+      if uss is None:
+        uss = e.uss
+      elif pid in born:
+        continue
+      e.add(t, uss, decay, tolerance)
+      # the run is the cheaper test, and rules out most processes
+      if t - e.run_start < window:
+        leaking = False
+      else:
+        leaking = e.slope() >= (rate / 2 if e.leaking else rate)
+      if leaking != e.leaking:
+        e.leaking = leaking
+        if self.on_change:
+          self.on_change(self, e)
+    for pid, name in born.iteritems():
+      estimators[pid] = LeakEstimator(pid, name, t, samples[pid])
+
+def describe(e):
+  """ One line about estimator 'e' """
+  what = "leaking" if e.leaking else "no longer leaking"
+  return "pid %u (%s) %s: %+.2f MB/min, %+.1f MB over %.0f s" % \
+         (e.pid, e.name, what, e.slope(), e.rise(), e.run())
+
+def add_leak_arguments(ap):
+  """ Add --leak-rate, --leak-window and --leak-tolerance to an ArgumentParser """
+  ap.add_argument("--leak-rate", type = float, default = DEFAULT_RATE, metavar = "MB_PER_MIN",
+                  help = "flag processes whose USS grows at least this fast")
+  ap.add_argument("--leak-window", type = float, default = DEFAULT_WINDOW, metavar = "SECONDS",
+                  help = "for at least this long; also the time constant of the slope estimate")
+  ap.add_argument("--leak-tolerance", type = float, default = DEFAULT_TOLERANCE, metavar = "MB",
+                  help = "drops below the peak that don't count as a break in the growth")
+
+def leak_settings(args):
+  """ LeakDetector keyword arguments for the options of add_leak_arguments() """
+  return { "rate": args.leak_rate, "window": args.leak_window, "tolerance": args.leak_tolerance }
+
+def main():
+  ap = argparse.ArgumentParser(description = "Report processes whose USS keeps growing")
+  ap.add_argument("devices", nargs = "*", default = ["localhost"], metavar = "device",
+                  help = "name=host:port, host:port, :port or host")
+  ap.add_argument("--session", help = "read a session recorded by procrecord.py instead")
+  ap.add_argument("--text", action = "store_true", help = "ask for the text protocol instead of binary")
+  add_leak_arguments(ap)
+  add_subscription_arguments(ap)
+  args = ap.parse_args()
+
+  def report(detector, e):
+    prefix = "%s: " % detector.device if detector.device is not None else ""
+    print "%s%s" % (prefix, describe(e))
+    sys.stdout.flush()
+
+  if args.session:
+    reader = SessionReader(args.session)
+    detector = LeakDetector(on_change = report, **leak_settings(args))
+    for catch_up, batch in reader.batches(NameTable()):
+      detector.apply(batch)
+    reader.close()
+    print "%u blocks, %u processes leaking at the end" % (detector.blocks, len(detector.leaking()))
+    return 0
+
+  manager = ConnectionManager(binary = not args.text,
+                              store = lambda device: LeakDetector(device, on_change = report,
+                                                                  **leak_settings(args)))
+  manager.on_status = lambda device, text: sys.stderr.write("%s: %s\n" % (device, text))
+  requests = subscription_requests(args)
+  for spec in args.devices:
+    manager.add(*parse_device(spec), requests = requests)
+  try:
+    manager.run()
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
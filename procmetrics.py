@@ -0,0 +1,213 @@
+#!/usr/bin/python
+""" Serve the latest USS of every process as Prometheus/OpenMetrics metrics.
+
+A headless client: one ConnectionManager follows any number of procserver
+streams, keeping only the latest state of each device's live processes,
+and an HTTP server answers /metrics with it, e.g.
+
+  procserver_uss_bytes{device="phone",pid="1234",ppid="1",name="b2g"} 52334592
+
+Each device's samples are rendered when one of its blocks arrives and the
+response is assembled from them then, so a scrape only copies a string,
+however often it comes.  Dead processes are forgotten, and a device never
+exports more than --max-series processes: beyond that, the processes with
+the least USS are summed into one pid="other" series, so churning PIDs and
+crowded devices can't grow memory here or cardinality in Prometheus.
+A device whose connection is lost keeps its last samples, with
+procserver_up 0, while it is reconnected; /metrics is served throughout.
+
+This module must not import any GUI code.
+
+usage: procmetrics.py [--listen [host]:9464] [--max-series 500] [device...]
+  device: 'name=host:port', 'host:port', ':port' or 'host'
+"""
+import sys
+import argparse
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from procblock import KIND_NEW, KIND_UPDATE, KIND_OLD, merge_snapshot
+from procmux import ConnectionManager, parse_device
+from procstream import add_subscription_arguments, subscription_requests
+
+DEFAULT_LISTEN = ":9464"
+DEFAULT_MAX_SERIES = 500
+MAX_NAME = 64           # longer process names are truncated
+
+TEXT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+def escape(value):
+  """ A label value, escaped for the exposition formats """
+  return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class MetricsStore:
+  """ The live processes of one device and their rendered samples """
+
+  def __init__(self, device, max_series = DEFAULT_MAX_SERIES):
+    self.device = device
+    self.label = escape(str(device))
+    self.max_series = max(1, max_series)
+    self.live = {}          # pid -> [ppid, uss, escaped name]
+    self.blocks = 0
+    self.server_time = None
+    self.folded = 0         # live processes summed into pid="other"
+    self.samples = ""       # procserver_uss_bytes lines
+
+  def apply(self, batch):
+    """ Apply the records of 'batch' and render the samples again """
+    live = self.live
+    if batch.sync:
+      batch = merge_snapshot(batch, live)
+    names = batch.names.names
+    for kind, pid, ppid, uss, name in zip(batch.kind, batch.pid, batch.ppid, batch.uss, batch.name):
+      if kind == KIND_NEW:
+        live[pid] = [ppid, int(uss), escape(names[name][:MAX_NAME]) if name >= 0 else ""]
+      elif kind == KIND_UPDATE:
+        info = live.get(pid)
+        if info:
+          info[1] = int(uss)
+          if name >= 0:
+            info[2] = escape(names[name][:MAX_NAME])
+      elif kind == KIND_OLD:
+        live.pop(pid, None)
+    self.blocks += batch.blocks
+    self.server_time = batch.server_time
+    self.render()
+
+  def render(self):
+    pids = live = self.live
+    other = None
+    if len(live) > self.max_series:
+      pids = sorted(live, key = lambda pid: live[pid][1], reverse = True)
+      kept = self.max_series - 1
+      other = sum(live[pid][1] for pid in pids[kept:])
+      pids = pids[:kept]
+    self.folded = len(live) - len(pids)
+    prefix = "procserver_uss_bytes{device=\"%s\"," % self.label
+    lines = []
+    for pid in pids:
+      ppid, uss, name = live[pid]
+      lines.append("%spid=\"%u\",ppid=\"%u\",name=\"%s\"} %u\n" % (prefix, pid, ppid, name, uss))
+    if other is not None:
+      lines.append("%spid=\"other\",ppid=\"\",name=\"other\"} %u\n" % (prefix, other))
+    self.samples = "".join(lines)
+
+class MetricsExporter:
+  """ Follow a ConnectionManager's devices and keep the /metrics responses
+  for them ready, in both formats """
+
+  def __init__(self, manager):
+    self.manager = manager
+    manager.on_data = self.on_data
+    manager.on_status = self.on_status
+    self.responses = { TEXT_TYPE: "", OPENMETRICS_TYPE: "# EOF\n" }
+    self.scrapes = 0
+
+  def on_data(self, batch):
+    self.rebuild()
+
+  def on_status(self, device, text):
+    self.rebuild()
+
+  def rebuild(self):
+    stores = [self.manager.stores[device] for device in sorted(self.manager.stores)]
+    uss = ["# HELP procserver_uss_bytes Unique set size of a process.\n",
+           "# TYPE procserver_uss_bytes gauge\n"]
+    uss += [s.samples for s in stores]
+    gauges = []
+    for name, help, value in (
+        ("procserver_up", "Whether the procserver stream is connected.",
+         lambda s, c: int(bool(c and c.connected))),
+        ("procserver_processes", "Live processes on the device.", lambda s, c: len(s.live)),
+        ("procserver_folded_processes", "Live processes summed into the pid=\"other\" series.",
+         lambda s, c: s.folded),
+        ("procserver_last_block_timestamp_seconds", "Server time of the latest sample.",
+         lambda s, c: s.server_time)):
+      gauges.append("# HELP %s %s\n# TYPE %s gauge\n" % (name, help, name))
+      for s in stores:
+        v = value(s, self.manager.connections.get(s.device))
+        if v is not None:
+          gauges.append("%s{device=\"%s\"} %r\n" % (name, s.label, v))
+    blocks = ["procserver_blocks_total{device=\"%s\"} %u\n" % (s.label, s.blocks) for s in stores]
+    counter_help = "# HELP %s Report blocks received.\n# TYPE %s counter\n"
+    body = "".join(uss + gauges)
+    # a counter's TYPE is named after the metric family, which OpenMetrics
+    # takes to be the name without '_total'
+    self.responses = {
+      TEXT_TYPE: body + counter_help % (("procserver_blocks_total",) * 2) + "".join(blocks),
+      OPENMETRICS_TYPE: body + counter_help % (("procserver_blocks",) * 2) + "".join(blocks) + "# EOF\n",
+    }
+
+  def response(self, accept):
+    """ (content type, body) to answer a scrape with 'accept' """
+    self.scrapes += 1
+    content_type = OPENMETRICS_TYPE if "application/openmetrics-text" in (accept or "") else TEXT_TYPE
+    return content_type, self.responses[content_type]
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  """ GET /metrics; self.server.exporter has the responses """
+
+  def do_GET(self):
+    if self.path.split("?")[0] != "/metrics":
+      self.send_error(404)
+      return
+    content_type, body = self.server.exporter.response(self.headers.get("Accept"))
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def serve(exporter, host, port, verbose = False):
+  """ Answer scrapes on a thread of their own; returns the HTTPServer """
+  server = HTTPServer((host, port), MetricsHandler)
+  server.exporter = exporter
+  server.verbose = verbose
+  thread = Thread(target = server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+def main():
+  ap = argparse.ArgumentParser(description = "Export procserver streams as Prometheus metrics")
+  ap.add_argument("devices", nargs = "*", default = ["localhost"], metavar = "device",
+                  help = "name=host:port, host:port, :port or host")
+  ap.add_argument("-l", "--listen", default = DEFAULT_LISTEN, metavar = "[HOST]:PORT",
+                  help = "where to serve /metrics")
+  ap.add_argument("--max-series", type = int, default = DEFAULT_MAX_SERIES,
+                  help = "processes exported per device; the rest are summed into pid=\"other\"")
+  ap.add_argument("--text", action = "store_true", help = "ask for the text protocol instead of binary")
+  ap.add_argument("-v", "--verbose", action = "store_true", help = "log scrapes and connections")
+  add_subscription_arguments(ap)
+  args = ap.parse_args()
+
+  def status(device, text):
+    if args.verbose:
+      print "%s: %s" % (device, text)
+    exporter.on_status(device, text)
+
+  manager = ConnectionManager(binary = not args.text,
+                              store = lambda device: MetricsStore(device, args.max_series))
+  exporter = MetricsExporter(manager)
+  manager.on_status = status
+  requests = subscription_requests(args)
+  for spec in args.devices:
+    manager.add(*parse_device(spec), requests = requests)
+
+  host, sep, port = args.listen.rpartition(":")
+  server = serve(exporter, host, int(port), args.verbose)
+  print "Serving metrics on http://%s:%u/metrics" % (host or "0.0.0.0", server.server_port)
+  try:
+    manager.run()
+  except KeyboardInterrupt:
+    pass
+  server.shutdown()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
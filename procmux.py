@@ -0,0 +1,185 @@
+""" Many procserver connections in one thread.
+
+ConnectionManager multiplexes any number of procserver streams (e.g. one
+per adb-forwarded port) over a single asyncore event loop instead of one
+blocking SocketThread per connection.  Every decoded block is tagged with
+its device id and applied to that device's store, a SeriesStore unless
+the manager is given another kind.  A lost connection is made again and
+resumed as procstream.Connection does, after the same growing delays, so
+the loop keeps running while devices are away.
+
+This module must not import any GUI code.
+"""
+import sys
+import time
+import errno
+import asyncore
+from socket import AF_INET, SOCK_STREAM, error
+
+from procstream import BlockParser, DEFAULT_RECV_SIZE, BINARY_REQUEST, RECONNECT_DELAY, \
+                       MAX_RECONNECT_DELAY, resume_request
+from procblock import NameTable, decode_block
+from procseries import SeriesStore
+
+class DeviceConnection(asyncore.dispatcher):
+  """ One procserver stream, owned by a ConnectionManager
+
+  When the connection is lost or can't be made, it is tried again
+  RECONNECT_DELAY seconds later, doubling the delay after every failure up
+  to MAX_RECONNECT_DELAY, and resumed after the last block received.
+  """
+
+  def __init__(self, manager, device, host, port, recv_size = DEFAULT_RECV_SIZE, binary = True,
+               requests = ()):
+    asyncore.dispatcher.__init__(self, map = manager.map)
+    self.manager = manager
+    self.device = device
+    self.host = host
+    self.port = port
+    self.hostport = "%s:%d" % (host, port)
+    self.parser = BlockParser(recv_size)
+    self.names = NameTable()
+    self.blocks = 0
+    self.binary = binary
+    self.requests = requests
+    self.stream = None      # the server's stream and the last block's seq in it
+    self.seq = None
+    self.delay = RECONNECT_DELAY
+    self.retry_at = None    # when to connect again, None unless waiting to
+    self.open()
+
+  def open(self):
+    self.retry_at = None
+    self.parser.reset()
+    self.create_socket(AF_INET, SOCK_STREAM)
+    self.manager.post_status(self.device, "Connecting to %s..." % self.hostport)
+    try:
+      self.connect((self.host, self.port))
+    except error:
+      self.handle_error()
+
+  def retry(self):
+    """ Connect again after the current delay, unless the manager is done """
+    if self.retry_at is not None or not self.manager.keep_going:
+      return
+    self.retry_at = time.time() + self.delay
+    self.manager.post_status(self.device, "Reconnecting to %s in %.1f s..." % (self.hostport, self.delay))
+    self.delay = min(self.delay * 2, MAX_RECONNECT_DELAY)
+
+  def writable(self):
+    # only interested in writability to learn that connect() completed
+    return not self.connected
+
+  def handle_connect(self):
+    requests = ([BINARY_REQUEST] if self.binary else []) + list(self.requests)
+    if self.stream is not None:
+      requests.append(resume_request(self.stream, self.seq))
+      self.manager.post_status(self.device, "Connected to %s, resuming after block %u" %
+                               (self.hostport, self.seq))
+    else:
+      self.manager.post_status(self.device, "Connected to %s" % self.hostport)
+    # a few bytes into an empty socket buffer, this won't block
+    self.socket.sendall(b''.join(requests))
+
+  def handle_read(self):
+    try:
+      blocks = self.parser.recv(self.socket)
+    except EnvironmentError, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      raise
+    if blocks is None:
+      self.handle_close()
+      return
+    for block in blocks:
+      batch = decode_block(block, self.names)
+      batch.device = self.device
+      self.blocks += 1
+      self.delay = RECONNECT_DELAY
+      if batch.stream is not None:
+        self.stream = batch.stream
+        self.seq = batch.seq
+      self.manager.post_data(batch)
+
+  def handle_close(self):
+    self.close()
+    self.manager.post_status(self.device, "Connection to %s lost" % self.hostport)
+    self.retry()
+
+  def handle_error(self):
+    # asyncore lands here for failed connects as well as broken streams
+    e = sys.exc_info()[1]
+    self.close()
+    self.manager.post_status(self.device, "Connection to %s failed (%s)" % (self.hostport, e))
+    self.retry()
+
+class ConnectionManager:
+  """ Multiplex procserver connections and keep a SeriesStore per device
+
+  post_data() and post_status() are called on the loop's thread for every
+  block and status change; override them (or pass callbacks) to forward
+  batches elsewhere.  By default batches are applied to self.stores, which
+  'store' makes, one per device: anything with an apply(batch) method.
+  """
+
+  def __init__(self, on_data = None, on_status = None, recv_size = DEFAULT_RECV_SIZE, binary = True,
+               store = SeriesStore):
+    self.map = {}
+    self.connections = {}   # device -> DeviceConnection
+    self.stores = {}        # device -> store
+    self.store = store
+    self.on_data = on_data
+    self.on_status = on_status
+    self.recv_size = recv_size
+    self.binary = binary
+    self.keep_going = True
+
+  def add(self, device, host, port, requests = ()):
+    """ Connect to a procserver and tag its blocks with 'device'
+
+    'requests' are sent after connecting, see procstream.
+    """
+    self.stores[device] = self.store(device)
+    self.connections[device] = DeviceConnection(self, device, host, port, self.recv_size,
+                                                self.binary, requests)
+
+  def post_data(self, batch):
+    self.stores[batch.device].apply(batch)
+    if self.on_data:
+      self.on_data(batch)
+
+  def post_status(self, device, text):
+    if self.on_status:
+      self.on_status(device, text)
+
+  def stop(self):
+    self.keep_going = False
+
+  def run(self, duration = None, timeout = 0.5):
+    """ Serve all connections, and reconnect lost ones, until stopped or
+    for 'duration' s """
+    end = time.time() + duration if duration is not None else None
+    while self.keep_going and self.connections:
+      now = time.time()
+      wait = timeout
+      for c in self.connections.itervalues():
+        if c.retry_at is not None:
+          if c.retry_at <= now:
+            c.open()
+          else:
+            wait = min(wait, c.retry_at - now)
+      if self.map:
+        asyncore.loop(timeout = wait, use_poll = True, map = self.map, count = 1)
+      else:
+        # every device is away
+        time.sleep(wait)
+      if end is not None and time.time() >= end:
+        break
+
+def parse_device(spec, default_port = 26600):
+  """ Parse 'name=host:port', 'host:port', ':port' or 'host' """
+  name, sep, hostport = spec.rpartition("=")
+  host, sep, port = hostport.partition(":")
+  host = host or "localhost"
+  port = int(port) if port else default_port
+  return (name or "%s:%d" % (host, port)), host, port
@@ -0,0 +1,621 @@
+""" The USS plot, independent of any GUI toolkit.
+
+ProcPlot holds the per-process series and their lines on a matplotlib
+figure, applies decoded report batches to them and redraws.  GraphFrame
+mixes it into a wx frame; anything else with a figure canvas (e.g. an
+offscreen Agg canvas in a benchmark) can drive it the same way.
+
+The number of artists doesn't grow with the number of processes: all live
+processes are drawn by one LineCollection, dead ones are folded into a few
+static collections (see DeadLines) and the start and stop markers of all
+processes are two scatter collections.  Only the latest deaths are
+labelled, and dead processes can be forgotten altogether after a while
+('retention').  Hovering and clicking look processes up in a SampleIndex
+rather than hit-testing artists; a tooltip names the process under the
+mouse and its USS at that time.
+
+Besides the processes it can plot the total USS of process subtrees (see
+proctree), next to or instead of the individual lines.  Processes whose
+USS keeps growing (see procleak) are drawn thicker and named in the legend.
+"""
+import time
+from array import array
+from itertools import izip
+from collections import deque
+import numpy as np
+from matplotlib import rcParams
+from matplotlib.artist import setp
+from matplotlib.colors import to_rgba
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+
+from procblock import merge_snapshot
+from procdecimate import MinMaxDecimator, decimation_factor
+from proctree import ProcessTree, subtree_spec as aggregate_spec
+from procleak import LeakDetector, describe
+from procindex import SampleIndex, nearest
+
+PICKED_WIDTH = 3        # line width of processes picked to be highlighted
+LEAK_WIDTH = 2          # line width of processes flagged as leaking
+DEATH_LABELS = 20       # the latest deaths labelled with the process' name
+DEAD_CHUNK = 64         # dead processes per static collection
+HOVER_PIXELS = 5        # how near the mouse a line has to pass
+
+def segment(entry, factor):
+  """ The decimated series of a process, as an (n, 2) array """
+  x, y = entry['decimated'].points(factor)
+  return np.column_stack((x, y))
+
+class Aggregate:
+  """ The plotted USS total of one process subtree
+
+  'spec' is the root's pid, or an fnmatch pattern for its name, in which
+  case the root is the lowest live pid matching it, looked up again if it
+  dies.  The total is 0 while there is no root.
+  """
+
+  def __init__(self, spec, xstart):
+    self.spec = spec
+    self.root = spec if isinstance(spec, int) else None
+    self.generation = -1    # tree generation the root was looked up at
+    self.uss = array('d')
+    self.decimated = MinMaxDecimator(self.uss, xstart)
+    self.ussmax = 0.0
+    self.line = None
+    self.entry = { "uss": self.uss, "xstart": xstart, "decimated": self.decimated, "aggregate": self }
+
+  def label(self, tree):
+    node = tree.nodes.get(self.root)
+    name = node.name if node is not None and node.name is not None else self.spec
+    return "%s + children" % name
+
+class DeadLines:
+  """ The lines of dead processes, which no longer change
+
+  They are static, and split into collections of DEAD_CHUNK lines so that
+  deaths only rebuild the latest, small one, once per redraw.  Each
+  collection's 'entries' are the processes of its lines, in order.
+  """
+
+  def __init__(self, axes, visible):
+    self.axes = axes
+    self.visible = visible
+    self.chunks = []
+    self.dirty = set()      # chunks to rebuild
+
+  def add(self, entry, factor):
+    if not self.chunks or len(self.chunks[-1].entries) >= DEAD_CHUNK:
+      chunk = LineCollection([], visible = self.visible)
+      chunk.entries = []
+      chunk.segments = []
+      self.axes.add_collection(chunk, autolim = False)
+      self.chunks.append(chunk)
+    chunk = self.chunks[-1]
+    entry['chunk'] = chunk
+    chunk.entries.append(entry)
+    chunk.segments.append(segment(entry, factor))
+    self.dirty.add(chunk)
+
+  def sync(self):
+    """ Hand the lines to the collections that changed """
+    for chunk in self.dirty:
+      chunk.set_segments(chunk.segments)
+      self.restyle(chunk)
+    self.dirty.clear()
+
+  def restyle(self, chunk):
+    chunk.set_color(np.array([e['color'] for e in chunk.entries]))
+    chunk.set_linewidths([e['width'] for e in chunk.entries])
+
+  def remove(self, entries):
+    """ Forget the lines of 'entries', a dict of id -> entry """
+    for chunk in list(self.chunks):
+      kept = [(e, s) for e, s in izip(chunk.entries, chunk.segments) if id(e) not in entries]
+      if len(kept) == len(chunk.entries):
+        continue
+      if not kept:
+        chunk.remove()
+        self.chunks.remove(chunk)
+        self.dirty.discard(chunk)
+        continue
+      chunk.entries = [e for e, s in kept]
+      chunk.segments = [s for e, s in kept]
+      self.dirty.add(chunk)
+
+  def refresh(self, factor):
+    """ Decimate every line again, at a new 'factor' """
+    for chunk in self.chunks:
+      chunk.segments = [segment(e, factor) for e in chunk.entries]
+      self.dirty.add(chunk)
+
+class Markers:
+  """ The markers of one kind (e.g. process starts) in one scatter collection """
+
+  def __init__(self, axes, marker, visible):
+    self.collection = axes.scatter([], [], marker = marker, zorder = 2.5, visible = visible)
+    self.xy = np.empty((64, 2))
+    self.colors = np.empty((64, 4))
+    self.entries = []
+    self.dirty = False
+
+  def add(self, entry, x, y):
+    n = len(self.entries)
+    if n == len(self.xy):
+      self.xy = np.concatenate((self.xy, np.empty_like(self.xy)))
+      self.colors = np.concatenate((self.colors, np.empty_like(self.colors)))
+    self.xy[n] = (x, y)
+    self.colors[n] = entry['color']
+    self.entries.append(entry)
+    self.dirty = True
+
+  def remove(self, entries):
+    """ Forget the markers of 'entries', a dict of id -> entry """
+    keep = np.array([id(e) not in entries for e in self.entries], dtype = bool)
+    n = keep.sum()
+    self.xy[:n] = self.xy[:len(keep)][keep]
+    self.colors[:n] = self.colors[:len(keep)][keep]
+    self.entries = [e for e in self.entries if id(e) not in entries]
+    self.dirty = True
+
+  def sync(self):
+    """ Hand the markers to the collection, if they changed """
+    if self.dirty:
+      n = len(self.entries)
+      self.collection.set_offsets(self.xy[:n])
+      self.collection.set_color(self.colors[:n])
+      self.dirty = False
+
+class ProcPlot:
+  """ Per-process USS lines on one axes of 'fig', drawn on 'canvas'
+
+  'leak_settings' are LeakDetector keyword arguments, e.g. its rate.
+  Dead processes are forgotten 'retention' seconds of server time after
+  their death, if given.
+  """
+
+  def __init__(self, fig, canvas, leak_settings = None, retention = None):
+    # the following dictionaries are keyed by PID
+    self.data = {}        # every process, live or dead, not yet forgotten
+    self.live = {}        # live processes
+    self.x = 0
+    self.time = None      # server time of the latest batch
+    self.retention = retention
+    self.deaths = deque() # (time, entry) of dead processes, by time of death
+    self.highlighted = [] # processes with a thicker line, named in the legend
+    self.ussmax = 0.0
+    self.colors = [to_rgba(c) for c in rcParams['axes.prop_cycle'].by_key()['color']]
+    self.next_color = 0
+
+    # blitting state: live lines are animated and painted over a cached
+    # background holding everything else; the background is dropped
+    # whenever anything static (bounds, markers, labels, legend) changes.
+    # 'frame' is the background with the live lines on it, which is all
+    # the tooltip needs to be repainted over.
+    self.background = None
+    self.frame = None
+    self.legend_labels = []
+    self.factor = 1       # samples per decimation bucket
+
+    # subtree totals
+    self.tree = ProcessTree()
+    self.aggregates = []
+    self.aggregates_only = False  # hide the per-process lines
+
+    # leak detection, on the blocks' server times
+    self.leaks = LeakDetector(on_change = self.on_leak, **(leak_settings or {}))
+
+    axes = fig.add_subplot(111)
+
+    #
+    box = axes.get_position()
+    axes.set_position([box.x0, box.y0, box.width * 0.9, box.height])
+    # self.axes.legend(loc = 'center left', fontsize = 8, bbox_to_anchor = (1, 0.5))
+    # self.axes.set_axis_bgcolor('black')
+
+    axes.grid(True, color = 'gray')
+    axes.set_xlabel('Time (seconds)')
+    axes.set_ylabel('Memory (MB)')
+    axes.set_title('Process USS (MB) vs Time (seconds)', size = 10)
+    setp(axes.get_xticklabels(), fontsize = 8)
+    setp(axes.get_yticklabels(), fontsize = 8)
+    setp(axes.get_xticklabels(), visible = True)
+    self.fig = fig
+    self.axes = axes
+
+    self.canvas = canvas
+    self.canvas.mpl_connect('button_press_event', self.on_click)
+    self.canvas.mpl_connect('motion_notify_event', self.on_motion)
+    self.canvas.mpl_connect('axes_leave_event', self.on_motion)
+    self.canvas.mpl_connect('draw_event', self.on_draw)
+    self.blit = self.canvas.supports_blit
+    self.create_layers()
+
+  def create_layers(self):
+    """ The collections every process is drawn with """
+    visible = not self.aggregates_only
+    self.live_lines = LineCollection([], animated = self.blit, visible = visible)
+    self.live_lines.entries = []
+    self.axes.add_collection(self.live_lines, autolim = False)
+    self.dead_lines = DeadLines(self.axes, visible)
+    self.starts = Markers(self.axes, 'o', visible)
+    self.stops = Markers(self.axes, 'x', visible)
+    self.labels = deque()
+    self.index = SampleIndex()
+    self.hover = None     # (x, y) of the mouse, in data coordinates
+    self.tooltip = self.axes.annotate("", (0, 0), xytext = (12, 12), textcoords = 'offset points',
+                                      fontsize = 9, animated = self.blit, visible = False,
+                                      bbox = dict(boxstyle = 'round', fc = 'lightyellow', alpha = 0.9))
+
+  def lookup(self, x, y):
+    """ (entry, time step, USS) of the line nearest (x, y), or None """
+    if x is None or y is None:
+      return None
+    # HOVER_PIXELS, in data units
+    ymin, ymax = self.axes.get_ybound()
+    tolerance = HOVER_PIXELS * (ymax - ymin) / max(self.axes.bbox.height, 1)
+    aggregates = [a.entry for a in self.aggregates]
+    if self.aggregates_only:
+      return nearest(aggregates, x, y, tolerance, self.factor)
+    return self.index.nearest(x, y, tolerance, self.factor, aggregates)
+
+  def on_click(self, event):
+    if event.inaxes is not self.axes:
+      return
+    found = self.lookup(event.xdata, event.ydata)
+    if found is None:
+      return
+    entry, x, y = found
+    print "pick: %s (%u, %f)" % (entry.get('pid', 'total'), x, y)
+    if event.button == 2:
+      self.axes.text(x + 0.5, y + 0.5, "%.3f MB" % y, color = 'black', fontsize = 10)
+      self.axes.plot(x, y, color = 'white', marker = 's')
+    if 'pid' in entry:
+      if event.button == 1:
+        self.set_width(entry, 1 if entry['width'] != 1 else PICKED_WIDTH)
+      if event.button == 3:
+        self.add_aggregate(entry['pid'])
+    self.background = None
+    self.redraw_plot()
+
+  def on_motion(self, event):
+    inside = event.inaxes is self.axes and event.name != 'axes_leave_event'
+    self.hover = (event.xdata, event.ydata) if inside else None
+    if self.update_tooltip():
+      if self.blit and self.frame is not None:
+        self.canvas.restore_region(self.frame)
+        self.draw_tooltip()
+        self.canvas.blit(self.axes.bbox)
+      else:
+        self.canvas.draw_idle()
+
+  def update_tooltip(self):
+    """ Point the tooltip at the line under the mouse; True if it changed """
+    tip = self.tooltip
+    found = self.lookup(*self.hover) if self.hover else None
+    if found is None:
+      shown = tip.get_visible()
+      tip.set_visible(False)
+      return shown
+    entry, x, uss = found
+    if 'pid' in entry:
+      text = "%s (%u)" % (entry['name'], entry['pid'])
+      leak = self.leaks.estimators.get(entry['pid'])
+      if self.live.get(entry['pid']) is entry and leak is not None and leak.leaking:
+        text += "\nleaking %+.2f MB/min" % leak.slope()
+    else:
+      text = entry['aggregate'].label(self.tree)
+    text += "\n%u s: %.3f MB" % (x, uss)
+    if tip.get_visible() and tip.get_text() == text and tip.xy == (x, uss):
+      return False
+    # on the side of the point facing the middle of the axes, to stay inside
+    xmin, xmax = self.axes.get_xbound()
+    ymin, ymax = self.axes.get_ybound()
+    right = x > (xmin + xmax) / 2.0
+    top = uss > (ymin + ymax) / 2.0
+    tip.xy = (x, uss)
+    tip.xyann = (-12 if right else 12, -12 if top else 12)
+    tip.set_horizontalalignment('right' if right else 'left')
+    tip.set_verticalalignment('top' if top else 'bottom')
+    tip.set_text(text)
+    tip.set_visible(True)
+    return True
+
+  def set_width(self, entry, width):
+    """ Draw a process' line 'width' wide; it's in the legend unless 1 """
+    entry['width'] = width
+    self.highlighted = [e for e in self.highlighted if e is not entry]
+    if width != 1:
+      self.highlighted.append(entry)
+    chunk = entry.get('chunk')
+    if chunk is not None:
+      self.dead_lines.dirty.add(chunk)
+      self.background = None
+
+  def snap_bound(self, axis, needed, minimum):
+    """ Round 'needed' up to the next major tick of 'axis'
+
+    Axis bounds then only move when the data crosses a tick, which is
+    what lets redraw_plot() blit most frames instead of redrawing.
+    """
+    needed = max(needed, minimum)
+    for tick in axis.get_major_locator().tick_values(0, needed):
+      if tick >= needed:
+        return tick
+    return needed
+
+  def redraw_plot(self):
+    """ Draw the plot using all current data, settings """
+    xmin = 0
+    xmax = self.snap_bound(self.axes.xaxis, self.x * 1.01, 50)
+    ymin = 0
+    # lines are decimated to about one bucket per pixel column; when that
+    # changes (time axis growth, resize) every line has to be refreshed
+    factor = decimation_factor(xmax - xmin, self.axes.bbox.width)
+    if factor != self.factor:
+      self.factor = factor
+      self.dead_lines.refresh(factor)
+      self.background = None
+    ymax = 0
+    legend = []
+    handles = []
+    if not self.aggregates_only:
+      # only live lines change; dead ones were finalized by handle_old()
+      # and hidden ones are brought up to date when shown again
+      self.set_live_lines()
+      if self.data:
+        ymax = round(self.ussmax, 0) + 1
+      for entry in self.highlighted:
+        leak = self.leaks.estimators.get(entry['pid'])
+        alive = self.live.get(entry['pid']) is entry
+        legend.append('%s (%s)%s' % (entry['name'], entry['pid'],
+                                     " leaking" if alive and leak and leak.leaking else ""))
+        handles.append(Line2D([], [], color = entry['color'], linewidth = entry['width']))
+    self.dead_lines.sync()
+    self.starts.sync()
+    self.stops.sync()
+    for a in self.aggregates:
+      x, y = a.decimated.points(self.factor)
+      a.line.set_data(x, y)
+      ymax = max(ymax, round(a.ussmax, 0) + 1)
+      legend.append(a.label(self.tree))
+      handles.append(a.line)
+    if legend != self.legend_labels:
+      self.legend_labels = legend
+      self.background = None
+      if legend:
+        # Apparently setting loc = 'best' causes matplotlib to eat up 100% CPU :(
+        # For now, keep this to the left edge where the oldest data is.
+        # self.legend = self.axes.legend(fontsize = 10, loc = 'center left')
+        self.legend = self.axes.legend(handles, legend, fontsize = 10, loc = 'center left',
+                                       bbox_to_anchor = (1, 0.5))
+      else:
+        try:
+          self.legend.set_visible(False)
+        except:
+          pass
+    ymax = self.snap_bound(self.axes.yaxis, ymax, 1)
+    if self.hover:
+      # the line under the mouse may have moved, or another come by
+      self.update_tooltip()
+    # print "redraw: (%u, %u)-(%u, %u)" % (xmin, ymin, xmax, ymax)
+    if self.axes.get_xbound() != (xmin, xmax) or self.axes.get_ybound() != (ymin, ymax):
+      self.axes.set_xbound(lower = xmin, upper = xmax)
+      self.axes.set_ybound(lower = ymin, upper = ymax)
+      self.background = None
+    if self.blit and self.background is not None:
+      # nothing static changed: restore the cached background and
+      # repaint only the live lines on top of it
+      self.canvas.restore_region(self.background)
+      self.draw_live_plots()
+      self.canvas.blit(self.axes.bbox)
+    else:
+      self.canvas.draw()
+
+  def set_live_lines(self):
+    """ Hand the decimated series of the live processes to their collection """
+    entries = self.live.values()
+    lines = self.live_lines
+    lines.entries = entries
+    lines.set_segments([segment(e, self.factor) for e in entries])
+    if entries:
+      lines.set_color(np.array([e['color'] for e in entries]))
+      lines.set_linewidths([e['width'] for e in entries])
+
+  def draw_live_plots(self):
+    if self.live_lines.get_visible():
+      self.axes.draw_artist(self.live_lines)
+    for a in self.aggregates:
+      if a.line.get_animated():
+        self.axes.draw_artist(a.line)
+    if self.blit:
+      self.frame = self.canvas.copy_from_bbox(self.axes.bbox)
+    self.draw_tooltip()
+
+  def draw_tooltip(self):
+    if self.tooltip.get_visible() and self.tooltip.get_animated():
+      self.axes.draw_artist(self.tooltip)
+
+  def on_draw(self, event):
+    """ A full draw just happened: cache everything but the live lines """
+    if self.blit:
+      self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+      self.draw_live_plots()
+
+  def set_blit(self, blit):
+    """ Switch between blitted and full redraws """
+    self.blit = blit and self.canvas.supports_blit
+    self.live_lines.set_animated(self.blit)
+    self.tooltip.set_animated(self.blit)
+    self.frame = None
+    for a in self.aggregates:
+      a.line.set_animated(self.blit)
+    self.background = None
+    self.redraw_plot()
+
+  def add_aggregate(self, spec):
+    """ Plot the total USS of a subtree: 'spec' is the pid of its root, or
+    an fnmatch pattern for the root's name """
+    if any(a.spec == spec for a in self.aggregates):
+      return
+    a = Aggregate(spec, self.x)
+    a.line = self.axes.plot([], [], linewidth = 3, linestyle = '--', animated = self.blit)[0]
+    self.aggregates.append(a)
+    self.update_aggregate(a, 1)
+    self.background = None
+
+  def update_aggregate(self, a, blocks):
+    """ Append the subtree's current total, once per block """
+    tree = self.tree
+    if a.root not in tree and not isinstance(a.spec, int) and a.generation != tree.generation:
+      a.root = tree.find(a.spec)
+      a.generation = tree.generation
+    total = tree.total(a.root) or 0.0
+    a.uss.extend([total] * blocks)
+    a.ussmax = max(a.ussmax, total)
+
+  def on_leak(self, detector, leak):
+    """ A process was flagged as leaking, or cleared: highlight its line """
+    print "[%s]" % describe(leak)
+    entry = self.live.get(leak.pid)
+    if entry is None:
+      return
+    if leak.leaking and entry['width'] == 1:
+      self.set_width(entry, LEAK_WIDTH)
+    elif not leak.leaking and entry['width'] == LEAK_WIDTH:
+      self.set_width(entry, 1)
+
+  def set_aggregates_only(self, only):
+    """ Show the subtree totals instead of, or next to, every process """
+    self.aggregates_only = only
+    self.dead_lines.visible = not only
+    lines = set(a.line for a in self.aggregates)
+    lines.add(self.tooltip)
+    for artist in self.axes.collections + self.axes.lines + self.axes.texts:
+      if artist not in lines:
+        artist.set_visible(not only)
+    self.background = None
+    self.redraw_plot()
+
+  def clear_plot(self):
+    """ Forget all processes, e.g. before switching to another source """
+    for artist in self.axes.collections + self.axes.lines + self.axes.texts:
+      artist.remove()
+    self.data = {}
+    self.live = {}
+    self.deaths = deque()
+    self.highlighted = []
+    self.ussmax = 0.0
+    self.x = 0
+    self.time = None
+    self.hover = None
+    self.create_layers()
+    self.tree = ProcessTree()
+    self.leaks.reset()
+    specs = [a.spec for a in self.aggregates]
+    self.aggregates = []
+    for spec in specs:
+      self.add_aggregate(spec)
+    self.background = None
+    self.redraw_plot()
+
+  def handle_new(self, pid, ppid, uss, name):
+    """ Handle new process """
+    self.tree.add(pid, ppid, uss, name)
+    if pid not in self.live:
+      series = array('d', [uss])
+      color = self.colors[self.next_color % len(self.colors)]
+      self.next_color += 1
+      # a reused pid replaces the dead process in self.data, not on the plot
+      entry = { "pid": pid, "name": name, "uss": series, "xstart": self.x,
+                "decimated": MinMaxDecimator(series, self.x), "color": color, "width": 1 }
+      self.data[pid] = entry
+      self.live[pid] = entry
+      self.index.add(entry)
+      self.ussmax = max(self.ussmax, uss)
+      if name is not None:
+        print "[new pid %u uss %.3f name '%s']" % (pid, uss, name)
+      else:
+        print "[new pid %u uss %.3f]" % (pid, uss)
+      self.starts.add(entry, self.x, uss)
+      self.background = None
+
+  def handle_update(self, pid, ppid, uss, name):
+    """ Update an existing process, possibly including a rename """
+    self.tree.update(pid, uss, name)
+    entry = self.live.get(pid)
+    if entry is not None:
+      entry['uss'][-1] = uss
+      self.ussmax = max(self.ussmax, uss)
+      # print "[update pid %u uss %.3f --> length %u]" % (pid, uss, len(entry['uss']))
+      if name is not None:
+        print "[pid new name '%s']" % name
+        entry['name'] = name
+
+  def handle_old(self, pid, ppid, uss, name):
+    """ Handle the death of a process """
+    self.tree.remove(pid)
+    entry = self.live.pop(pid, None)
+    if entry is None:
+      return
+    # print "[old pid %u]" % pid
+    series = entry['uss']
+    if len(series) > 1:
+      # drop this step's repeated sample, the process is gone
+      series.pop()
+    x = entry['xstart'] + len(series) - 1
+    y = series[-1]
+    self.stops.add(entry, x, y)
+    self.labels.append(self.axes.text(x, y, "%s" % entry['name'], color = 'black', fontsize = 10,
+                                      visible = not self.aggregates_only))
+    if len(self.labels) > DEATH_LABELS:
+      self.labels.popleft().remove()
+    if entry['width'] == LEAK_WIDTH:
+      # the leak detector forgets dead processes too
+      self.set_width(entry, 1)
+    # the line won't change any more; move it into the static layer
+    self.dead_lines.add(entry, self.factor)
+    self.deaths.append((self.time, entry))
+    self.background = None
+
+  def forget_dead(self):
+    """ Forget the processes that died more than 'retention' seconds ago """
+    forgotten = {}
+    while self.deaths and self.deaths[0][0] < self.time - self.retention:
+      t, entry = self.deaths.popleft()
+      forgotten[id(entry)] = entry
+      if self.data.get(entry['pid']) is entry:
+        del self.data[entry['pid']]
+    if forgotten:
+      self.highlighted = [e for e in self.highlighted if id(e) not in forgotten]
+      self.dead_lines.remove(forgotten)
+      self.starts.remove(forgotten)
+      self.stops.remove(forgotten)
+      self.index.remove(forgotten)
+      self.background = None
+
+  def handle_messages(self, batch):
+    """ Generic process message dispatch """
+    if batch.sync:
+      batch = merge_snapshot(batch, self.live)
+    # a batch merged from several blocks still moves time on by one per block
+    blocks = batch.blocks
+    self.x = self.x + blocks
+    self.time = batch.server_time if batch.server_time is not None else time.time()
+    self.index.advance(self.x, self.live.itervalues())
+    for entry in self.live.itervalues():
+      # for now, pre-duplicate all of the last data points
+      series = entry['uss']
+      series.extend([series[-1]] * blocks)
+    # the batch arrives fully decoded; only scale it to megabytes
+    uss = (np.frombuffer(batch.uss) / (1024 * 1024)).tolist()
+    names = batch.names.names
+    handlers = (self.handle_new, self.handle_update, self.handle_old)
+    for kind, pid, ppid, mb, name in izip(batch.kind, batch.pid, batch.ppid, uss, batch.name):
+      handlers[kind](pid, ppid, mb, names[name] if name >= 0 else None)
+    for a in self.aggregates:
+      self.update_aggregate(a, blocks)
+    # in the server's seconds, as procleak.py sees them, not plot steps
+    self.leaks.apply(batch)
+    if self.retention is not None:
+      self.forget_dead()
+    self.redraw_plot()
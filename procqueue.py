@@ -0,0 +1,103 @@
+""" Latest-wins hand-off of report batches from a reader thread to the GUI.
+
+A reader thread put()s every batch it decodes; the consumer take()s
+whatever is pending, as one batch, whenever it gets round to it.  Batches
+that arrive in between are merged into the pending one instead of being
+queued behind it, so a consumer that falls behind catches up in one step
+rather than working through a backlog:
+
+  - 'new' and 'old' records are kept, in order, so every process that was
+    born or died is still seen, as is a PID that was reused;
+  - 'update' records collapse into the process' latest 'new' or 'update'
+    record, keeping the latest USS and the latest name sent;
+  - a snapshot ('sync') replaces everything pending: it holds the state of
+    every live process, and the consumer reconciles it with merge_snapshot().
+
+The pending batch counts the blocks merged into it in 'blocks', so the
+consumer can still advance its time axis one step per block.  Memory is
+bounded by the number of processes and births/deaths, not by the backlog.
+"""
+import time
+from threading import Lock
+
+from procblock import KIND_UPDATE, KIND_OLD, TIMINGS
+
+class BatchQueue:
+  """ At most one pending ReportBatch, merged into as batches arrive """
+
+  def __init__(self, notify):
+    """ 'notify' is called, on the producing thread, when a batch is put
+    into an empty queue; the consumer should then take() it. """
+    self.notify = notify
+    self.lock = Lock()
+    self.pending = None
+    self.open = None      # pid -> index of its 'new'/'update' record in pending
+    self.merged = 0       # blocks merged into another, since the start
+
+  def put(self, batch):
+    with self.lock:
+      if self.pending is None:
+        batch.queue_time = time.time()
+        self.pending = batch
+        self.open = None
+        wake = True
+      else:
+        self.merge(batch)
+        wake = False
+    if wake:
+      self.notify()
+
+  def take(self):
+    """ The pending batch, None if there is none """
+    with self.lock:
+      batch = self.pending
+      self.pending = None
+      self.open = None
+      return batch
+
+  def peek(self):
+    """ The pending batch, left pending; None if there is none.  It only
+    stays as it is while nothing is put(). """
+    with self.lock:
+      return self.pending
+
+  def merge(self, batch):
+    pending = self.pending
+    self.merged += 1
+    if batch.sync:
+      batch.blocks += pending.blocks
+      batch.queue_time = pending.queue_time
+      self.pending = batch
+      self.open = None
+      return
+    if self.open is None:
+      # indexed lazily: a consumer that keeps up never pays for it
+      self.open = {}
+      for i, (kind, pid) in enumerate(zip(pending.kind, pending.pid)):
+        if kind == KIND_OLD:
+          self.open.pop(pid, None)
+        else:
+          self.open[pid] = i
+    open = self.open
+    for kind, pid, ppid, uss, name in zip(batch.kind, batch.pid, batch.ppid, batch.uss, batch.name):
+      i = open.get(pid) if kind == KIND_UPDATE else None
+      if i is not None:
+        pending.uss[i] = uss
+        if name >= 0:
+          pending.name[i] = name
+        continue
+      if kind == KIND_OLD:
+        open.pop(pid, None)
+      else:
+        open[pid] = len(pending)
+      pending.add(kind, pid, ppid, uss, name)
+    pending.blocks += batch.blocks
+    pending.server_time = batch.server_time
+    pending.stream = batch.stream
+    # timings are the latest block's, but for how long the batch has waited
+    for key in TIMINGS:
+      if key != "queue_time":
+        setattr(pending, key, getattr(batch, key))
+    if batch.parsed is not None:
+      pending.parsed = batch.parsed
+      pending.skipped = batch.skipped
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+""" Headless procserver recorder
+
+Connects to a procserver the same way procclient's SocketThread does,
+decodes every report block and appends it to a compressed session file
+(see procsession), and optionally to a segment store queryable by
+process and time (see procsegments).  No GUI code is imported, so this runs on hosts with no
+display and keeps per-recorder CPU and memory small.
+
+usage: procrecord.py [-H host] [-p port] [--leaks] [--segments DIR] -o session.prs
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+from socket import *
+
+from procstream import BlockParser, DEFAULT_RECV_SIZE, BINARY_REQUEST, \
+                       add_subscription_arguments, subscription_requests
+from procblock import NameTable, decode_block
+from procsession import SessionWriter, DEFAULT_KEYFRAME_INTERVAL
+from procleak import LeakDetector, describe, add_leak_arguments, leak_settings
+
+def record(host, port, writer, recv_size = DEFAULT_RECV_SIZE, binary = True, requests = (), leaks = None,
+           segments = None):
+  """ Record blocks from host:port into 'writer' until the server closes
+
+  Every block is also applied to LeakDetector 'leaks' and SegmentWriter
+  'segments', if given.
+  """
+  parser = BlockParser(recv_size)
+  names = NameTable()
+  client = socket(AF_INET, SOCK_STREAM)
+  hostport = "%s:%d" % (host, port)
+  print "Connecting to %s..." % hostport
+  rv = client.connect_ex((host, port))
+  if rv != 0:
+    print "Connection to %s failed (%s)" % (hostport, os.strerror(rv))
+    return False
+  print "Connected to %s, recording to %s" % (hostport, writer.path)
+  if binary:
+    client.sendall(BINARY_REQUEST)
+  for request in requests:
+    client.sendall(request)
+
+  try:
+    while True:
+      blocks = parser.recv(client)
+      if blocks is None:
+        break
+      now = time.time()
+      for block in blocks:
+        batch = decode_block(block, names)
+        writer.write(batch, now)
+        if leaks is not None:
+          leaks.apply(batch)
+        if segments is not None:
+          segments.apply(batch)
+  finally:
+    client.close()
+    print "Connection to %s closed after %u blocks" % (hostport, writer.blocks)
+  return True
+
+def main():
+  ap = argparse.ArgumentParser(description = "Record a procserver stream to a session file")
+  ap.add_argument("-H", "--host", default = "localhost")
+  ap.add_argument("-p", "--port", type = int, default = 26600)
+  ap.add_argument("-o", "--output", required = True, help = "session file to write")
+  ap.add_argument("--keyframe-interval", type = int, default = DEFAULT_KEYFRAME_INTERVAL,
+                  help = "blocks between full-state keyframes")
+  ap.add_argument("--level", type = int, default = 6, help = "zlib compression level")
+  ap.add_argument("--recv-size", type = int, default = DEFAULT_RECV_SIZE)
+  ap.add_argument("--text", action = "store_true", help = "ask for the text protocol instead of binary")
+  ap.add_argument("--leaks", action = "store_true", help = "report processes whose USS keeps growing")
+  ap.add_argument("--segments", metavar = "DIR", help = "also write a segment store to this directory")
+  ap.add_argument("--segment-seconds", type = float,
+                  help = "time covered by each segment of the store (default: procsegments.DEFAULT_SEGMENT_SECONDS)")
+  add_leak_arguments(ap)
+  add_subscription_arguments(ap)
+  args = ap.parse_args()
+
+  # let 'kill' close the session file cleanly
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  leaks = None
+  if args.leaks:
+    leaks = LeakDetector(on_change = lambda detector, e: sys.stdout.write("%s\n" % describe(e)),
+                         **leak_settings(args))
+  segments = None
+  if args.segments:
+    # procsegments brings in numpy; a recorder that writes no segments stays without it
+    from procsegments import SegmentWriter, DEFAULT_SEGMENT_SECONDS
+    segments = SegmentWriter(args.segments, args.segment_seconds or DEFAULT_SEGMENT_SECONDS)
+  writer = SessionWriter(args.output, args.keyframe_interval, args.level)
+  try:
+    ok = record(args.host, args.port, writer, args.recv_size, not args.text, subscription_requests(args),
+                leaks, segments)
+  except KeyboardInterrupt:
+    ok = True
+  finally:
+    writer.close()
+    if segments is not None:
+      segments.close()
+  return 0 if ok else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,373 @@
+#!/usr/bin/python
+""" A segmented on-disk store of USS samples, queryable by time, PID and name.
+
+A store is a directory holding one file per segment (by default ten
+minutes of samples) and a manifest:
+
+  manifest       MANIFEST_ENTRY per segment, appended as each is finished:
+                 '<ddIII4x' start time, end time, segment number, rows, pids
+  seg-NNNNNN     header    '<4sHHIIIIdd' magic 'PSEG', version, reserved,
+                                         rows, pids, names, name pairs,
+                                         start time, end time
+                 columns   time, uss ('<f8'); pid, ppid, name ('<i4'),
+                           one value per row
+                 pid index pid ('<i4', pids), first row ('<i4', pids + 1)
+                 names     name, pid ('<i4', name pairs), sorted by name
+                 then each name as '<H' length and bytes
+
+A row is a change of one process: its USS (in bytes, NaN once it is gone),
+ppid and name (an index into the segment's names, NO_NAME if none) at a
+server time.  Each segment starts with a keyframe, a row for every live
+process, so it can be read on its own.  Rows are sorted by pid, then time,
+and the pid index gives each pid's rows; the manifest is the time index.
+"PID X from hour 3 to 5" or "everything named Y" thus maps only the
+segments of that time and reads only the rows of those processes.
+
+Rows are kept in memory until their segment is finished, then written at
+once, so a crash loses at most the segment being filled.
+
+This module must not import any GUI code.
+
+usage: procsegments.py STORE [--pid PID | --name PATTERN] [--start S] [--end S]
+"""
+import os
+import sys
+import time
+import struct
+import fnmatch
+import argparse
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+import numpy as np
+
+from procblock import KIND_NEW, KIND_UPDATE, KIND_OLD, NO_NAME, NO_USS, merge_snapshot
+from procsession import mmap_file
+
+MAGIC = b'PSEG'
+VERSION = 1
+
+SEGMENT_HEADER = struct.Struct('<4sHHIIIIdd')
+MANIFEST_ENTRY = struct.Struct('<ddIII4x')
+NAME_LENGTH = struct.Struct('<H')
+
+MANIFEST = "manifest"
+DEFAULT_SEGMENT_SECONDS = 600
+OPEN_SEGMENTS = 16      # segments a reader keeps mapped
+
+def segment_path(path, number):
+  return os.path.join(path, "seg-%06u" % number)
+
+class SegmentWriter:
+  """ Write report batches to the store in directory 'path'
+
+  Like SeriesStore, it has an apply(batch) method, so it can be given
+  every batch a client receives.  A new segment is started by the first
+  batch 'segment_seconds' or more after the start of the current one.
+  Appends to an existing store.
+  """
+
+  def __init__(self, path, segment_seconds = DEFAULT_SEGMENT_SECONDS):
+    self.path = path
+    self.segment_seconds = segment_seconds
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.manifest = open(os.path.join(path, MANIFEST), "ab")
+    self.number = self.manifest.tell() // MANIFEST_ENTRY.size
+    self.live = {}        # pid -> [ppid, uss, name]
+    self.start = None     # time of the segment being filled
+    self.segments = 0     # finished by this writer
+    self.rows = 0
+    self.clear()
+
+  def clear(self):
+    self.time = array('d')
+    self.uss = array('d')
+    self.pid = array('i')
+    self.ppid = array('i')
+    self.name = array('i')
+    self.names = {}       # name -> index in this segment
+
+  def row(self, t, pid, ppid, uss, name):
+    self.time.append(t)
+    self.pid.append(pid)
+    self.ppid.append(ppid)
+    self.uss.append(uss)
+    if name is None:
+      self.name.append(NO_NAME)
+    else:
+      self.name.append(self.names.setdefault(name, len(self.names)))
+
+  def apply(self, batch, t = None):
+    """ Add the changes of 'batch', at time 't' (by default the block's
+    server time) """
+    if t is None:
+      t = batch.server_time if batch.server_time is not None else time.time()
+    live = self.live
+    if batch.sync:
+      batch = merge_snapshot(batch, live)
+    if self.start is not None and t >= self.start + self.segment_seconds:
+      self.finish()
+    # a new segment starts with a keyframe, every live process as of this
+    # batch; only the batch's deaths need rows of their own
+    keyframe = self.start is None
+    if keyframe:
+      self.start = t
+    names = batch.names.names
+    for kind, pid, ppid, uss, name in zip(batch.kind, batch.pid, batch.ppid, batch.uss, batch.name):
+      name = names[name] if name >= 0 else None
+      if kind == KIND_NEW:
+        live[pid] = [ppid, uss, name]
+      elif kind == KIND_UPDATE:
+        info = live.get(pid)
+        if info is None:
+          continue
+        if uss != NO_USS:
+          info[1] = uss
+        if name is not None:
+          info[2] = name
+        ppid, uss, name = info
+      elif kind == KIND_OLD:
+        info = live.pop(pid, None)
+        if info is None:
+          continue
+        ppid, uss, name = info[0], float('nan'), info[2]
+      if not keyframe or kind == KIND_OLD:
+        self.row(t, pid, ppid, uss, name)
+    if keyframe:
+      for pid in sorted(live):
+        ppid, uss, name = live[pid]
+        self.row(t, pid, ppid, uss, name)
+
+  def finish(self):
+    """ Write the segment being filled, if any, and add it to the manifest """
+    if self.start is None:
+      return
+    rows = len(self.time)
+    pid = np.frombuffer(self.pid, dtype = np.int32) if rows else np.empty(0, np.int32)
+    # by pid, then time: rows were added in time order and the sort is stable
+    order = np.argsort(pid, kind = 'mergesort')
+    pids, first = np.unique(pid[order], return_index = True)
+    index_start = np.append(first, rows).astype('<i4')
+    name = np.frombuffer(self.name, dtype = np.int32) if rows else np.empty(0, np.int32)
+    named = name >= 0
+    pairs = np.unique(name[named].astype(np.int64) << 32 | pid[named].astype(np.int64))
+    names = sorted(self.names, key = self.names.get)
+    end = max(self.time) if rows else self.start
+
+    def column(a, dtype):
+      values = np.frombuffer(a, dtype = dtype) if rows else np.empty(0, dtype)
+      return values[order].astype('<' + np.dtype(dtype).str[1:]).tostring()
+
+    parts = [SEGMENT_HEADER.pack(MAGIC, VERSION, 0, rows, len(pids), len(names), len(pairs), self.start, end),
+             column(self.time, np.float64), column(self.uss, np.float64),
+             column(self.pid, np.int32), column(self.ppid, np.int32), column(self.name, np.int32),
+             pids.astype('<i4').tostring(), index_start.tostring(),
+             (pairs >> 32).astype('<i4').tostring(), (pairs & 0xffffffff).astype('<i4').tostring()]
+    for n in names:
+      parts.append(NAME_LENGTH.pack(len(n)))
+      parts.append(n)
+    path = segment_path(self.path, self.number)
+    with open(path + ".tmp", "wb") as f:
+      f.write(b''.join(parts))
+    os.rename(path + ".tmp", path)
+    self.manifest.write(MANIFEST_ENTRY.pack(self.start, end, self.number, rows, len(pids)))
+    self.manifest.flush()
+    self.number += 1
+    self.segments += 1
+    self.rows += rows
+    self.start = None
+    self.clear()
+
+  def close(self):
+    self.finish()
+    self.manifest.close()
+
+class Segment:
+  """ One finished segment, mapped read-only """
+
+  def __init__(self, path):
+    self.file = open(path, "rb")
+    self.data = mmap_file(self.file)
+    magic, version, reserved, rows, pids, names, pairs, self.start, self.end = \
+      SEGMENT_HEADER.unpack_from(self.data)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("%s is not a segment" % path)
+    self.rows = rows
+    self.offset = SEGMENT_HEADER.size
+    self.time = self.column('<f8', rows)
+    self.uss = self.column('<f8', rows)
+    self.pid = self.column('<i4', rows)
+    self.ppid = self.column('<i4', rows)
+    self.name = self.column('<i4', rows)
+    self.index_pid = self.column('<i4', pids)
+    self.index_start = self.column('<i4', pids + 1)
+    self.pair_name = self.column('<i4', pairs)
+    self.pair_pid = self.column('<i4', pairs)
+    self.name_count = names
+    self.names_offset = self.offset
+    self._names = None
+
+  def column(self, dtype, count):
+    values = np.frombuffer(self.data, dtype = dtype, count = count, offset = self.offset) \
+             if count else np.empty(0, dtype)
+    self.offset += values.nbytes
+    return values
+
+  def names(self):
+    """ The segment's names, as a list indexed by the name column """
+    if self._names is None:
+      names = []
+      offset = self.names_offset
+      for i in xrange(self.name_count):
+        length, = NAME_LENGTH.unpack_from(self.data, offset)
+        offset += NAME_LENGTH.size
+        names.append(self.data[offset:offset + length])
+        offset += length
+      self._names = names
+    return self._names
+
+  def pids(self):
+    return self.index_pid
+
+  def rows_of(self, pid):
+    """ (first, end) of the rows of 'pid'; empty if it has none """
+    k = np.searchsorted(self.index_pid, pid)
+    if k < len(self.index_pid) and self.index_pid[k] == pid:
+      return int(self.index_start[k]), int(self.index_start[k + 1])
+    return 0, 0
+
+  def named(self, pattern):
+    """ {pid: set of names} of the processes with a name matching the
+    fnmatch 'pattern' in this segment """
+    found = {}
+    for i, name in enumerate(self.names()):
+      if fnmatch.fnmatchcase(name, pattern):
+        a = np.searchsorted(self.pair_name, i, 'left')
+        b = np.searchsorted(self.pair_name, i, 'right')
+        for pid in self.pair_pid[a:b]:
+          found.setdefault(int(pid), set()).add(name)
+    return found
+
+  def close(self):
+    self.data.close()
+    self.file.close()
+
+class SegmentStore:
+  """ Read a store written by SegmentWriter; it may still be growing """
+
+  def __init__(self, path):
+    self.path = path
+    self.open = OrderedDict() # segment number -> Segment, least recently used first
+    self.starts = []
+    self.ends = []
+    self.numbers = []
+    self.refresh()
+
+  def refresh(self):
+    """ Pick up the segments finished since the last refresh """
+    with open(os.path.join(self.path, MANIFEST), "rb") as f:
+      f.seek(len(self.numbers) * MANIFEST_ENTRY.size)
+      data = f.read()
+    for offset in xrange(0, len(data) - MANIFEST_ENTRY.size + 1, MANIFEST_ENTRY.size):
+      start, end, number, rows, pids = MANIFEST_ENTRY.unpack_from(data, offset)
+      self.starts.append(start)
+      self.ends.append(end)
+      self.numbers.append(number)
+
+  def __len__(self):
+    return len(self.numbers)
+
+  def start_time(self):
+    return self.starts[0] if self.starts else None
+
+  def end_time(self):
+    return self.ends[-1] if self.ends else None
+
+  def segment(self, i):
+    """ The i-th segment, mapped on first use
+
+    At most OPEN_SEGMENTS stay mapped; the least recently used is unmapped
+    to make room.
+    """
+    number = self.numbers[i]
+    s = self.open.pop(number, None)
+    if s is None:
+      if len(self.open) >= OPEN_SEGMENTS:
+        self.open.popitem(last = False)[1].close()
+      s = Segment(segment_path(self.path, number))
+    # (re)insert at the end: most recently used
+    self.open[number] = s
+    return s
+
+  def range(self, start = None, end = None):
+    """ Indices of the segments holding the samples from 'start' to 'end',
+    including the one holding the value in effect at 'start' """
+    first = 0 if start is None else max(bisect_right(self.starts, start) - 1, 0)
+    last = len(self.starts) if end is None else bisect_right(self.starts, end)
+    return xrange(first, last)
+
+  def series(self, pid, start = None, end = None):
+    """ (time, uss) arrays of the rows of 'pid' from 'start' to 'end', the
+    first being the row in effect at 'start'; uss is NaN while it's gone """
+    times = []
+    values = []
+    for i in self.range(start, end):
+      s = self.segment(i)
+      a, b = s.rows_of(pid)
+      times.append(s.time[a:b])
+      values.append(s.uss[a:b])
+    if not times:
+      return np.empty(0), np.empty(0)
+    t = np.concatenate(times)
+    u = np.concatenate(values)
+    first = 0 if start is None else max(np.searchsorted(t, start, 'right') - 1, 0)
+    last = len(t) if end is None else np.searchsorted(t, end, 'right')
+    return t[first:last], u[first:last]
+
+  def named(self, pattern, start = None, end = None):
+    """ {pid: set of names} of the processes with a name matching the
+    fnmatch 'pattern' from 'start' to 'end' """
+    found = {}
+    for i in self.range(start, end):
+      for pid, names in self.segment(i).named(pattern).iteritems():
+        found.setdefault(pid, set()).update(names)
+    return found
+
+  def close(self):
+    for s in self.open.itervalues():
+      s.close()
+    self.open = OrderedDict()
+
+def main():
+  ap = argparse.ArgumentParser(description = "Query a segment store written by procrecord.py or procclient.py")
+  ap.add_argument("store", help = "store directory")
+  ap.add_argument("--pid", type = int, help = "print the samples of this process")
+  ap.add_argument("--name", help = "print the processes with a name matching this pattern")
+  ap.add_argument("--start", type = float, help = "seconds from the start of the store")
+  ap.add_argument("--end", type = float, help = "seconds from the start of the store")
+  args = ap.parse_args()
+
+  store = SegmentStore(args.store)
+  if not len(store):
+    print "%s: no finished segments" % args.store
+    return 1
+  origin = store.start_time()
+  start = origin + args.start if args.start is not None else None
+  end = origin + args.end if args.end is not None else None
+  if args.pid is not None:
+    t, uss = store.series(args.pid, start, end)
+    for when, value in zip(t, uss):
+      print "%.3f\t%s" % (when - origin, "gone" if np.isnan(value) else "%.3f" % (value / (1024.0 * 1024)))
+  elif args.name is not None:
+    for pid, names in sorted(store.named(args.name, start, end).iteritems()):
+      print "%u\t%s" % (pid, ", ".join(sorted(names)))
+  else:
+    print "%u segments, %.0f s from %s" % (len(store), store.end_time() - origin,
+                                          time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(origin)))
+  store.close()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
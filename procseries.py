@@ -0,0 +1,66 @@
+""" Per-process USS series, independent of any GUI.
+
+SeriesStore applies decoded report blocks the same way GraphFrame does:
+every block is one time step, every live process gets one sample per step
+(its last value repeated unless the block updates it), and dead processes
+keep their history.
+"""
+from array import array
+
+from procblock import KIND_NEW, KIND_UPDATE, KIND_OLD, merge_snapshot
+
+MB = 1024.0 * 1024.0
+
+class Series:
+  """ The samples of one process, in MB, starting at time step 'xstart' """
+
+  def __init__(self, pid, ppid, name, xstart, uss):
+    self.pid = pid
+    self.ppid = ppid
+    self.name = name
+    self.xstart = xstart
+    self.uss = array('d', [uss])
+    self.alive = True
+
+  def xend(self):
+    """ One past the time step of the last sample """
+    return self.xstart + len(self.uss)
+
+class SeriesStore:
+  """ All series of one device, keyed by PID """
+
+  def __init__(self, device = None):
+    self.device = device
+    self.x = 0            # time step of the next block
+    self.blocks = 0
+    self.series = {}      # pid -> Series, including dead processes
+    self.live = {}        # pid -> Series, live processes only
+
+  def apply(self, batch):
+    """ Advance one time step and apply the records of 'batch' """
+    if batch.sync:
+      batch = merge_snapshot(batch, self.live)
+    self.x += 1
+    self.blocks += 1
+    for s in self.live.itervalues():
+      s.uss.append(s.uss[-1])
+    names = batch.names.names
+    for kind, pid, ppid, uss, name in zip(batch.kind, batch.pid, batch.ppid, batch.uss, batch.name):
+      if kind == KIND_NEW:
+        if pid not in self.live:
+          s = Series(pid, ppid, names[name] if name >= 0 else None, self.x, uss / MB)
+          self.series[pid] = s
+          self.live[pid] = s
+      elif kind == KIND_UPDATE:
+        s = self.live.get(pid)
+        if s:
+          s.uss[-1] = uss / MB
+          if name >= 0:
+            s.name = names[name]
+      elif kind == KIND_OLD:
+        s = self.live.pop(pid, None)
+        if s:
+          # drop this step's repeated sample, the process is gone
+          if len(s.uss) > 1:
+            s.uss.pop()
+          s.alive = False
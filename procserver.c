@@ -1,8 +1,12 @@
 #include <poll.h>
 #include <time.h>
 #include <stdio.h>
+#include <stdlib.h>
+#include <errno.h>
+#include <fcntl.h>
 #include <signal.h>
 #include <stdint.h>
+#include <string.h>
 #include <unistd.h>
 #include <strings.h>
 #include <inttypes.h>
@@ -60,10 +64,12 @@ proc_get_server_socket(int port)
   return s;
 }
 
+static volatile sig_atomic_t tick = 0;
+
 static void
 sig_alrm_handler(int signum)
 {
-  // do nothing
+  tick = 1;
 }
 
 static void
@@ -72,25 +78,450 @@ sig_pipe_handler(int signum)
   // do nothing
 }
 
-int
-main(void)
+typedef struct {
+  char    data[1024];
+  size_t  len;
+} request_buffer;
+
+#define MAX_CLIENTS PROC_MAX_SUBSCRIBERS
+
+#define DEFAULT_INTERVAL_MS 1000
+#define MIN_INTERVAL_MS     10
+#define MAX_INTERVAL_MS     3600000
+#define INTERVAL_STEP_MS    10  // intervals are multiples of this
+
+// what to do with a client that reads slower than blocks are produced
+typedef enum {
+  SLOW_DROP,        // drop its blocks, then resync it with a snapshot
+  SLOW_DISCONNECT   // close its connection
+} SLOW_POLICY;
+
+typedef struct {
+  int             fd;         // -1 if this slot is free
+  proc_subscriber sub;        // format, filters, and what it has been told
+  unsigned        interval;   // ms between blocks
+  uint64_t        next_due;   // CLOCK_MONOTONIC ms of its next block
+  request_buffer  requests;
+  char*           out;        // blocks not yet written to the socket
+  size_t          out_start;
+  size_t          out_len;
+  size_t          out_cap;
+  unsigned        dropped;
+} client_info;
+
+static client_info clients[MAX_CLIENTS];
+static SLOW_POLICY slow_policy = SLOW_DROP;
+static size_t max_pending = 1024 * 1024;
+static unsigned tick_interval = 0;  // ms, 0 if the timer isn't set
+
+static uint64_t
+now_ms(void)
 {
-  struct itimerval new_value;
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return now.tv_sec * 1000ULL + now.tv_nsec / 1000000;
+}
+
+static unsigned
+gcd(unsigned a, unsigned b)
+{
+  while (b) {
+    unsigned r = a % b;
+    a = b;
+    b = r;
+  }
+  return a;
+}
 
+// Tick at the greatest common divisor of the clients' intervals, so every
+// client's blocks fall on exact multiples of the tick.  Intervals are
+// multiples of INTERVAL_STEP_MS, which bounds how fast the timer can go.
+// A new tick starts at the next block due, keeping the clients' cadence.
+static int
+update_timer(void)
+{
+  unsigned interval = 0;
+  int i;
+
+  for (i = 0; i < MAX_CLIENTS; ++i) {
+    if (clients[i].fd != -1) {
+      interval = gcd(clients[i].interval, interval);
+    }
+  }
+  if (!interval) {
+    interval = DEFAULT_INTERVAL_MS;
+  }
+  if (interval == tick_interval) {
+    return 0;
+  }
+  uint64_t now = now_ms();
+  unsigned first = interval;
+  for (i = 0; i < MAX_CLIENTS; ++i) {
+    client_info* c = &clients[i];
+    if (c->fd != -1 && c->next_due > now && c->next_due - now < first) {
+      first = c->next_due - now;
+    }
+  }
+  TRACE("sampling every %u ms", interval);
+  struct itimerval new_value;
   bzero(&new_value, sizeof(new_value));
-  new_value.it_interval.tv_sec = 1;
-  new_value.it_value.tv_sec = 1;
+  new_value.it_interval.tv_sec = interval / 1000;
+  new_value.it_interval.tv_usec = (interval % 1000) * 1000;
+  new_value.it_value.tv_sec = first / 1000;
+  new_value.it_value.tv_usec = (first % 1000) * 1000;
+  if (setitimer(ITIMER_REAL, &new_value, NULL) == -1) {
+    perror("setitimer()");
+    return -1;
+  }
+  tick_interval = interval;
+  return 0;
+}
+
+// Parse "filter|pids=1,2,3|name=pattern|ppid=N"; every field is optional
+// and an empty filter means every process
+static void
+parse_filter(char* fields, proc_subscriber* sub)
+{
+  sub->pid_count = 0;
+  sub->name[0] = '\0';
+  sub->subtree = 0;
+
+  char* field;
+  while ((field = strsep(&fields, "|"))) {
+    if (strncmp(field, "pids=", 5) == 0) {
+      char* pids = field + 5;
+      char* pid;
+      while ((pid = strsep(&pids, ",")) && sub->pid_count < PROC_MAX_FILTER_PIDS) {
+        if (*pid) {
+          sub->pids[sub->pid_count++] = atoi(pid);
+        }
+      }
+    } else if (strncmp(field, "name=", 5) == 0) {
+      snprintf(sub->name, sizeof(sub->name), "%s", field + 5);
+    } else if (strncmp(field, "ppid=", 5) == 0) {
+      sub->subtree = atoi(field + 5);
+    }
+  }
+  // the client's view changes completely; start it over
+  sub->sync = 1;
+}
+
+// Read and act on requests from the client, one per line:
+//
+//   format|binary=1    send blocks in PROC_FORMAT_BINARY from now on
+//   format|binary=0    send blocks in PROC_FORMAT_TEXT from now on
+//   interval|ms=N      send a block every N ms (default 1000); N is rounded
+//                      to a multiple of 10 ms from 10 ms to an hour
+//   filter|pids=1,2|name=pattern|ppid=N
+//                      only report these pids, processes whose name
+//                      matches the fnmatch() pattern, and the process
+//                      subtree under ppid; "filter|" reports everything
+//   resume|stream=S|seq=N
+//                      the client was sent block N of stream S before it
+//                      lost its connection: if that sample is still kept,
+//                      send only what changed since, else a snapshot; sent
+//                      after the other requests
+//
+// Unknown requests are ignored, so clients can probe for features; old
+// servers never read from the client at all.  Returns -1 once the client
+// has closed the connection.
+static int
+proc_read_requests(client_info* c)
+{
+  request_buffer* in = &c->requests;
+  ssize_t n = read(c->fd, in->data + in->len, sizeof(in->data) - in->len - 1);
+  if (n == 0 || (n < 0 && errno != EINTR && errno != EAGAIN)) {
+    return -1;
+  }
+  if (n > 0) {
+    in->len += n;
+  }
+  in->data[in->len] = '\0';
+
+  char* line = in->data;
+  char* eol;
+  while ((eol = strchr(line, '\n'))) {
+    *eol = '\0';
+    TRACE("request: '%s'", line);
+    if (strcmp(line, "format|binary=1") == 0) {
+      c->sub.format = PROC_FORMAT_BINARY;
+    } else if (strcmp(line, "format|binary=0") == 0) {
+      c->sub.format = PROC_FORMAT_TEXT;
+    } else if (strncmp(line, "interval|ms=", 12) == 0) {
+      int ms = atoi(line + 12);
+      unsigned interval = ms < MIN_INTERVAL_MS ? MIN_INTERVAL_MS : (unsigned)ms;
+      if (interval > MAX_INTERVAL_MS) {
+        interval = MAX_INTERVAL_MS;
+      }
+      // round to the nearest step, so the timer can tick at the clients'
+      // common divisor and never faster than every INTERVAL_STEP_MS
+      interval = (interval + INTERVAL_STEP_MS / 2) / INTERVAL_STEP_MS * INTERVAL_STEP_MS;
+      c->interval = interval;
+      c->next_due = 0;
+    } else if (strncmp(line, "filter|", 7) == 0 || strcmp(line, "filter") == 0) {
+      parse_filter(line + 6 + (line[6] == '|'), &c->sub);
+    } else if (strncmp(line, "resume|", 7) == 0) {
+      unsigned stream;
+      unsigned seq;
+      if (sscanf(line, "resume|stream=%u|seq=%u", &stream, &seq) == 2) {
+        if (proc_resume(&c->sub, stream, seq) == 0) {
+          TRACE("client %d resumed after block %u", c->fd, seq);
+        } else {
+          TRACE("client %d can't resume after block %u, sending a snapshot", c->fd, seq);
+        }
+      }
+    }
+    line = eol + 1;
+  }
+  in->len -= line - in->data;
+  if (in->len == sizeof(in->data) - 1) {
+    // a line too long to be a request we know; drop it
+    in->len = 0;
+  }
+  memmove(in->data, line, in->len);
+  return 0;
+}
+
+static void
+client_close(client_info* c)
+{
+  TRACE("closing client %d, %u blocks dropped", c->fd, c->dropped);
+  close(c->fd);
+  free(c->out);
+  free(c->sub.gone);
+  bzero(c, sizeof(*c));
+  c->fd = -1;
+}
+
+static void
+client_open(int fd)
+{
+  int i;
+  for (i = 0; i < MAX_CLIENTS; ++i) {
+    client_info* c = &clients[i];
+    if (c->fd == -1) {
+      fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK);
+      c->fd = fd;
+      c->sub.id = i;
+      c->sub.format = PROC_FORMAT_TEXT;
+      c->sub.sync = 1;
+      c->interval = DEFAULT_INTERVAL_MS;
+      c->next_due = 0;
+      TRACE("client %d connected", fd);
+      return;
+    }
+  }
+  TRACE("too many clients");
+  close(fd);
+}
+
+// Write as much of the client's pending output as the socket takes.
+// Returns -1 if the connection is broken.
+static int
+client_flush(client_info* c)
+{
+  while (c->out_start < c->out_len) {
+    ssize_t n = write(c->fd, c->out + c->out_start, c->out_len - c->out_start);
+    if (n < 0) {
+      if (errno == EINTR) {
+        continue;
+      }
+      if (errno == EAGAIN || errno == EWOULDBLOCK) {
+        break;
+      }
+      perror("write()");
+      return -1;
+    }
+    c->out_start += n;
+  }
+  if (c->out_start == c->out_len) {
+    c->out_start = c->out_len = 0;
+  }
+  return 0;
+}
+
+// Queue a block for the client, applying the slow client policy when too
+// much is already pending.  Returns -1 if the client must be closed.
+static int
+client_send(client_info* c, const char* data, size_t len)
+{
+  size_t pending = c->out_len - c->out_start;
+  if (pending && pending + len > max_pending) {
+    if (slow_policy == SLOW_DISCONNECT) {
+      return -1;
+    }
+    // a dropped block leaves a hole in the client's state, so its next
+    // block will be a snapshot
+    ++c->dropped;
+    c->sub.sync = 1;
+    return 0;
+  }
+  if (c->out_start && c->out_len + len > c->out_cap) {
+    memmove(c->out, c->out + c->out_start, pending);
+    c->out_start = 0;
+    c->out_len = pending;
+  }
+  if (c->out_len + len > c->out_cap) {
+    size_t cap = c->out_cap ? c->out_cap : 64 * 1024;
+    while (cap < c->out_len + len) {
+      cap *= 2;
+    }
+    char* out = realloc(c->out, cap);
+    if (!out) {
+      return -1;
+    }
+    c->out = out;
+    c->out_cap = cap;
+  }
+  memcpy(c->out + c->out_len, data, len);
+  c->out_len += len;
+  c->sub.sync = 0;
+  return client_flush(c);
+}
+
+// Sample once and hand every client that is due the block it needs
+static void
+broadcast(void)
+{
+  proc_subscriber* subs[MAX_CLIENTS];
+  int count = 0;
+  int due = 0;
+  int i;
+
+  uint64_t now = now_ms();
+  for (i = 0; i < MAX_CLIENTS; ++i) {
+    client_info* c = &clients[i];
+    if (c->fd == -1) {
+      continue;
+    }
+    // allow for timer jitter: due within half a tick is due now
+    c->sub.due = now + tick_interval / 2 >= c->next_due;
+    if (c->sub.due) {
+      c->next_due += c->interval;
+      if (c->next_due <= now) {
+        c->next_due = now + c->interval;
+      }
+      ++due;
+    }
+    subs[count++] = &c->sub;
+  }
+  if (!due) {
+    return;
+  }
+
+  struct timespec start;
+  struct timespec end;
+
+  TRACE();
+  clock_gettime(CLOCK_MONOTONIC, &start);
+  proc_sample(subs, count);
+  clock_gettime(CLOCK_MONOTONIC, &end);
+  TRACE();
+
+  if (end.tv_nsec < start.tv_nsec) {
+    end.tv_nsec += 1000000000L;
+    end.tv_sec -= 1;
+  }
+  unsigned long delta = end.tv_sec - start.tv_sec;
+  delta *= 1000000UL;
+  delta += (end.tv_nsec - start.tv_nsec) / 1000;
+  // the timings also travel in every block, see proc_report.c
+  TRACE("---> proc_sample() took %lu us", delta);
+
+  for (i = 0; i < MAX_CLIENTS; ++i) {
+    client_info* c = &clients[i];
+    if (c->fd != -1 && c->sub.due) {
+      size_t len;
+      proc_stamp_write(&c->sub);
+      const char* block = proc_get_block(&c->sub, &len);
+      if (client_send(c, block, len) < 0) {
+        client_close(c);
+      }
+    }
+  }
+}
+
+static void
+usage(const char* argv0)
+{
+  fprintf(stderr,
+          "usage: %s [-c sscanf|smaps|rollup] [-S ms] [-b rounds] [-s drop|disconnect] [-m kB]\n"
+          "          [-r samples]\n"
+          "  -c  how to read USS from /proc (default: rollup, falling back to smaps)\n"
+          "  -S  re-read smaps at least every 'ms', even if statm hasn't changed\n"
+          "      (default: %u; 0 reads smaps on every sample)\n"
+          "  -b  time 'rounds' scans with every collector, print the results and exit\n"
+          "  -s  what to do with a client that falls behind (default: drop its blocks\n"
+          "      until it catches up, then send it a snapshot)\n"
+          "  -m  how much output a client may have pending before it is behind\n"
+          "      (default: 1024 kB)\n"
+          "  -r  how many samples to keep for clients resuming a lost connection\n"
+          "      (default: %u; 0 sends them a snapshot)\n",
+          argv0, PROC_DEFAULT_MAX_STALENESS, PROC_DEFAULT_HISTORY);
+}
+
+int
+main(int argc, char* argv[])
+{
+  int opt;
+  int i;
+
+  while ((opt = getopt(argc, argv, "c:S:b:s:m:r:h")) != -1) {
+    switch (opt) {
+      case 'c':
+        if (strcmp(optarg, "sscanf") == 0) {
+          proc_set_collector(PROC_COLLECT_SSCANF);
+        } else if (strcmp(optarg, "smaps") == 0) {
+          proc_set_collector(PROC_COLLECT_SMAPS);
+        } else if (strcmp(optarg, "rollup") == 0) {
+          proc_set_collector(PROC_COLLECT_ROLLUP);
+        } else {
+          usage(argv[0]);
+          return __LINE__;
+        }
+        break;
+
+      case 'S':
+        proc_set_max_staleness(atoi(optarg));
+        break;
+
+      case 'b':
+        return proc_benchmark_collectors(atoi(optarg)) == 0 ? 0 : __LINE__;
+
+      case 's':
+        if (strcmp(optarg, "drop") == 0) {
+          slow_policy = SLOW_DROP;
+        } else if (strcmp(optarg, "disconnect") == 0) {
+          slow_policy = SLOW_DISCONNECT;
+        } else {
+          usage(argv[0]);
+          return __LINE__;
+        }
+        break;
+
+      case 'm':
+        max_pending = (size_t)atoi(optarg) * 1024;
+        break;
+
+      case 'r':
+        proc_set_history(atoi(optarg));
+        break;
+
+      default:
+        usage(argv[0]);
+        return __LINE__;
+    }
+  }
+
+  for (i = 0; i < MAX_CLIENTS; ++i) {
+    clients[i].fd = -1;
+  }
 
   int server = proc_get_server_socket(26600);
   if (server < 0) {
     return __LINE__;
   }
 
-  struct pollfd pfds[2];
-  pfds[0].fd = server;
-  pfds[0].events = POLLIN;
-  pfds[1].events = POLLHUP | POLLPRI | POLLERR | POLLNVAL | POLLMSG | POLLREMOVE | POLLRDHUP | POLLRDBAND| POLLWRBAND;
-
   if (signal(SIGALRM, sig_alrm_handler) == SIG_ERR) {
     perror("signal()");
     return __LINE__;
@@ -100,98 +531,68 @@ main(void)
     return __LINE__;
   }
 
-  int client = -1;
-  int nfds = 1;
-  int sync = 1;
+  // sample once a second, or as often as the clients' intervals need,
+  // whenever there is anyone to send to
+  if (update_timer() < 0) {
+    return __LINE__;
+  }
+
+  struct pollfd pfds[1 + MAX_CLIENTS];
+  client_info* polled[1 + MAX_CLIENTS];
 
   while (1) {
     TRACE("----------\n");
+    int nfds = 1;
+    pfds[0].fd = server;
+    pfds[0].events = POLLIN;
     pfds[0].revents = 0;
-    if (client != -1) {
-      TRACE();
-      nfds = 2;
-      pfds[1].fd = client;
-      pfds[1].revents = 0;
-    } else {
-      TRACE();
-      nfds = 1;
+    for (i = 0; i < MAX_CLIENTS; ++i) {
+      client_info* c = &clients[i];
+      if (c->fd != -1) {
+        pfds[nfds].fd = c->fd;
+        pfds[nfds].events = POLLIN | POLLHUP | POLLRDHUP;
+        if (c->out_len > c->out_start) {
+          pfds[nfds].events |= POLLOUT;
+        }
+        pfds[nfds].revents = 0;
+        polled[nfds] = c;
+        ++nfds;
+      }
     }
 
     TRACE();
     int rv = poll(pfds, nfds, -1 /* INFTIM */);
-    if (rv < 0) {
-      TRACE();
-      if (client == -1 || errno != EINTR) {
-        perror("poll()");
-        return __LINE__;
-      }
+    if (rv < 0 && errno != EINTR) {
+      perror("poll()");
+      return __LINE__;
     }
 
-    int new_client = -1;
-    TRACE();
-    if ((pfds[0].revents & POLLIN) == POLLIN) {
-      int fd = accept(server, NULL, 0);
-      TRACE();
-      if (client != -1) {
-        TRACE();
-        close(fd);
-      } else {
-        TRACE();
-        new_client = fd;
-        bzero(&new_value, sizeof(new_value));
-        new_value.it_interval.tv_sec = 1;
-        new_value.it_value.tv_sec = 1;
-        if (setitimer(ITIMER_REAL, &new_value, NULL) == -1) {
-          perror("setitimer()");
-          return __LINE__;
-        }
-      }
-    }
-    if (client != -1) {
-      TRACE("pfds[1].revents = 0x%x", pfds[1].revents);
-      if (pfds[1].revents & (POLLHUP | POLLRDHUP)) {
-        TRACE();
-        bzero(&new_value, sizeof(new_value));
-        if (setitimer(ITIMER_REAL, &new_value, NULL) == -1) {
-          perror("setitimer()");
-          return __LINE__;
-        }
-        close(client);
-        client = -1;
+    for (i = 1; rv > 0 && i < nfds; ++i) {
+      client_info* c = polled[i];
+      TRACE("client %d revents = 0x%x", c->fd, pfds[i].revents);
+      if (pfds[i].revents & (POLLHUP | POLLRDHUP | POLLERR | POLLNVAL)) {
+        client_close(c);
+      } else if ((pfds[i].revents & POLLIN) && proc_read_requests(c) < 0) {
+        client_close(c);
+      } else if ((pfds[i].revents & POLLOUT) && client_flush(c) < 0) {
+        client_close(c);
       }
     }
-        
-    if (client != -1) {
-      TRACE();
-      write(client, ">>>\n", 4);
-      TRACE();
-
-      struct timespec start;
-      struct timespec end;
 
+    if (rv > 0 && (pfds[0].revents & POLLIN)) {
+      int fd = accept(server, NULL, 0);
       TRACE();
-      clock_gettime(CLOCK_MONOTONIC, &start);
-      proc_write_report(client, sync);
-      sync = 0;
-      clock_gettime(CLOCK_MONOTONIC, &end);
-      TRACE();
-
-      if (end.tv_nsec < start.tv_nsec) {
-        end.tv_nsec += 1000000000L;
-        end.tv_sec -= 1;
+      if (fd != -1) {
+        client_open(fd);
       }
-      unsigned long delta = end.tv_sec - start.tv_sec;
-      delta *= 1000000UL;
-      delta += (end.tv_nsec - start.tv_nsec) / 1000;
-      printf("---> proc_write_report() took %lu us\n", delta);
+    }
 
-      TRACE();
-      write(client, "<<<\n", 4);
-      TRACE();
+    if (tick) {
+      tick = 0;
+      broadcast();
     }
-    if (new_client != -1) {
-      client = new_client;
-      sync = 1;
+    if (update_timer() < 0) {
+      return __LINE__;
     }
   }
 
@@ -0,0 +1,411 @@
+#!/usr/bin/python
+""" A procserver for this host, in Python.
+
+Speaks the same protocol as procserver.c over the local Linux /proc: every
+client gets a snapshot of the live processes on connect ('sync'), then a
+block of new/update/old records per sample, in text or, if it asks, in the
+binary framing.  'interval|ms=N' and 'filter|pids=..|name=..|ppid=..'
+requests are honoured per client, as are the slow client policies.
+
+Blocks are numbered by sample ('seq') within a stream, the life of one
+server, which has a random id ('stream').  The last HISTORY samples are
+kept, so a client that lost its connection can send 'resume|stream=S|seq=N'
+after its other requests: if sample N of this stream is still known, the
+client is sent only what changed since then rather than a snapshot.
+
+Processes are read by a pool of worker processes (or threads, with
+--threads), so a host with thousands of processes can be sampled several
+times a second.  Use it to run procclient without a device, as the
+reference server for protocol tests, or as a load source for benchmarks.
+
+usage: procserver.py [-p 26600] [--workers N] [--threads] [-s drop|disconnect] [-m kB] [--history N]
+"""
+import os
+import re
+import sys
+import time
+import errno
+import random
+import select
+import fnmatch
+import argparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from socket import *
+from fractions import gcd
+from collections import deque
+
+from procblock import KIND_NEW, KIND_UPDATE, KIND_OLD, NameTable, ReportBatch, \
+                      encode_text, encode_binary
+
+DEFAULT_PORT = 26600
+DEFAULT_INTERVAL = 1000     # ms
+MIN_INTERVAL = 10
+MAX_INTERVAL = 3600 * 1000
+INTERVAL_STEP = 10          # intervals are rounded to multiples of this
+HISTORY = 64                # samples a client can resume from
+
+PRIVATE = re.compile(r'^Private_(?:Clean|Dirty):\s+(\d+) kB', re.M)
+
+def read_file(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+def read_uss(pid):
+  """ USS of 'pid' in bytes, from smaps_rollup if the kernel has it """
+  try:
+    data = read_file("/proc/%u/smaps_rollup" % pid)
+  except IOError, e:
+    if e.errno != errno.ENOENT:
+      raise
+    data = read_file("/proc/%u/smaps" % pid)
+  return sum(int(kb) for kb in PRIVATE.findall(data)) * 1024
+
+def read_process(pid):
+  """ (pid, ppid, uss, name) of a process, None if it can't be read """
+  try:
+    stat = read_file("/proc/%u/stat" % pid)
+    name = read_file("/proc/%u/comm" % pid).rstrip(b'\n')
+    uss = read_uss(pid)
+  except (IOError, OSError):
+    return None
+  # the name in stat is in parentheses and may contain anything
+  ppid = int(stat[stat.rindex(b')') + 2:].split(None, 2)[1])
+  return pid, ppid, uss, name
+
+def read_processes(pids):
+  """ Worker: read a chunk of processes """
+  return filter(None, map(read_process, pids))
+
+class Scanner:
+  """ Read every process in /proc with a pool of workers """
+
+  def __init__(self, workers = None, threads = False):
+    workers = workers or multiprocessing.cpu_count()
+    self.workers = workers
+    self.pool = ThreadPool(workers) if threads else multiprocessing.Pool(workers)
+
+  def scan(self):
+    """ Return {pid: (ppid, uss, name)} for every readable process """
+    pids = [int(d) for d in os.listdir("/proc") if d.isdigit()]
+    # a few chunks per worker evens out processes with huge smaps
+    size = max(1, len(pids) // (self.workers * 4))
+    chunks = [pids[i:i + size] for i in xrange(0, len(pids), size)]
+    processes = {}
+    for chunk in self.pool.map(read_processes, chunks):
+      for pid, ppid, uss, name in chunk:
+        processes[pid] = (ppid, uss, name)
+    return processes
+
+  def close(self):
+    self.pool.terminate()
+    self.pool.join()
+
+class History:
+  """ The latest samples of a stream, by seq """
+
+  def __init__(self, size = HISTORY):
+    self.stream = random.getrandbits(32) or 1   # 0 is none on the wire
+    self.samples = deque(maxlen = size)   # (seq, {pid: (ppid, uss, name)})
+    self.seq = 0                          # of the next sample
+
+  def add(self, processes):
+    """ Keep a sample, return its seq """
+    seq = self.seq
+    self.samples.append((seq, processes))
+    self.seq += 1
+    return seq
+
+  def get(self, stream, seq):
+    """ The processes of sample 'seq' of 'stream', None if not kept """
+    if stream != self.stream or not self.samples:
+      return None
+    first = self.samples[0][0]
+    if seq < first or seq > self.samples[-1][0]:
+      return None
+    return self.samples[seq - first][1]
+
+class Client:
+  """ One connection: its requests, its view of the processes, its output """
+
+  def __init__(self, sock, names, history = None):
+    self.socket = sock
+    self.names = names
+    self.history = history
+    self.binary = False
+    self.interval = DEFAULT_INTERVAL
+    self.next_due = 0.0
+    self.pids = set()
+    self.name = None
+    self.subtree = None
+    self.sent = {}          # pid -> (uss, name), what this client was told
+    self.sync = True        # the next block must be a snapshot
+    self.seq = 0            # of the next block, unless the server numbers them
+    self.resumed = False    # the client resumed an earlier connection
+    self.requests = b''
+    self.out = bytearray()
+    self.dropped = 0
+
+  def fileno(self):
+    return self.socket.fileno()
+
+  def handle_request(self, line):
+    """ Act on one request line; see procserver.c for the list """
+    fields = line.split(b'|')
+    if line == b'format|binary=1':
+      self.binary = True
+    elif line == b'format|binary=0':
+      self.binary = False
+    elif line.startswith(b'interval|ms='):
+      try:
+        interval = min(max(int(line[12:]), MIN_INTERVAL), MAX_INTERVAL)
+      except ValueError:
+        return
+      self.interval = (interval + INTERVAL_STEP // 2) // INTERVAL_STEP * INTERVAL_STEP
+      self.next_due = 0.0
+    elif fields[0] == b'filter':
+      pids = set()
+      name = None
+      subtree = None
+      try:
+        for field in fields[1:]:
+          key, sep, value = field.partition(b'=')
+          if key == b'pids':
+            pids = set(int(p) for p in value.split(b',') if p)
+          elif key == b'name' and value:
+            name = value
+          elif key == b'ppid' and value:
+            subtree = int(value)
+      except ValueError:
+        return
+      self.pids = pids
+      self.name = name
+      self.subtree = subtree
+      self.sync = True
+    elif fields[0] == b'resume':
+      values = dict(field.partition(b'=')[::2] for field in fields[1:])
+      try:
+        self.resume(int(values[b'stream']), int(values[b'seq']))
+      except (KeyError, ValueError):
+        pass
+
+  def resume(self, stream, seq):
+    """ Carry on from block 'seq' of 'stream', as the client of an earlier
+    connection: it knows the processes of that sample it watches, so it
+    only needs the changes since.  If the sample is no longer kept, the
+    next block is a snapshot as for any new client. """
+    processes = self.history.get(stream, seq) if self.history is not None else None
+    if processes is None:
+      return
+    self.sent = dict((pid, info[1:]) for pid, info in processes.iteritems() if self.watches(pid, processes))
+    self.sync = False
+    self.resumed = True
+
+  def watches(self, pid, processes):
+    if not self.pids and not self.name and not self.subtree:
+      return True
+    if pid in self.pids:
+      return True
+    if self.name and fnmatch.fnmatchcase(processes[pid][2], self.name):
+      return True
+    if self.subtree:
+      for depth in xrange(64):
+        if pid == self.subtree:
+          return True
+        info = processes.get(pid)
+        if not info or info[0] == pid:
+          break
+        pid = info[0]
+    return False
+
+  def block(self, processes, server_time, server_end = None, seq = None, stream = None):
+    """ Encode what changed for this client since its previous block
+
+    'server_time' and 'server_end' are when the sample started and ended;
+    the block is stamped as written now.  'seq' is the sample's number in
+    'stream', by default the number of blocks sent to this client.
+    """
+    batch = ReportBatch(self.names)
+    batch.server_time = server_time
+    batch.server_end = server_end
+    if seq is None:
+      seq = self.seq
+    batch.seq = seq
+    batch.stream = stream
+    self.seq = seq + 1
+    batch.sync = self.sync
+    batch.parsed = len(processes)
+    batch.skipped = 0
+    previous = {} if self.sync else self.sent
+    sent = {}
+    intern = self.names.intern
+    for pid in sorted(processes):
+      if not self.watches(pid, processes):
+        continue
+      ppid, uss, name = processes[pid]
+      sent[pid] = (uss, name)
+      last = previous.get(pid)
+      if last is None:
+        batch.add(KIND_NEW, pid, ppid, uss, intern(name))
+      elif last[1] != name:
+        batch.add(KIND_UPDATE, pid, 0, uss, intern(name))
+      elif last[0] != uss:
+        batch.add(KIND_UPDATE, pid, 0, uss)
+    # gone, or no longer watched
+    for pid in sorted(previous):
+      if pid not in sent:
+        batch.add(KIND_OLD, pid)
+    self.sent = sent
+    self.sync = False
+    batch.server_write = time.time()
+    return (encode_binary if self.binary else encode_text)(batch)
+
+class ProcServer:
+  """ Accept clients and sample for them, all on one thread """
+
+  def __init__(self, scanner, port = DEFAULT_PORT, slow = "drop", max_pending = 1024 * 1024,
+               verbose = False, history = HISTORY):
+    self.scanner = scanner
+    self.history = History(history)
+    self.slow = slow
+    self.max_pending = max_pending
+    self.verbose = verbose
+    self.names = NameTable()
+    self.clients = []
+    self.listener = socket(AF_INET, SOCK_STREAM)
+    self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    self.listener.bind(("", port))
+    self.listener.listen(8)
+    self.keep_going = True
+
+  def tick_interval(self):
+    """ The greatest common divisor of the clients' intervals, in seconds,
+    so every client's blocks fall on exact multiples of the tick """
+    return (reduce(gcd, [c.interval for c in self.clients], 0) or DEFAULT_INTERVAL) / 1000.0
+
+  def close_client(self, c):
+    if self.verbose:
+      print "closing client %d, %u blocks dropped%s" % \
+            (c.fileno(), c.dropped, ", had resumed" if c.resumed else "")
+    self.clients.remove(c)
+    c.socket.close()
+
+  def send(self, c, data):
+    """ Queue a block, applying the slow client policy """
+    if c.out and len(c.out) + len(data) > self.max_pending:
+      if self.slow == "disconnect":
+        self.close_client(c)
+        return
+      c.dropped += 1
+      c.sync = True
+      return
+    c.out += data
+    self.flush(c)
+
+  def flush(self, c):
+    try:
+      n = c.socket.send(c.out)
+      del c.out[:n]
+    except error, e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        self.close_client(c)
+
+  def read_requests(self, c):
+    try:
+      data = c.socket.recv(4096)
+    except error, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      data = b''
+    if not data:
+      self.close_client(c)
+      return
+    lines = (c.requests + data).split(b'\n')
+    c.requests = lines.pop()[-1024:]
+    for line in lines:
+      c.handle_request(line)
+
+  def sample(self):
+    now = time.time()
+    tick = self.tick_interval()
+    due = [c for c in self.clients if now + tick / 2 >= c.next_due]
+    if not due:
+      return
+    for c in due:
+      c.next_due += c.interval / 1000.0
+      if c.next_due <= now:
+        c.next_due = now + c.interval / 1000.0
+    processes = self.scanner.scan()
+    seq = self.history.add(processes)
+    end = time.time()
+    if self.verbose:
+      print "---> scan of %u processes took %.0f us" % (len(processes), 1e6 * (end - now))
+    for c in due:
+      # a 'disconnect' policy may have closed it meanwhile
+      if c in self.clients:
+        self.send(c, c.block(processes, now, end, seq, self.history.stream))
+
+  def serve_forever(self):
+    next_tick = time.time()
+    tick = self.tick_interval()
+    while self.keep_going:
+      if tick != self.tick_interval():
+        # a new tick starts at the next block due, keeping the cadence
+        tick = self.tick_interval()
+        now = time.time()
+        next_tick = min([c.next_due for c in self.clients if c.next_due > now] + [now + tick])
+      timeout = max(0.0, next_tick - time.time())
+      writers = [c for c in self.clients if c.out]
+      readable, writable, x = select.select([self.listener] + self.clients, writers, [], timeout)
+      for c in writable:
+        if c in self.clients:
+          self.flush(c)
+      for r in readable:
+        if r is self.listener:
+          sock, address = self.listener.accept()
+          sock.setblocking(0)
+          self.clients.append(Client(sock, self.names, self.history))
+          if self.verbose:
+            print "client %d connected from %s:%d" % ((sock.fileno(),) + address)
+        elif r in self.clients:
+          self.read_requests(r)
+      if time.time() >= next_tick:
+        self.sample()
+        next_tick += tick
+        if next_tick < time.time():
+          next_tick = time.time() + tick
+
+  def close(self):
+    for c in list(self.clients):
+      self.close_client(c)
+    self.listener.close()
+
+def main():
+  ap = argparse.ArgumentParser(description = "Serve this host's /proc like procserver")
+  ap.add_argument("-p", "--port", type = int, default = DEFAULT_PORT)
+  ap.add_argument("--workers", type = int, help = "scanning workers (default: one per CPU)")
+  ap.add_argument("--threads", action = "store_true", help = "scan with threads instead of processes")
+  ap.add_argument("-s", "--slow", choices = ("drop", "disconnect"), default = "drop",
+                  help = "what to do with a client that falls behind")
+  ap.add_argument("-m", "--max-pending", type = int, default = 1024, metavar = "KB",
+                  help = "output a client may have pending before it is behind")
+  ap.add_argument("--history", type = int, default = HISTORY, metavar = "N",
+                  help = "samples kept for clients resuming a lost connection")
+  ap.add_argument("-v", "--verbose", action = "store_true")
+  args = ap.parse_args()
+
+  scanner = Scanner(args.workers, args.threads)
+  server = ProcServer(scanner, args.port, args.slow, args.max_pending * 1024, args.verbose, args.history)
+  print "Serving /proc on port %d with %u %s" % \
+        (args.port, scanner.workers, "threads" if args.threads else "worker processes")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+    scanner.close()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
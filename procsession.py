@@ -0,0 +1,338 @@
+""" Recorded procserver sessions.
+
+A session file is append-only:
+
+  file header    '<4sHH'      magic 'PRSN', version, reserved
+  record*        '<IBxxxdd'   payload length, record type, time, receive time
+                 payload      zlib-compressed packed batch
+
+'time' is the server's wall clock time of the sample when the server sends
+it, the receive time otherwise.  BLOCK records hold one report block as
+received.  Every 'keyframe_interval' blocks a KEYFRAME record follows,
+holding the full set of live processes (as 'new' records) after that
+block, so a reader can start anywhere without replaying from the start.
+
+Next to each session file, '<file>.idx' holds one fixed-size entry
+('<dQBxxxI': time, offset, record type, payload length) per record.
+
+A packed batch is '<II' (records, names), then the kind, pid, ppid, uss and
+name columns as little-endian arrays, then each name as '<H' length and
+bytes.  Name indices are local to the record.
+
+This module must not import any GUI code.
+"""
+import os
+import sys
+import mmap
+import time
+import zlib
+import struct
+from array import array
+from threading import Thread
+
+from procblock import KIND_NEW, KIND_UPDATE, KIND_OLD, NO_NAME, NameTable, ReportBatch, \
+                      merge_snapshot
+
+MAGIC = b'PRSN'
+VERSION = 1
+
+FILE_HEADER = struct.Struct('<4sHH')
+RECORD_HEADER = struct.Struct('<IBxxxdd')
+INDEX_ENTRY = struct.Struct('<dQBxxxI')
+PAYLOAD_HEADER = struct.Struct('<II')
+NAME_LENGTH = struct.Struct('<H')
+
+RECORD_BLOCK = 1
+RECORD_KEYFRAME = 2
+
+DEFAULT_KEYFRAME_INTERVAL = 60
+
+def to_le(a):
+  """ Return the bytes of array 'a' in little-endian order """
+  if sys.byteorder != 'little':
+    a = array(a.typecode, a)
+    a.byteswap()
+  return a.tostring()
+
+def pack_batch(batch):
+  """ Serialize a ReportBatch, see the module docstring """
+  local = {}
+  names = []
+  ids = array('i')
+  table = batch.names.names
+  for n in batch.name:
+    if n < 0:
+      ids.append(NO_NAME)
+      continue
+    i = local.get(n)
+    if i is None:
+      i = local[n] = len(names)
+      names.append(table[n])
+    ids.append(i)
+  parts = [PAYLOAD_HEADER.pack(len(batch), len(names)),
+           to_le(batch.kind), to_le(batch.pid), to_le(batch.ppid),
+           to_le(batch.uss), to_le(ids)]
+  for name in names:
+    parts.append(NAME_LENGTH.pack(len(name)))
+    parts.append(name)
+  return b''.join(parts)
+
+class SessionWriter:
+  """ Append decoded report blocks to a session file """
+
+  def __init__(self, path, keyframe_interval = DEFAULT_KEYFRAME_INTERVAL, level = 6):
+    self.path = path
+    self.file = open(path, 'wb')
+    self.index = open(path + '.idx', 'wb')
+    self.file.write(FILE_HEADER.pack(MAGIC, VERSION, 0))
+    self.offset = FILE_HEADER.size
+    self.keyframe_interval = keyframe_interval
+    self.level = level
+    self.blocks = 0
+    self.state = {}   # pid -> [ppid, uss, name], the live processes
+
+  def write(self, batch, receive_time):
+    """ Record one ReportBatch received at 'receive_time' """
+    if batch.sync:
+      # record what changed, so blocks always apply on top of each other
+      batch = merge_snapshot(batch, self.state)
+    t = batch.server_time
+    if t is None:
+      t = receive_time
+    self.append(RECORD_BLOCK, t, receive_time, pack_batch(batch))
+    self.track(batch)
+    self.blocks += 1
+    if self.keyframe_interval and self.blocks % self.keyframe_interval == 0:
+      self.append(RECORD_KEYFRAME, t, receive_time, pack_batch(self.keyframe(batch.names)))
+    self.file.flush()
+    self.index.flush()
+
+  def append(self, type, t, receive_time, payload):
+    payload = zlib.compress(payload, self.level)
+    self.file.write(RECORD_HEADER.pack(len(payload), type, t, receive_time))
+    self.file.write(payload)
+    self.index.write(INDEX_ENTRY.pack(t, self.offset, type, len(payload)))
+    self.offset += RECORD_HEADER.size + len(payload)
+
+  def track(self, batch):
+    """ Keep the set of live processes up to date for keyframes """
+    state = self.state
+    table = batch.names.names
+    for kind, pid, ppid, uss, name in zip(batch.kind, batch.pid, batch.ppid, batch.uss, batch.name):
+      if kind == KIND_NEW:
+        state[pid] = [ppid, uss, table[name] if name >= 0 else None]
+      elif kind == KIND_UPDATE:
+        info = state.get(pid)
+        if info:
+          info[1] = uss
+          if name >= 0:
+            info[2] = table[name]
+      elif kind == KIND_OLD:
+        state.pop(pid, None)
+
+  def keyframe(self, names):
+    batch = ReportBatch(names)
+    for pid in sorted(self.state):
+      ppid, uss, name = self.state[pid]
+      batch.add(KIND_NEW, pid, ppid, uss, names.intern(name) if name is not None else NO_NAME)
+    return batch
+
+  def close(self):
+    self.file.close()
+    self.index.close()
+
+def from_le(typecode, data):
+  a = array(typecode)
+  a.fromstring(data)
+  if sys.byteorder != 'little':
+    a.byteswap()
+  return a
+
+def unpack_batch(payload, names):
+  """ Deserialize a packed batch, interning its names into 'names' """
+  n, count = PAYLOAD_HEADER.unpack_from(payload)
+  pos = PAYLOAD_HEADER.size
+  batch = ReportBatch(names)
+  for attr, typecode in (('kind', 'b'), ('pid', 'i'), ('ppid', 'i'), ('uss', 'd'), ('name', 'i')):
+    size = n * array(typecode).itemsize
+    setattr(batch, attr, from_le(typecode, payload[pos:pos + size]))
+    pos += size
+  local = []
+  for i in xrange(count):
+    length, = NAME_LENGTH.unpack_from(payload, pos)
+    pos += NAME_LENGTH.size
+    local.append(names.intern(payload[pos:pos + length]))
+    pos += length
+  if local:
+    batch.name = array('i', [local[i] if i >= 0 else NO_NAME for i in batch.name])
+  return batch
+
+class SessionReader:
+  """ Random access to a session file through mmap
+
+  Nothing is read up front but the index; records are decompressed only
+  when asked for, so opening even a multi-day capture is immediate.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, 'rb')
+    self.data = mmap_file(self.file)
+    if self.data is None or len(self.data) < FILE_HEADER.size:
+      raise IOError("%s: not a session file" % path)
+    magic, version, reserved = FILE_HEADER.unpack_from(self.data)
+    if magic != MAGIC or version != VERSION:
+      raise IOError("%s: not a version %u session file" % (path, VERSION))
+    self.index = None
+    self.count = 0
+    try:
+      self.index_file = open(path + '.idx', 'rb')
+      self.index = mmap_file(self.index_file)
+    except IOError:
+      self.index_file = None
+    if self.index is not None:
+      self.count = len(self.index) // INDEX_ENTRY.size
+      # ignore a record the writer hadn't finished when this was opened
+      while self.count:
+        t, offset, type, length = self.entry(self.count - 1)
+        if offset + RECORD_HEADER.size + length <= len(self.data):
+          break
+        self.count -= 1
+    else:
+      self.rebuild_index()
+
+  def rebuild_index(self):
+    """ Index the records by walking their headers (no .idx file) """
+    entries = []
+    offset = FILE_HEADER.size
+    while offset + RECORD_HEADER.size <= len(self.data):
+      length, type, t, receive_time = RECORD_HEADER.unpack_from(self.data, offset)
+      if offset + RECORD_HEADER.size + length > len(self.data):
+        break
+      entries.append(INDEX_ENTRY.pack(t, offset, type, length))
+      offset += RECORD_HEADER.size + length
+    self.index = b''.join(entries)
+    self.count = len(entries)
+
+  def __len__(self):
+    return self.count
+
+  def entry(self, i):
+    """ (time, offset, record type, payload length) of record 'i' """
+    return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+
+  def time(self, i):
+    return self.entry(i)[0]
+
+  def start_time(self):
+    return self.time(0) if self.count else None
+
+  def end_time(self):
+    return self.time(self.count - 1) if self.count else None
+
+  def find(self, t):
+    """ Index of the first record at or after time 't' (binary search) """
+    lo = 0
+    hi = self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.time(mid) < t:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def read(self, i, names):
+    """ Decode record 'i' into a ReportBatch """
+    t, offset, type, length = self.entry(i)
+    start = offset + RECORD_HEADER.size
+    batch = unpack_batch(zlib.decompress(self.data[start:start + length]), names)
+    batch.server_time = t
+    return batch
+
+  def keyframe_before(self, t):
+    """ Index of the last keyframe at or before 't', or -1 if none """
+    i = self.find(t)
+    # the keyframe sharing a block's time follows that block
+    while i < self.count and self.time(i) == t:
+      i += 1
+    i -= 1
+    while i >= 0 and self.entry(i)[2] != RECORD_KEYFRAME:
+      i -= 1
+    return i
+
+  def batches(self, names, start = None):
+    """ Yield (catch_up, batch) for the stream as seen from time 'start'
+
+    The consumer starts from an empty state.  When 'start' is given,
+    the nearest keyframe before it and the blocks between that keyframe
+    and 'start' come first, with catch_up True; the batches of the
+    requested range follow with catch_up False.  Keyframes in the middle
+    of the stream are skipped, since blocks already carry the changes.
+    """
+    i = 0
+    if start is not None:
+      k = self.keyframe_before(start)
+      if k >= 0:
+        yield True, self.read(k, names)
+        i = k + 1
+    for j in xrange(i, self.count):
+      t, offset, type, length = self.entry(j)
+      if type != RECORD_BLOCK:
+        continue
+      yield start is not None and t < start, self.read(j, names)
+
+  def close(self):
+    if self.index_file:
+      self.index.close()
+      self.index_file.close()
+    self.data.close()
+    self.file.close()
+
+def mmap_file(f):
+  """ Map all of 'f' read-only, None if it is empty """
+  size = os.fstat(f.fileno()).st_size
+  if not size:
+    return None
+  return mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ)
+
+class SessionPlayer(Thread):
+  """ Replay a recorded session into post_data(), like SocketThread
+
+  'speed' is a multiple of real time; 0 replays as fast as possible.
+  Blocks before 'start' are delivered immediately to rebuild the state
+  at that time, pacing begins from there.  Subclasses override
+  post_data() to hand batches to their consumer.
+  """
+
+  def __init__(self, path, speed = 1.0, start = None):
+    Thread.__init__(self)
+    self.daemon = True
+    self.reader = SessionReader(path)
+    self.speed = speed
+    self.start_time = start
+    self.keep_going = True
+
+  def stop(self):
+    self.keep_going = False
+
+  def run(self):
+    names = NameTable()
+    origin = None
+    for catch_up, batch in self.reader.batches(names, self.start_time):
+      if not self.keep_going:
+        break
+      if self.speed > 0 and not catch_up:
+        if origin is None:
+          origin = (batch.server_time, time.time())
+        delay = (batch.server_time - origin[0]) / self.speed - (time.time() - origin[1])
+        if delay > 0:
+          time.sleep(delay)
+      self.post_data(batch)
+    self.finished()
+
+  def post_data(self, batch):
+    pass
+
+  def finished(self):
+    pass
@@ -0,0 +1,284 @@
+""" Incremental framing of the procserver report stream.
+
+Two framings share the stream.  A text block is the lines between a '>>>'
+and a '<<<' marker line.  A binary block, sent once the client has asked
+for it with BINARY_REQUEST, is '>>>B', the little-endian u32 length of the
+payload, then the payload; see procblock.decode_binary().
+
+This module has no wx/matplotlib dependency so it can be shared by the GUI,
+headless tools and benchmarks.
+"""
+import os
+import time
+import errno
+import struct
+from socket import socket, error, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_KEEPALIVE
+
+from procblock import NameTable, decode_block
+
+MARK = b'>>>'   # start of any block
+SOB = b'>>>\n'  # start-of-block marker line
+EOB = b'<<<\n'  # end-of-block marker line
+BINARY = ord('B')  # follows MARK in a binary frame
+FRAME_LENGTH = struct.Struct('<I')
+
+# sent by clients after connecting; servers that don't know it ignore it
+# and keep sending text
+BINARY_REQUEST = b'format|binary=1\n'
+
+def interval_request(ms):
+  """ Ask the server for a block every 'ms' milliseconds; servers round it
+  to a multiple of 10 ms from 10 ms to an hour """
+  return b'interval|ms=%u\n' % ms
+
+def filter_request(pids = None, name = None, ppid = None):
+  """ Ask the server to report only the given PIDs, the processes whose
+  name matches the fnmatch pattern 'name', and the subtree under 'ppid';
+  with no arguments, every process is reported again """
+  fields = [b'filter']
+  if pids:
+    fields.append(b'pids=' + b','.join(b'%u' % pid for pid in pids))
+  if name:
+    fields.append(b'name=' + name)
+  if ppid:
+    fields.append(b'ppid=%u' % ppid)
+  return b'|'.join(fields) + b'\n'
+
+def resume_request(stream, seq):
+  """ Ask the server for the changes since block 'seq' of 'stream', the
+  last one received before the connection was lost; sent after the other
+  requests.  Servers that can't resume send a snapshot instead. """
+  return b'resume|stream=%u|seq=%u\n' % (stream, seq)
+
+def add_subscription_arguments(ap):
+  """ Add --interval, --pids, --name and --subtree to an ArgumentParser """
+  ap.add_argument("--interval", type = int, metavar = "MS", help = "ask for a block every MS milliseconds (a multiple of 10)")
+  ap.add_argument("--pids", type = lambda s: [int(p) for p in s.split(",")],
+                  help = "only report these comma separated PIDs")
+  ap.add_argument("--name", help = "only report processes whose name matches this pattern")
+  ap.add_argument("--subtree", type = int, metavar = "PPID", help = "only report PPID and its descendants")
+
+def subscription_requests(args):
+  """ The requests for the options added by add_subscription_arguments() """
+  requests = []
+  if args.interval:
+    requests.append(interval_request(args.interval))
+  if args.pids or args.name or args.subtree:
+    requests.append(filter_request(args.pids, args.name, args.subtree))
+  return requests
+
+DEFAULT_RECV_SIZE = 64 * 1024
+
+# seconds between attempts to reconnect, doubling after each failure
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+
+class BlockParser:
+  """ Split a raw procserver byte stream into complete report blocks
+
+  Bytes are appended to a single growable bytearray and every byte is
+  scanned once, no matter how the stream is chunked, so the cost of
+  framing is linear in the amount of data received.  Each complete
+  block is returned as a byte string holding the lines between the
+  '>>>' and '<<<' markers (markers excluded), or the payload of a binary
+  frame.
+  """
+
+  def __init__(self, recv_size = DEFAULT_RECV_SIZE):
+    self.buffer = bytearray()
+    self.scan = 0           # offset of the next byte not yet searched
+    self.body = -1          # offset of the current block body, -1 if none
+    self.end = -1           # end of the current binary payload, -1 if text
+    self.recv_size = recv_size
+    self.scratch = bytearray(recv_size)
+    self.view = memoryview(self.scratch)
+
+  def reset(self):
+    """ Forget any partially received data, e.g. after a reconnect """
+    del self.buffer[:]
+    self.scan = 0
+    self.body = -1
+    self.end = -1
+
+  def recv(self, sock):
+    """ Read one chunk from 'sock' into the buffer
+
+    Returns the list of blocks completed by this chunk, or None if the
+    peer closed the connection.
+    """
+    n = sock.recv_into(self.scratch, self.recv_size)
+    if n == 0:
+      return None
+    return self.feed(self.view[:n])
+
+  def feed(self, data):
+    """ Append raw bytes and return the list of newly completed blocks """
+    self.buffer += data
+    return self.parse()
+
+  def parse(self):
+    blocks = []
+    buf = self.buffer
+    consumed = 0
+    while True:
+      if self.body < 0:
+        i = buf.find(MARK, self.scan)
+        # the marker must start a line or directly follow the previous block
+        while i > consumed and buf[i - 1] != 10:
+          i = buf.find(MARK, i + 1)
+        if i < 0:
+          # nothing outside of a block is of interest; keep only the last
+          # partial line, which may be the beginning of a split marker
+          consumed = max(consumed, buf.rfind(b'\n', consumed) + 1)
+          self.scan = max(consumed, len(buf) - len(SOB))
+          break
+        if i + len(SOB) > len(buf):
+          self.scan = i
+          break
+        if buf[i + len(MARK)] == 10:
+          self.body = i + len(SOB)
+        elif buf[i + len(MARK)] == BINARY:
+          if i + len(MARK) + 1 + FRAME_LENGTH.size > len(buf):
+            self.scan = i
+            break
+          length, = FRAME_LENGTH.unpack_from(buf, i + len(MARK) + 1)
+          self.body = i + len(MARK) + 1 + FRAME_LENGTH.size
+          self.end = self.body + length
+        else:
+          self.scan = i + 1
+          continue
+        self.scan = self.body
+      if self.end >= 0:
+        if self.end > len(buf):
+          self.scan = self.body
+          break
+        blocks.append(bytes(buf[self.body:self.end]))
+        consumed = self.end
+        self.end = -1
+      else:
+        i = buf.find(EOB, self.scan)
+        while i > self.body and buf[i - 1] != 10:
+          i = buf.find(EOB, i + 1)
+        if i < 0:
+          self.scan = max(self.body, len(buf) - len(EOB))
+          break
+        blocks.append(bytes(buf[self.body:i]))
+        consumed = i + len(EOB)
+      self.body = -1
+      self.scan = consumed
+
+    if consumed:
+      # drop everything up to the end of the last complete block
+      del buf[:consumed]
+      self.scan -= consumed
+      if self.body >= 0:
+        self.body -= consumed
+      if self.end >= 0:
+        self.end -= consumed
+    return blocks
+
+class Connection:
+  """ The blocks of one procserver, across lost connections
+
+  batches() connects, sends BINARY_REQUEST if 'binary', then 'requests',
+  and yields the decoded blocks.  When the connection is lost or can't be
+  made, it tries again RECONNECT_DELAY seconds later, doubling the delay
+  after every failure up to MAX_RECONNECT_DELAY, until stop() is called.
+  A reconnection asks to resume after the last block received (see
+  resume_request()), so the server sends only what changed meanwhile, or
+  a snapshot, which consumers reconcile with merge_snapshot().
+  'on_status(text)' is told about every attempt.
+  """
+
+  def __init__(self, host, port, recv_size = DEFAULT_RECV_SIZE, binary = True, requests = (),
+               on_status = None):
+    self.host = host
+    self.port = port
+    self.hostport = "%s:%d" % (host, port)
+    self.parser = BlockParser(recv_size)
+    self.names = NameTable()
+    self.binary = binary
+    self.requests = requests
+    self.on_status = on_status
+    self.keep_going = True
+    self.stream = None      # the server's stream and the last block's seq in it
+    self.seq = None
+    self.connections = 0    # made so far
+    self.resumes = 0        # reconnections that asked to resume
+
+  def status(self, text):
+    if self.on_status:
+      self.on_status(text)
+
+  def stop(self):
+    self.keep_going = False
+
+  def connect(self):
+    """ A connected socket with the requests sent, None on failure """
+    sock = socket(AF_INET, SOCK_STREAM)
+    self.status("Connecting to %s..." % self.hostport)
+    rv = sock.connect_ex((self.host, self.port))
+    if rv != 0:
+      sock.close()
+      self.status("Connection to %s failed (%s)" % (self.hostport, os.strerror(rv)))
+      return None
+    # notice a peer that vanished without closing, e.g. a USB cable pulled
+    sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+    requests = ([BINARY_REQUEST] if self.binary else []) + list(self.requests)
+    if self.stream is not None:
+      requests.append(resume_request(self.stream, self.seq))
+      self.resumes += 1
+      self.status("Connected to %s, resuming after block %u" % (self.hostport, self.seq))
+    else:
+      self.status("Connected to %s" % self.hostport)
+    self.connections += 1
+    try:
+      sock.sendall(b''.join(requests))
+    except error:
+      sock.close()
+      return None
+    self.parser.reset()
+    return sock
+
+  def receive(self, sock):
+    """ Yield the batches of one connection until it's lost """
+    while self.keep_going:
+      try:
+        blocks = self.parser.recv(sock)
+      except error, e:
+        if e.errno == errno.EINTR:
+          continue
+        blocks = None
+      if blocks is None:
+        break
+      receive_time = time.time()
+      for block in blocks:
+        batch = decode_block(block, self.names)
+        batch.receive_time = receive_time
+        batch.decode_time = time.time()
+        if batch.stream is not None:
+          self.stream = batch.stream
+          self.seq = batch.seq
+        yield batch
+
+  def batches(self):
+    delay = RECONNECT_DELAY
+    while self.keep_going:
+      sock = self.connect()
+      if sock is not None:
+        try:
+          for batch in self.receive(sock):
+            delay = RECONNECT_DELAY
+            yield batch
+        finally:
+          sock.close()
+        if self.keep_going:
+          self.status("Connection to %s lost" % self.hostport)
+      if not self.keep_going:
+        break
+      self.status("Reconnecting to %s in %.1f s..." % (self.hostport, delay))
+      end = time.time() + delay
+      while self.keep_going and time.time() < end:
+        time.sleep(min(0.1, max(0.0, end - time.time())))
+      delay = min(delay * 2, MAX_RECONNECT_DELAY)
+    self.status("Connection to %s closed" % self.hostport)
@@ -0,0 +1,148 @@
+""" Live processes indexed by parent, with the USS total of every subtree.
+
+Every 'new' record carries the process' ppid, so the client can keep the
+process tree without asking the server for anything else.  Each node holds
+the total USS of its subtree, kept up to date as processes come, go and
+change: a change of USS is added to the node and its ancestors only, so it
+costs O(depth) whatever the number of processes, and the total of any
+subtree ("b2g and all content processes", "everything under Nuwa") is a
+lookup.
+
+Processes may be reported before their parent (pid reuse, or a snapshot in
+pid order): they wait as orphans and are attached when the parent arrives.
+When a process dies its children are handed to init, as the kernel does.
+
+This module must not import any GUI code.
+"""
+import fnmatch
+
+MAX_DEPTH = 64          # as procserver's subtree filter; guards against loops
+INIT = 1
+
+def subtree_spec(text):
+  """ A pid if 'text' is a number, else a name pattern """
+  return int(text) if text.isdigit() else text
+
+class Node:
+  """ One live process """
+
+  def __init__(self, pid, ppid, uss, name):
+    self.pid = pid
+    self.ppid = ppid
+    self.uss = uss
+    self.name = name
+    self.parent = None
+    self.children = set()
+    self.total = uss    # uss of this process and all of its descendants
+
+class ProcessTree:
+  """ Parent/child index of the live processes of one source """
+
+  def __init__(self):
+    self.nodes = {}       # pid -> Node
+    self.orphans = {}     # ppid -> set of Nodes whose parent isn't known (yet)
+    self.generation = 0   # bumped whenever a process comes, goes or is renamed
+
+  def __len__(self):
+    return len(self.nodes)
+
+  def __contains__(self, pid):
+    return pid in self.nodes
+
+  def propagate(self, node, delta):
+    """ Add 'delta' to the totals of 'node' and its ancestors """
+    depth = 0
+    while node is not None and depth < MAX_DEPTH:
+      node.total += delta
+      node = node.parent
+      depth += 1
+
+  def attach(self, node, parent):
+    # refuse to close a loop, which only a confused ppid could make
+    ancestor = parent
+    for depth in xrange(MAX_DEPTH):
+      if ancestor is None:
+        break
+      if ancestor is node:
+        self.orphans.setdefault(node.ppid, set()).add(node)
+        return
+      ancestor = ancestor.parent
+    node.parent = parent
+    parent.children.add(node)
+    self.propagate(parent, node.total)
+
+  def add(self, pid, ppid, uss, name = None):
+    if pid in self.nodes:
+      # the pid was reused before we heard of the death
+      self.remove(pid)
+    node = Node(pid, ppid, uss, name)
+    self.nodes[pid] = node
+    self.generation += 1
+    parent = self.nodes.get(ppid)
+    if parent is not None and ppid != pid:
+      self.attach(node, parent)
+    else:
+      self.orphans.setdefault(ppid, set()).add(node)
+    # children that were reported before this process
+    for child in self.orphans.pop(pid, ()):
+      self.attach(child, node)
+
+  def update(self, pid, uss, name = None):
+    node = self.nodes.get(pid)
+    if node is None:
+      return
+    if name is not None and name != node.name:
+      node.name = name
+      self.generation += 1
+    delta = uss - node.uss
+    if delta:
+      node.uss = uss
+      self.propagate(node, delta)
+
+  def remove(self, pid):
+    node = self.nodes.pop(pid, None)
+    if node is None:
+      return
+    self.generation += 1
+    if node.parent is not None:
+      node.parent.children.discard(node)
+      self.propagate(node.parent, -node.total)
+    else:
+      waiting = self.orphans.get(node.ppid)
+      if waiting is not None:
+        waiting.discard(node)
+        if not waiting:
+          del self.orphans[node.ppid]
+    # the kernel reparents the children to init
+    adopter = self.nodes.get(INIT)
+    for child in node.children:
+      child.parent = None
+      child.ppid = INIT
+      if adopter is not None and adopter is not node:
+        self.attach(child, adopter)
+      else:
+        self.orphans.setdefault(INIT, set()).add(child)
+    node.children = set()
+
+  def total(self, pid):
+    """ USS of 'pid' and all of its descendants, None if it isn't live """
+    node = self.nodes.get(pid)
+    return node.total if node is not None else None
+
+  def find(self, pattern):
+    """ The lowest live pid whose name matches the fnmatch 'pattern', None
+    if there is none """
+    for pid in sorted(self.nodes):
+      name = self.nodes[pid].name
+      if name is not None and fnmatch.fnmatchcase(name, pattern):
+        return pid
+    return None
+
+  def descendants(self, pid):
+    """ The pids of the subtree under 'pid', not including it """
+    node = self.nodes.get(pid)
+    stack = list(node.children) if node is not None else []
+    while stack:
+      node = stack.pop()
+      yield node.pid
+      stack.extend(node.children)